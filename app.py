@@ -1,7 +1,8 @@
 # Medical OCR Application - Multi-Model Voting System
 # Claude Sonnet 4 和 Claude 3 Haiku 各跑兩次，然後投票比對
 
-from flask import Flask, render_template, request, jsonify, redirect
+from flask import Flask, Request, render_template, request, jsonify, redirect, has_request_context, Response
+from flask.json.provider import DefaultJSONProvider
 import boto3
 import json
 import os
@@ -10,16 +11,105 @@ import base64
 from datetime import datetime
 import uuid
 from werkzeug.utils import secure_filename
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+from botocore.config import Config
+from boto3.dynamodb.conditions import Key, Attr
 from collections import Counter, defaultdict
 import difflib
 import asyncio
 import concurrent.futures
+import time
+import threading
+import hashlib
+import queue
+import sqlite3
+from collections import OrderedDict, deque
 from decimal import Decimal
+import io
+import zipfile
+import mimetypes
+import functools
+import heapq
+import itertools
+import random
+import contextlib
+from PIL import Image, ImageChops, ImageOps
+from PyPDF2 import PdfReader, PdfWriter
 
 app = Flask(__name__)
 
-# 日期格式正規化函數
+# 日期格式正規化（預先編譯，依序嘗試；\d 也會匹配全形數字，輸出時一律轉為半形）
+CHINESE_DATE_PATTERN = re.compile(r'(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*[日號]?')
+ROC_DATE_PATTERN = re.compile(r'民國\s*(\d{1,3})\s*[年/.-]\s*(\d{1,2})\s*[月/.-]\s*(\d{1,2})\s*[日號]?')
+ROC_SHORT_DATE_PATTERN = re.compile(r'(?<!\d)(\d{2,3})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*[日號]?')  # 省略「民國」，例如 110年6月1日
+ISO_DATE_PATTERN = re.compile(r'(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})')
+DAY_FIRST_DATE_PATTERN = re.compile(r'(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})')
+COMPACT_DATE_PATTERN = re.compile(r'(\d{4})(\d{2})(\d{2})')
+
+def format_date_parts(year, month, day):
+    """驗證日期後回傳 yyyy/mm/dd，不合法時回傳 None"""
+    try:
+        datetime(year, month, day)
+    except ValueError:
+        return None
+    return f"{year:04d}/{month:02d}/{day:02d}"
+
+def parse_date_string(date_string):
+    """
+    將單一（已去除空白的）日期字串轉換為 yyyy/mm/dd，無法辨識時回傳原字串
+    normalize_date_format 會以 LRU 快取包裝此函數
+    """
+    if not date_string:
+        return date_string
+
+    try:
+        # 中文日期格式 (yyyy年mm月dd日, yyyy年mm月dd號)
+        match = CHINESE_DATE_PATTERN.search(date_string)
+        if match:
+            year, month, day = map(int, match.groups())
+            formatted = format_date_parts(year, month, day)
+            if formatted:
+                return formatted
+
+        # 民國年格式 (民國xxx年mm月dd日、民國xxx/mm/dd)，以及省略「民國」的 xxx年mm月dd日
+        match = ROC_DATE_PATTERN.search(date_string) or ROC_SHORT_DATE_PATTERN.search(date_string)
+        if match:
+            roc_year, month, day = map(int, match.groups())
+            formatted = format_date_parts(roc_year + 1911, month, day)  # 民國年轉西元年
+            if formatted:
+                return formatted
+
+        # yyyy-mm-dd, yyyy/mm/dd, yyyy.mm.dd
+        match = ISO_DATE_PATTERN.search(date_string)
+        if match:
+            year, month, day = map(int, match.groups())
+            formatted = format_date_parts(year, month, day)
+            if formatted:
+                return formatted
+
+        # dd-mm-yyyy 優先；日/月不合法時再以 mm-dd-yyyy (美式日期) 解讀
+        match = DAY_FIRST_DATE_PATTERN.search(date_string)
+        if match:
+            first, second, year = map(int, match.groups())
+            formatted = format_date_parts(year, second, first) or format_date_parts(year, first, second)
+            if formatted:
+                return formatted
+
+        # 純數字格式 (yyyymmdd)
+        match = COMPACT_DATE_PATTERN.fullmatch(date_string)
+        if match:
+            year, month, day = map(int, match.groups())
+            formatted = format_date_parts(year, month, day)
+            if formatted:
+                return formatted
+
+        # 如果都無法匹配，返回原始字符串
+        return date_string
+
+    except Exception as e:
+        print(f"日期格式化錯誤: {str(e)}")
+        return date_string
+
 def normalize_date_format(date_string):
     """
     將各種日期格式統一轉換為 yyyy/mm/dd 格式
@@ -28,91 +118,40 @@ def normalize_date_format(date_string):
     - dd-mm-yyyy, dd/mm/yyyy, dd.mm.yyyy
     - mm-dd-yyyy, mm/dd/yyyy, mm.dd.yyyy
     - yyyy年mm月dd日, yyyy年mm月dd號
-    - 民國年格式等
+    - 民國年格式（民國110年6月1日、民國110/6/1、110年6月1日）等
+    相同字串的結果保存在有上限的 LRU 快取 (DATE_NORMALIZATION_CACHE_SIZE)
     """
     if not date_string or not isinstance(date_string, str):
         return date_string
-    
-    # 移除多餘的空白字符
-    date_string = date_string.strip()
-    
-    if not date_string:
-        return date_string
-    
-    try:
-        # 處理中文日期格式 (yyyy年mm月dd日, yyyy年mm月dd號)
-        chinese_date_pattern = r'(\d{4})年(\d{1,2})月(\d{1,2})[日號]?'
-        chinese_match = re.search(chinese_date_pattern, date_string)
-        if chinese_match:
-            year, month, day = chinese_match.groups()
-            return f"{year}/{month.zfill(2)}/{day.zfill(2)}"
-        
-        # 處理民國年格式 (民國xxx年mm月dd日)
-        roc_date_pattern = r'民國(\d{1,3})年(\d{1,2})月(\d{1,2})[日號]?'
-        roc_match = re.search(roc_date_pattern, date_string)
-        if roc_match:
-            roc_year, month, day = roc_match.groups()
-            year = int(roc_year) + 1911  # 民國年轉西元年
-            return f"{year}/{month.zfill(2)}/{day.zfill(2)}"
-        
-        # 處理各種分隔符的日期格式
-        # 匹配 yyyy-mm-dd, yyyy/mm/dd, yyyy.mm.dd 格式
-        iso_pattern = r'(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})'
-        iso_match = re.search(iso_pattern, date_string)
-        if iso_match:
-            year, month, day = iso_match.groups()
-            # 驗證是否為合理的日期
-            try:
-                datetime(int(year), int(month), int(day))
-                return f"{year}/{month.zfill(2)}/{day.zfill(2)}"
-            except ValueError:
-                pass
-        
-        # 處理 dd-mm-yyyy, dd/mm/yyyy, dd.mm.yyyy 格式
-        dmy_pattern = r'(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})'
-        dmy_match = re.search(dmy_pattern, date_string)
-        if dmy_match:
-            day, month, year = dmy_match.groups()
-            # 驗證是否為合理的日期
-            try:
-                datetime(int(year), int(month), int(day))
-                return f"{year}/{month.zfill(2)}/{day.zfill(2)}"
-            except ValueError:
-                pass
-        
-        # 處理 mm-dd-yyyy, mm/dd/yyyy, mm.dd.yyyy 格式 (美式日期)
-        mdy_pattern = r'(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})'
-        mdy_match = re.search(mdy_pattern, date_string)
-        if mdy_match:
-            month, day, year = mdy_match.groups()
-            # 驗證是否為合理的日期
-            try:
-                datetime(int(year), int(month), int(day))
-                # 如果月份大於12，可能是dd/mm/yyyy格式
-                if int(month) > 12:
-                    return f"{year}/{day.zfill(2)}/{month.zfill(2)}"
-                else:
-                    return f"{year}/{month.zfill(2)}/{day.zfill(2)}"
-            except ValueError:
-                pass
-        
-        # 處理純數字格式 (yyyymmdd)
-        numeric_pattern = r'^(\d{4})(\d{2})(\d{2})$'
-        numeric_match = re.match(numeric_pattern, date_string)
-        if numeric_match:
-            year, month, day = numeric_match.groups()
-            try:
-                datetime(int(year), int(month), int(day))
-                return f"{year}/{month}/{day}"
-            except ValueError:
-                pass
-        
-        # 如果都無法匹配，返回原始字符串
-        return date_string
-        
-    except Exception as e:
-        print(f"日期格式化錯誤: {str(e)}")
-        return date_string
+    return cached_date_normalization(date_string.strip())
+
+def normalize_date_column(values):
+    """
+    一次正規化一整欄日期字串（回填、匯出用），回傳與輸入等長的串列
+    同一欄內重複的字串只處理一次，非字串值原樣保留
+    """
+    distinct = {}
+    normalized = []
+    for value in values:
+        if isinstance(value, str):
+            if value not in distinct:
+                distinct[value] = normalize_date_format(value)
+            normalized.append(distinct[value])
+        else:
+            normalized.append(value)
+    return normalized
+
+def get_date_normalization_summary():
+    """日期正規化快取的命中次數與命中率"""
+    info = cached_date_normalization.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hit_ratio': round(info.hits / lookups, 4) if lookups else 0.0
+    }
 
 def normalize_dates_in_data(data):
     """
@@ -200,6 +239,40 @@ VET_FORM_FIELDS = {
     'remarks': '備註'
 }
 
+# 表格區塊與欄位的對應（與提取提示詞的 JSON 結構一致）
+VET_FORM_SECTIONS = {
+    'basic_info': ['chart_number', 'first_visit_date'],
+    'pet_info': ['pet_name', 'species', 'breed', 'pet_gender', 'desexed', 'color', 'pet_age', 'pet_birth_date'],
+    'medical_history': ['past_medical_history'],
+    'owner_info': ['owner_id', 'owner_name', 'owner_birth_date', 'phone', 'line_id', 'email',
+                   'registered_address', 'mailing_address'],
+    'preventive_care': ['monthly_preventive_treatment', 'monthly_preventive_yes', 'monthly_preventive_no',
+                        'major_illness_surgery', 'vaccine_types', 'vaccine_rabies', 'vaccine_3in1',
+                        'vaccine_4in1', 'vaccine_5in1', 'vaccine_others', 'vaccine_others_detail'],
+    'visit_info': ['visit_purpose', 'remarks']
+}
+
+# 初診表的固定版面（百分比座標），區塊式 OCR 在使用者未指定區域時使用
+VET_FORM_BLOCK_LAYOUT = [
+    {'type': 'basic_info', 'label': '基本資料', 'coordinates': {'x': 0, 'y': 0, 'width': 100, 'height': 12}},
+    {'type': 'pet_info', 'label': '寵物資料', 'coordinates': {'x': 0, 'y': 12, 'width': 100, 'height': 22}},
+    {'type': 'medical_history', 'label': '病史資料', 'coordinates': {'x': 0, 'y': 34, 'width': 100, 'height': 10}},
+    {'type': 'owner_info', 'label': '飼主資料', 'coordinates': {'x': 0, 'y': 44, 'width': 100, 'height': 24}},
+    {'type': 'preventive_care', 'label': '預防醫療資料', 'coordinates': {'x': 0, 'y': 68, 'width': 100, 'height': 22}},
+    {'type': 'visit_info', 'label': '就診資訊', 'coordinates': {'x': 0, 'y': 90, 'width': 100, 'height': 10}}
+]
+
+# 區塊式 OCR 頁面上的通用區塊類型對應到的表單區塊（未列出的類型提取所有區塊）
+BLOCK_TYPE_SECTIONS = {
+    'patient_info': ['pet_info', 'owner_info'],
+    'hospital_info': ['basic_info'],
+    'provider_info': ['basic_info'],
+    'dates': ['basic_info'],
+    'diagnosis': ['medical_history', 'visit_info'],
+    'medications': ['preventive_care'],
+    'vitals': ['pet_info']
+}
+
 def normalize_vet_form_data(data):
     """標準化動物醫院表格資料，將英文轉換為繁體中文"""
     
@@ -289,6 +362,199 @@ def normalize_vet_form_data(data):
                 normalized_data[key] = value
     
     return normalized_data
+
+# 英文選項值 → 繁體中文（整個單字比對、不分大小寫）
+FORM_VALUE_TRANSLATIONS = {
+    'not vaccinated': '未施打',
+    'vaccinated': '已施打',
+    'yes': '是',
+    'no': '否',
+    'none': '無',
+    'cat': '貓',
+    'dog': '狗',
+    'male': '公',
+    'female': '母',
+    'spayed': '已絕育',
+    'neutered': '已絕育',
+    'intact': '未絕育'
+}
+
+# 單一 alternation 一次掃描完所有選項值；較長的詞在前，"not vaccinated" 才不會先被 "vaccinated" 吃掉
+FORM_VALUE_PATTERN = re.compile(
+    r'\b(?:' + '|'.join(re.escape(word) for word in sorted(FORM_VALUE_TRANSLATIONS, key=len, reverse=True)) + r')\b',
+    re.IGNORECASE
+)
+
+# 欄位缺少或為空時的預設值（依 VET_FORM_SECTIONS 放在所屬區塊內）
+FORM_FIELD_DEFAULTS = {
+    'desexed': '否'
+}
+
+FORM_FIELD_SECTIONS = {field: section for section, fields in VET_FORM_SECTIONS.items() for field in fields}
+
+DATE_FIELD_KEYWORDS = ('date', '日期', 'time', '時間')
+
+@functools.lru_cache(maxsize=512)
+def is_date_field(key):
+    """欄位名稱是否為日期欄位（與 normalize_dates_in_data 的判斷相同，欄位名稱有限所以快取）"""
+    lowered = key.lower()
+    return any(keyword in lowered for keyword in DATE_FIELD_KEYWORDS)
+
+def translate_form_value(text):
+    """將字串中的英文選項值轉換為繁體中文"""
+    return FORM_VALUE_PATTERN.sub(lambda match: FORM_VALUE_TRANSLATIONS[match.group(0).lower()], text)
+
+def _normalize_form_value(value, key, translate):
+    if isinstance(value, str):
+        if key is not None and is_date_field(key):
+            return normalize_date_format(value)
+        return translate_form_value(value) if translate and value else value
+    if isinstance(value, dict):
+        return {k: _normalize_form_value(v, k, translate) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize_form_value(item, None, translate) for item in value]
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return value
+
+def normalize_form_record(data, translate=True):
+    """
+    單次走訪完成表單資料正規化，取代 set_default_values → normalize_vet_form_data /
+    normalize_dates_in_data → convert_floats_to_decimal 的多次遞迴：
+    - 日期欄位統一為 yyyy/mm/dd
+    - 其他字串的英文選項值轉為繁體中文（translate=False 時略過，例如使用者手動編輯的結果）
+    - float 轉為 DynamoDB 可接受的 Decimal
+    - 依 FORM_FIELD_DEFAULTS 在所屬區塊補上預設值
+    回傳新的結構，不修改輸入
+    """
+    normalized = _normalize_form_value(data, None, translate)
+    if not isinstance(normalized, dict):
+        return normalized
+
+    for field, default in FORM_FIELD_DEFAULTS.items():
+        section = normalized.setdefault(FORM_FIELD_SECTIONS[field], {})
+        if not isinstance(section, dict):
+            continue
+        current = section.get(field)
+        if not current or (isinstance(current, str) and not current.strip()):
+            section[field] = default
+    return normalized
+
+# 表單欄位的固定順序（VetFormRecord 的 slot 與投票陣列皆使用此 index）
+FORM_FIELD_PATHS = tuple(f"{section}.{field}" for section, fields in VET_FORM_SECTIONS.items() for field in fields)
+FORM_FIELD_NAMES = tuple(path.split('.', 1)[1] for path in FORM_FIELD_PATHS)
+FORM_FIELD_INDEX = {path: index for index, path in enumerate(FORM_FIELD_PATHS)}
+FORM_FIELD_KEYS = tuple(tuple(path.split('.', 1)) for path in FORM_FIELD_PATHS)
+
+_UNSET = object()
+
+def flatten_form_value(value, path):
+    """將巢狀 dict 展開為 (欄位路徑, 值)"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten_form_value(item, f"{path}.{key}")
+    else:
+        yield path, value
+
+class VetFormRecord:
+    """
+    初診表提取結果的精簡表示：VET_FORM_SECTIONS 的每個欄位一個 slot
+    - 未設定的 slot 代表模型沒有回傳該欄位（與空字串不同）
+    - 不在 schema 內的區塊或欄位原樣保留在 extras（欄位路徑 → 值）
+    多模型投票時每次模型執行的 extracted_data 即為此物件（模型輸出的巢狀 dict 轉換後即丟棄），
+    投票以固定順序讀取欄位；API 回應與 S3 結果檔在序列化時才轉回巢狀 JSON（見 form_json_default）
+    """
+    __slots__ = FORM_FIELD_NAMES + ('extras',)
+    
+    def __init__(self, **fields):
+        self.extras = None
+        for name, value in fields.items():
+            setattr(self, name, value)
+    
+    @classmethod
+    def from_nested(cls, data):
+        """由模型輸出 / UI 使用的巢狀 JSON 建立"""
+        record = cls()
+        extras = {}
+        for section, content in (data or {}).items():
+            if section not in VET_FORM_SECTIONS or not isinstance(content, dict):
+                extras[section] = content
+                continue
+            for field, value in content.items():
+                if FORM_FIELD_SECTIONS.get(field) == section:
+                    setattr(record, field, value)
+                else:
+                    extras[f"{section}.{field}"] = value
+        record.extras = extras or None
+        return record
+    
+    def __len__(self):
+        """已設定的欄位數（含 extras），模型沒有回傳任何欄位時為 0"""
+        return sum(1 for name in FORM_FIELD_NAMES if hasattr(self, name)) + len(self.extras or ())
+    
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+    
+    def values(self, missing=None):
+        """依 FORM_FIELD_PATHS 順序回傳各欄位的值，未設定的欄位為 missing"""
+        return [getattr(self, name, missing) for name in FORM_FIELD_NAMES]
+    
+    def items(self):
+        """依序產生 (欄位路徑, 值)：schema 欄位以固定順序取得，extras 與 dict 值才展開"""
+        for path, name in zip(FORM_FIELD_PATHS, FORM_FIELD_NAMES):
+            value = getattr(self, name, _UNSET)
+            if value is _UNSET:
+                continue
+            if isinstance(value, dict):
+                yield from flatten_form_value(value, path)
+            else:
+                yield path, value
+        if self.extras:
+            for path, value in self.extras.items():
+                yield from flatten_form_value(value, path)
+    
+    def to_nested(self, include_empty=False):
+        """
+        轉回 UI / API 使用的巢狀 JSON（依 schema 順序）
+        include_empty=True 時未設定的欄位填入空字串，確保每個區塊都存在
+        """
+        nested = {}
+        for section, fields in VET_FORM_SECTIONS.items():
+            content = {}
+            for field in fields:
+                value = getattr(self, field, _UNSET)
+                if value is not _UNSET:
+                    content[field] = value
+                elif include_empty:
+                    content[field] = ""
+            if content:
+                nested[section] = content
+        if self.extras:
+            for path, value in self.extras.items():
+                section, _, field = path.partition('.')
+                if field:
+                    nested.setdefault(section, {})[field] = value
+                else:
+                    nested[path] = value
+        return nested
+
+def form_json_default(value):
+    """json.dumps 的 default：VetFormRecord 輸出為 UI 使用的巢狀 JSON"""
+    if isinstance(value, VetFormRecord):
+        return value.to_nested()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class FormJSONProvider(DefaultJSONProvider):
+    """jsonify 回應中的 VetFormRecord（模型執行結果）轉為巢狀 JSON"""
+    
+    @staticmethod
+    def default(value):
+        if isinstance(value, VetFormRecord):
+            return value.to_nested()
+        return DefaultJSONProvider.default(value)
+
+app.json = FormJSONProvider(app)
+
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
 # Load environment variables
@@ -305,9 +571,140 @@ CLAUDE_SONNET_MODEL_ID = 'us.anthropic.claude-sonnet-4-20250514-v1:0'
 CLAUDE_HAIKU_MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
 CLAUDE_SONNET_LATEST_MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'  # For automatic validation
 
+# 模型並行呼叫設定
+MODEL_FANOUT_MAX_WORKERS = int(os.getenv('MODEL_FANOUT_MAX_WORKERS', '8'))  # 全域同時進行的模型呼叫上限
+MODEL_CALL_TIMEOUT_SECONDS = float(os.getenv('MODEL_CALL_TIMEOUT_SECONDS', '120'))  # 單一模型呼叫逾時
+
+# Bedrock 全域排程設定：每個模型依 RPM / TPM 配額排隊，遇到節流時自動降低並行數 (AIMD)
+BEDROCK_SCHEDULER_ENABLED = os.getenv('BEDROCK_SCHEDULER_ENABLED', 'true').lower() == 'true'
+BEDROCK_DEFAULT_RPM = int(os.getenv('BEDROCK_DEFAULT_RPM', '50'))
+BEDROCK_DEFAULT_TPM = int(os.getenv('BEDROCK_DEFAULT_TPM', '200000'))
+BEDROCK_DEFAULT_MAX_CONCURRENCY = int(os.getenv('BEDROCK_DEFAULT_MAX_CONCURRENCY', '4'))
+BEDROCK_MODEL_QUOTAS = json.loads(os.getenv('BEDROCK_MODEL_QUOTAS', '{}'))  # {"model_id": {"rpm": 50, "tpm": 200000, "max_concurrency": 4}}
+BEDROCK_SCHEDULER_MAX_WAIT_SECONDS = float(os.getenv('BEDROCK_SCHEDULER_MAX_WAIT_SECONDS', '60'))
+BEDROCK_THROTTLE_RETRIES = int(os.getenv('BEDROCK_THROTTLE_RETRIES', '2'))  # 取代 boto3 內建重試
+BEDROCK_TRANSIENT_RETRIES = int(os.getenv('BEDROCK_TRANSIENT_RETRIES', '2'))  # 5xx 與連線錯誤的重試次數（與 boto3 standard 模式相同）
+BEDROCK_IMAGE_TOKEN_ESTIMATE = int(os.getenv('BEDROCK_IMAGE_TOKEN_ESTIMATE', '1600'))  # 單張圖片的輸入 token 估計
+
+# 對沖請求（預設關閉）：模型呼叫超過近期延遲的百分位數時，另外送出一個重複請求，取先回來的結果
+HEDGING_ENABLED = os.getenv('HEDGING_ENABLED', 'false').lower() == 'true'
+HEDGE_LATENCY_PERCENTILE = float(os.getenv('HEDGE_LATENCY_PERCENTILE', '0.95'))
+HEDGE_LATENCY_WINDOW = int(os.getenv('HEDGE_LATENCY_WINDOW', '200'))  # 每個模型保留的近期延遲樣本數
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))  # 樣本不足時不對沖
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv('HEDGE_MIN_DELAY_SECONDS', '2'))
+HEDGE_MAX_PER_MINUTE = int(os.getenv('HEDGE_MAX_PER_MINUTE', '10'))
+HEDGE_ALTERNATE_MODELS = json.loads(os.getenv('HEDGE_ALTERNATE_MODELS', '{}'))  # {"model_id": "其他 inference profile 或替代模型"}，未設定則重送同一模型
+
+# 每個模型的斷路器：滑動視窗內錯誤率或慢呼叫比例過高時暫停呼叫，投票改用替代模型或略過
+CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+CIRCUIT_WINDOW_SECONDS = float(os.getenv('CIRCUIT_WINDOW_SECONDS', '60'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '5'))  # 視窗內呼叫數不足時不判斷
+CIRCUIT_ERROR_RATE_THRESHOLD = float(os.getenv('CIRCUIT_ERROR_RATE_THRESHOLD', '0.5'))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_SLOW_CALL_SECONDS', '60'))
+CIRCUIT_SLOW_RATE_THRESHOLD = float(os.getenv('CIRCUIT_SLOW_RATE_THRESHOLD', '0.5'))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))  # 開啟後經過此時間允許一次試探呼叫
+CIRCUIT_FALLBACK_MODELS = json.loads(os.getenv('CIRCUIT_FALLBACK_MODELS', '{}'))  # {"model_id": "替代模型"}，未設定則略過
+
+SCHEDULER_PRIORITY_INTERACTIVE = 0
+SCHEDULER_PRIORITY_DEFAULT = 1
+SCHEDULER_PRIORITY_BACKGROUND = 2
+SCHEDULER_ROUTE_PRIORITIES = {
+    'process_human_review': SCHEDULER_PRIORITY_INTERACTIVE,
+    'job_human_review': SCHEDULER_PRIORITY_INTERACTIVE,
+    'upload_and_vote': SCHEDULER_PRIORITY_INTERACTIVE,
+    'api_reprocess_image': SCHEDULER_PRIORITY_BACKGROUND,
+    'batch_automatic': SCHEDULER_PRIORITY_BACKGROUND,
+    'batch_human_review': SCHEDULER_PRIORITY_BACKGROUND,
+    'background': SCHEDULER_PRIORITY_BACKGROUND
+}
+
+# 投票模式: full = 三個模型全部執行, quorum = 前兩個模型一致時跳過第三個模型
+VOTING_MODE = os.getenv('VOTING_MODE', 'full')
+QUORUM_PRIMARY_MODEL_IDS = [CLAUDE_SONNET_MODEL_ID, CLAUDE_HAIKU_MODEL_ID]
+QUORUM_TIE_BREAKER_MODEL_ID = CLAUDE_SONNET_LATEST_MODEL_ID
+
+# 低信心欄位精修：投票後只針對有爭議的欄位，以最強的模型做一次小型重新提取
+REFINEMENT_ENABLED = os.getenv('REFINEMENT_ENABLED', 'true').lower() == 'true'
+REFINEMENT_MODEL_ID = os.getenv('REFINEMENT_MODEL_ID', CLAUDE_SONNET_MODEL_ID)
+REFINEMENT_CONFIDENCE_THRESHOLD = float(os.getenv('REFINEMENT_CONFIDENCE_THRESHOLD', '0.7'))  # 三票中有一票不同 (0.67) 即精修
+REFINEMENT_MAX_FIELDS = int(os.getenv('REFINEMENT_MAX_FIELDS', '12'))  # 超過此數量代表整張表都不可靠，交給人工審核
+REFINEMENT_MAX_TOKENS = int(os.getenv('REFINEMENT_MAX_TOKENS', '600'))
+
+# 結構化輸出：tool = 以 toolConfig 傳入表單 schema 並讀取 toolUse 輸入, text = 解析自由文字中的 JSON
+EXTRACTION_OUTPUT_MODE = os.getenv('EXTRACTION_OUTPUT_MODE', 'tool')
+EXTRACTION_TOOL_NAME = 'record_vet_form'
+
+# 提取提示詞變體：full = 完整 JSON 骨架與說明, compact = 扁平短鍵與精簡說明（較少輸入 token）
+EXTRACTION_PROMPT_VARIANT = os.getenv('EXTRACTION_PROMPT_VARIANT', 'full')
+EXTRACTION_PROMPT_VARIANTS = json.loads(os.getenv('EXTRACTION_PROMPT_VARIANTS', '{}'))  # {"model_id": "compact"} 依模型指定
+
+# 日期正規化快取：同一批日期字串會在各筆紀錄與重新處理時反覆出現
+DATE_NORMALIZATION_CACHE_SIZE = int(os.getenv('DATE_NORMALIZATION_CACHE_SIZE', '4096'))  # LRU 筆數，0 為不快取
+cached_date_normalization = functools.lru_cache(maxsize=DATE_NORMALIZATION_CACHE_SIZE)(parse_date_string)
+
+# 區塊式 OCR 設定：每個區域使用較短的提示詞與輸出上限
+BLOCK_MODEL_ID = os.getenv('BLOCK_MODEL_ID', CLAUDE_SONNET_MODEL_ID)
+BLOCK_MAX_TOKENS = int(os.getenv('BLOCK_MAX_TOKENS', '800'))
+BLOCK_CROP_PADDING_PERCENT = float(os.getenv('BLOCK_CROP_PADDING_PERCENT', '1.5'))  # 避免切到區塊邊緣的文字
+
+# 多頁 PDF 設定：逐頁取出內容，記憶體上限為上傳檔大小加上同時處理的頁數
+PDF_PAGE_CONCURRENCY = int(os.getenv('PDF_PAGE_CONCURRENCY', '3'))
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '50'))
+
+# 批次上傳設定：多個檔案或 ZIP 逐一串流到 S3，再以有限的並行數處理
+BATCH_MAX_PARALLEL = int(os.getenv('BATCH_MAX_PARALLEL', '4'))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '1000'))
+BATCH_MAX_UPLOAD_MB = int(os.getenv('BATCH_MAX_UPLOAD_MB', '512'))  # 只適用於批次上傳路由
+BATCH_MAX_ZIP_ENTRIES = int(os.getenv('BATCH_MAX_ZIP_ENTRIES', '2000'))  # 單一 ZIP 最多讀取的項目數
+BATCH_MAX_UNCOMPRESSED_MB = int(os.getenv('BATCH_MAX_UNCOMPRESSED_MB', '2048'))  # 單一 ZIP 解壓縮後的總大小上限
+
+# 處理進度事件 (Server-Sent Events)
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))  # 沒有事件時送出註解保持連線；使用持久化佇列時同時補查狀態
+SSE_STREAM_MAX_SECONDS = float(os.getenv('SSE_STREAM_MAX_SECONDS', '900'))  # 超過後結束串流，瀏覽器會帶 Last-Event-ID 重新連線
+SSE_REPLAY_EVENTS = int(os.getenv('SSE_REPLAY_EVENTS', '100'))  # 每個主題保留的近期事件數，晚加入的訂閱者會先收到這些事件
+SSE_TOPIC_TTL_SECONDS = float(os.getenv('SSE_TOPIC_TTL_SECONDS', '900'))  # 沒有訂閱者且超過此時間未發布的主題會被清除
+SSE_SUBSCRIBER_QUEUE_SIZE = int(os.getenv('SSE_SUBSCRIBER_QUEUE_SIZE', '256'))  # 佇列滿時丟棄事件，慢的連線不會拖慢處理流程
+SSE_MAX_TOPICS_PER_STREAM = int(os.getenv('SSE_MAX_TOPICS_PER_STREAM', '50'))
+
+# 萃取結果快取設定 (memory / disk / s3 / none)
+EXTRACTION_CACHE_BACKEND = os.getenv('EXTRACTION_CACHE_BACKEND', 'memory')
+EXTRACTION_CACHE_TTL_SECONDS = int(os.getenv('EXTRACTION_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', '1024'))
+EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', '/tmp/medical-ocr-extraction-cache')
+EXTRACTION_CACHE_S3_PREFIX = os.getenv('EXTRACTION_CACHE_S3_PREFIX', 'extraction_cache/')
+
+# 圖片前處理設定（送往 Bedrock 前執行一次，所有模型共用）
+IMAGE_PREPROCESSING_ENABLED = os.getenv('IMAGE_PREPROCESSING_ENABLED', 'true').lower() == 'true'
+IMAGE_MAX_LONG_EDGE = int(os.getenv('IMAGE_MAX_LONG_EDGE', '1568'))  # Claude 超過此長邊會自行縮圖
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+IMAGE_GRAYSCALE_MAX_CHANNEL_DIFF = int(os.getenv('IMAGE_GRAYSCALE_MAX_CHANNEL_DIFF', '12'))  # 色差低於此值才轉灰階
+
+# 非同步處理工作池設定
+JOB_WORKER_COUNT = int(os.getenv('JOB_WORKER_COUNT', '4'))
+JOB_QUEUE_MAX_DEPTH = int(os.getenv('JOB_QUEUE_MAX_DEPTH', '100'))
+
+# 持久化工作佇列設定 (thread = 行程內工作池, sqlite = 本機開發/測試, sqs = 正式環境)
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'thread')
+JOB_QUEUE_SQLITE_PATH = os.getenv('JOB_QUEUE_SQLITE_PATH', 'ocr_jobs.sqlite3')
+JOB_QUEUE_SQS_URL = os.getenv('JOB_QUEUE_SQS_URL')
+JOB_DEAD_LETTER_SQS_URL = os.getenv('JOB_DEAD_LETTER_SQS_URL')
+JOB_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv('JOB_VISIBILITY_TIMEOUT_SECONDS', '300'))  # 處理中的工作會定期延長，只需涵蓋兩次心跳之間
+JOB_HEARTBEAT_INTERVAL_SECONDS = float(os.getenv('JOB_HEARTBEAT_INTERVAL_SECONDS', str(JOB_VISIBILITY_TIMEOUT_SECONDS / 3)))  # 需小於 visibility timeout
+JOB_MAX_RECEIVES = int(os.getenv('JOB_MAX_RECEIVES', '3'))  # 超過後移到 dead-letter
+JOB_RETRY_BASE_DELAY_SECONDS = int(os.getenv('JOB_RETRY_BASE_DELAY_SECONDS', '10'))
+JOB_QUEUE_DEPTH_CACHE_SECONDS = float(os.getenv('JOB_QUEUE_DEPTH_CACHE_SECONDS', '15'))  # SQS 佇列深度快取，避免每次 /metrics 抓取都呼叫 get_queue_attributes
+
+# 健康檢查設定：依賴服務由背景執行緒定期探測，/health/ready 只讀取快取結果
+HEALTH_PROBE_INTERVAL_SECONDS = float(os.getenv('HEALTH_PROBE_INTERVAL_SECONDS', '30'))
+HEALTH_STALE_AFTER_SECONDS = float(os.getenv('HEALTH_STALE_AFTER_SECONDS', '120'))  # 超過此時間未更新視為不健康
+HEALTH_READY_DEPENDENCIES = [name for name in os.getenv('HEALTH_READY_DEPENDENCIES', 'dynamodb,s3,bedrock').split(',') if name]
+
 # DynamoDB Configuration
 DYNAMODB_TABLE_NAME = os.getenv('DYNAMODB_TABLE_NAME', 'medical-ocr-results')
 DYNAMODB_IMAGES_TABLE_NAME = os.getenv('DYNAMODB_IMAGES_TABLE_NAME', 'medical-ocr-images')
+DYNAMODB_RECORD_TYPE_INDEX = os.getenv('DYNAMODB_RECORD_TYPE_INDEX', 'record-type-created-at-index')
+IMAGES_PAGE_MAX_LIMIT = 100
+IMAGE_URL_EXPIRES_SECONDS = int(os.getenv('IMAGE_URL_EXPIRES_SECONDS', '3600'))
 
 # Initialize AWS clients
 def create_aws_session():
@@ -321,759 +718,3964 @@ def create_aws_session():
 
 aws_session = create_aws_session()
 s3_client = aws_session.client('s3')
-bedrock_client = aws_session.client('bedrock-runtime')
+# 節流與暫時性錯誤的重試由 scheduled_converse 處理，關閉 boto3 內建重試以免延遲疊加
+bedrock_client = aws_session.client(
+    'bedrock-runtime',
+    config=Config(retries={'max_attempts': 1 if BEDROCK_SCHEDULER_ENABLED else 3, 'mode': 'standard'})
+)
 dynamodb = aws_session.resource('dynamodb')
 dynamodb_table = dynamodb.Table(DYNAMODB_TABLE_NAME)
 dynamodb_images_table = dynamodb.Table(DYNAMODB_IMAGES_TABLE_NAME)
+bedrock_control_client = aws_session.client('bedrock')  # 只用於健康檢查
+
+# 延遲與用量指標（以 Prometheus 文字格式在 /metrics 輸出）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded', 'SlowDown', 'ServiceQuotaExceededException'
+}
+TRANSIENT_ERROR_CODES = {
+    'InternalServerException', 'InternalFailure', 'ServiceUnavailableException', 'ServiceUnavailable',
+    'ModelNotReadyException', 'RequestTimeout', 'RequestTimeoutException'
+}
+TRANSIENT_CONNECTION_ERRORS = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError)
+
+class MetricsRegistry:
+    """執行緒安全的 counter / histogram 集合"""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.metadata = {}
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauge_callbacks = []
+    
+    def describe(self, name, metric_type, help_text):
+        self.metadata[name] = (metric_type, help_text)
+    
+    def inc(self, name, labels=None, amount=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] += amount
+    
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+    
+    def register_gauges(self, callback):
+        """callback 回傳 [(name, labels, value)]，於輸出時呼叫"""
+        self.gauge_callbacks.append(callback)
+    
+    @staticmethod
+    def format_labels(labels, extra=None):
+        pairs = list(labels) + list(extra or [])
+        if not pairs:
+            return ''
+        escaped = [
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        ]
+        return '{' + ','.join(escaped) + '}'
+    
+    def render(self):
+        samples = defaultdict(list)
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples[name].append(f"{name}{self.format_labels(labels)} {value:g}")
+            for (name, labels), histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    samples[name].append(f"{name}_bucket{self.format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                samples[name].append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                samples[name].append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']:.6f}")
+                samples[name].append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        for callback in self.gauge_callbacks:
+            try:
+                for name, labels, value in callback():
+                    samples[name].append(f"{name}{self.format_labels(sorted(labels.items()))} {value:g}")
+            except Exception as e:
+                print(f"⚠️ 指標收集錯誤: {str(e)}")
+        
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text = self.metadata.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+metrics.describe('ocr_stage_duration_seconds', 'histogram', 'Latency of OCR pipeline stages by route')
+metrics.describe('ocr_stage_errors_total', 'counter', 'Exceptions raised by OCR pipeline stages')
+metrics.describe('bedrock_model_call_duration_seconds', 'histogram', 'Latency of Bedrock converse calls by model and route')
+metrics.describe('bedrock_model_errors_total', 'counter', 'Failed Bedrock converse calls by model, route and error code')
+metrics.describe('bedrock_model_throttles_total', 'counter', 'Throttled Bedrock converse calls by model and route')
+metrics.describe('bedrock_input_tokens_total', 'counter', 'Bedrock input tokens by model and route')
+metrics.describe('bedrock_output_tokens_total', 'counter', 'Bedrock output tokens by model and route')
+metrics.describe('aws_request_duration_seconds', 'histogram', 'Latency of AWS SDK calls by service and operation')
+metrics.describe('aws_request_errors_total', 'counter', 'Failed AWS SDK calls by service, operation and error code')
+metrics.describe('aws_request_throttles_total', 'counter', 'Throttled AWS SDK calls by service and operation')
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+metrics_local = threading.local()
 
-def convert_floats_to_decimal(obj):
-    """遞歸轉換所有 float 為 Decimal，用於 DynamoDB 存儲"""
-    if isinstance(obj, float):
-        return Decimal(str(obj))
-    elif isinstance(obj, dict):
-        return {key: convert_floats_to_decimal(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_floats_to_decimal(item) for item in obj]
-    else:
-        return obj
+def current_metrics_route():
+    """目前的路由標籤：背景執行緒使用 metrics_local.route，請求中使用 Flask endpoint"""
+    route = getattr(metrics_local, 'route', None)
+    if route:
+        return route
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
 
-def save_image_metadata_to_dynamodb(filename, s3_key, file_size, content_type, session_id=None):
-    """保存圖片元數據到現有的 DynamoDB 表格"""
+def run_with_metrics_route(route, func, *args, **kwargs):
+    """在其他執行緒中以指定的路由標籤執行 func"""
+    previous = getattr(metrics_local, 'route', None)
+    metrics_local.route = route
     try:
-        record_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-        
-        # 使用現有表格，添加 record_type 來區分數據類型
-        item = {
-            'id': record_id,
-            'record_type': 'image_metadata',  # 區分圖片元數據和OCR結果
-            'timestamp': timestamp,
-            'filename': filename,
-            's3_key': s3_key,
-            'file_size': file_size,
-            'content_type': content_type,
-            'processing_status': 'uploaded',  # uploaded, processing, completed, failed
-            'created_at': timestamp,
-            'updated_at': timestamp
-        }
-        
-        if session_id:
-            item['session_id'] = session_id
-        
-        response = dynamodb_table.put_item(Item=item)
-        
-        return {
-            'success': True,
-            'image_id': record_id,
-            'timestamp': timestamp
-        }
-        
-    except Exception as e:
-        print(f"❌ 圖片元數據存儲錯誤: {str(e)}")
-        return {
-            'success': False,
-            'error': str(e)
-        }
+        return func(*args, **kwargs)
+    finally:
+        metrics_local.route = previous
 
-def update_image_processing_status(image_id, status, ocr_result_id=None):
-    """更新圖片處理狀態"""
+@contextlib.contextmanager
+def stage_timer(stage):
+    """記錄一個處理階段的延遲"""
+    labels = {'route': current_metrics_route(), 'stage': stage}
+    started = time.perf_counter()
     try:
-        update_expression = "SET processing_status = :status, updated_at = :updated_at"
-        expression_values = {
-            ':status': status,
-            ':updated_at': datetime.now().isoformat()
+        yield
+    except Exception:
+        metrics.inc('ocr_stage_errors_total', labels)
+        raise
+    finally:
+        metrics.observe('ocr_stage_duration_seconds', time.perf_counter() - started, labels)
+
+def timed_stage(stage):
+    """以 stage_timer 包裝整個函數"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_aws_client(client):
+    """透過 botocore 事件記錄每個 AWS API 呼叫的延遲、錯誤與節流次數"""
+    def before_call(model, context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+        context['metrics_labels'] = {'service': model.service_model.service_name, 'operation': model.name}
+    
+    def after_call(parsed, context, **kwargs):
+        if 'metrics_started' not in context:
+            return
+        labels = context['metrics_labels']
+        metrics.observe('aws_request_duration_seconds', time.perf_counter() - context['metrics_started'], labels)
+        error_code = (parsed or {}).get('Error', {}).get('Code')
+        if error_code:
+            metrics.inc('aws_request_errors_total', {**labels, 'code': error_code})
+            if error_code in THROTTLING_ERROR_CODES:
+                metrics.inc('aws_request_throttles_total', labels)
+    
+    def after_call_error(exception, context, **kwargs):
+        if 'metrics_started' not in context:
+            return
+        labels = context['metrics_labels']
+        metrics.observe('aws_request_duration_seconds', time.perf_counter() - context['metrics_started'], labels)
+        metrics.inc('aws_request_errors_total', {**labels, 'code': type(exception).__name__})
+    
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+    return client
+
+for instrumented_client in (s3_client, bedrock_client, dynamodb.meta.client):
+    instrument_aws_client(instrumented_client)
+
+# 處理進度事件
+# 行程內的發布/訂閱：主題為 image:<id> 或 batch:<id>，每個 SSE 連線是一個訂閱者，
+# 發布時只把事件放進各訂閱者的有界佇列，不會等待任何連線
+class ProgressEventBus:
+    """行程內的進度事件發布/訂閱，每個主題保留最近的事件供晚加入的訂閱者補發"""
+    
+    def __init__(self, replay_size, topic_ttl_seconds, subscriber_queue_size):
+        self.replay_size = replay_size
+        self.topic_ttl_seconds = topic_ttl_seconds
+        self.subscriber_queue_size = subscriber_queue_size
+        self._topics = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.stats = {'published': 0, 'delivered': 0, 'dropped': 0}
+    
+    def _topic(self, topic):
+        entry = self._topics.get(topic)
+        if entry is None:
+            entry = {'events': deque(maxlen=self.replay_size), 'subscribers': set(), 'last_publish': time.monotonic()}
+            self._topics[topic] = entry
+        return entry
+    
+    def _sweep(self, now):
+        """清除沒有訂閱者且已過期的主題（呼叫時需持有鎖）"""
+        if now - self._last_sweep < min(60, self.topic_ttl_seconds):
+            return
+        self._last_sweep = now
+        for topic, entry in list(self._topics.items()):
+            if not entry['subscribers'] and now - entry['last_publish'] > self.topic_ttl_seconds:
+                del self._topics[topic]
+    
+    def publish(self, topic, event, data, terminal=False):
+        """發布事件；terminal 表示該主題的處理已結束，SSE 串流收到後會關閉"""
+        now = time.monotonic()
+        with self._lock:
+            record = {
+                'id': next(self._ids),
+                'topic': topic,
+                'event': event,
+                'data': data,
+                'terminal': terminal,
+                'timestamp': datetime.now().isoformat()
+            }
+            entry = self._topic(topic)
+            entry['events'].append(record)
+            entry['last_publish'] = now
+            subscribers = list(entry['subscribers'])
+            self.stats['published'] += 1
+            self._sweep(now)
+        
+        delivered = 0
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(record)
+                delivered += 1
+            except queue.Full:
+                pass
+        with self._lock:
+            self.stats['delivered'] += delivered
+            self.stats['dropped'] += len(subscribers) - delivered
+        return record
+    
+    def subscribe(self, topics, last_event_id=0):
+        """訂閱多個主題，回傳 (佇列, 需要補發的事件)；last_event_id 之前的事件不會補發"""
+        subscriber = queue.Queue(maxsize=self.subscriber_queue_size)
+        replay = []
+        with self._lock:
+            for topic in topics:
+                entry = self._topic(topic)
+                entry['subscribers'].add(subscriber)
+                replay.extend(record for record in entry['events'] if record['id'] > last_event_id)
+        replay.sort(key=lambda record: record['id'])
+        return subscriber, replay
+    
+    def events_since(self, topic, last_event_id=0):
+        """主題中 id 大於 last_event_id 的保留事件（供輪詢使用）"""
+        with self._lock:
+            entry = self._topics.get(topic)
+            return [record for record in entry['events'] if record['id'] > last_event_id] if entry else []
+    
+    def unsubscribe(self, topics, subscriber):
+        with self._lock:
+            for topic in topics:
+                entry = self._topics.get(topic)
+                if entry:
+                    entry['subscribers'].discard(subscriber)
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'subscribers': sum(len(entry['subscribers']) for entry in self._topics.values()),
+                **self.stats
+            }
+
+progress_events = ProgressEventBus(SSE_REPLAY_EVENTS, SSE_TOPIC_TTL_SECONDS, SSE_SUBSCRIBER_QUEUE_SIZE)
+progress_local = threading.local()
+
+def image_topic(image_id):
+    return f"image:{image_id}"
+
+def batch_topic(batch_id):
+    return f"batch:{batch_id}"
+
+def current_progress_scope():
+    """目前執行緒的進度範圍 {'topics': [...], 'progressive': bool}，不在任何範圍內時為 None"""
+    return getattr(progress_local, 'scope', None)
+
+def current_progress_topics():
+    """目前執行緒正在處理的圖片（與所屬批次）的事件主題"""
+    scope = current_progress_scope()
+    return scope['topics'] if scope else []
+
+@contextlib.contextmanager
+def progress_scope(image_id, batch_id=None, progressive=False):
+    """
+    在此範圍內發布的階段事件會送到該圖片（與批次）的主題；已在同一圖片的範圍內時沿用外層設定
+    progressive=True 時，模型結果會以 provisional_result / field_updates 逐步發布
+    """
+    previous = current_progress_scope()
+    if not previous or image_topic(image_id) not in previous['topics']:
+        progress_local.scope = {
+            'topics': [image_topic(image_id)] + ([batch_topic(batch_id)] if batch_id else []),
+            'progressive': progressive
         }
-        
-        if ocr_result_id:
-            update_expression += ", ocr_result_id = :ocr_result_id"
-            expression_values[':ocr_result_id'] = ocr_result_id
-        
-        response = dynamodb_table.update_item(
-            Key={'id': image_id},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_values
-        )
-        
-        return {'success': True}
-        
-    except Exception as e:
-        print(f"❌ 更新圖片狀態錯誤: {str(e)}")
-        return {'success': False, 'error': str(e)}
+    try:
+        yield
+    finally:
+        progress_local.scope = previous
 
-def get_uploaded_images(limit=50):
-    """獲取已上傳的圖片列表"""
+def run_with_progress_scope(scope, func, *args, **kwargs):
+    """在其他執行緒中沿用呼叫端的進度範圍執行 func"""
+    previous = current_progress_scope()
+    progress_local.scope = scope
     try:
-        # 使用 scan 操作查找所有圖片元數據記錄
-        response = dynamodb_table.scan(
-            FilterExpression='record_type = :record_type',
-            ExpressionAttributeValues={':record_type': 'image_metadata'},
-            Limit=limit
-        )
-        
-        images = []
-        for item in response.get('Items', []):
-            # 生成預簽名URL用於圖片預覽
-            try:
-                presigned_url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': S3_BUCKET, 'Key': item['s3_key']},
-                    ExpiresIn=3600  # 1小時有效期
-                )
-            except:
-                presigned_url = None
-            
-            images.append({
-                'id': item['id'],
-                'filename': item['filename'],
-                's3_key': item['s3_key'],
-                'file_size': item['file_size'],
-                'content_type': item['content_type'],
-                'processing_status': item['processing_status'],
-                'created_at': item['created_at'],
-                'updated_at': item['updated_at'],
-                'session_id': item.get('session_id'),
-                'ocr_result_id': item.get('ocr_result_id'),
-                'presigned_url': presigned_url
-            })
-        
-        # 按創建時間排序（最新的在前）
-        images.sort(key=lambda x: x['created_at'], reverse=True)
-        
+        return func(*args, **kwargs)
+    finally:
+        progress_local.scope = previous
+
+def progress_scoped(func):
+    """以第一個參數 image_id 建立 progress_scope 執行整個函數"""
+    @functools.wraps(func)
+    def wrapper(image_id, *args, **kwargs):
+        with progress_scope(image_id):
+            return func(image_id, *args, **kwargs)
+    return wrapper
+
+def publish_progress(event, data, topics=None):
+    """發布處理階段事件到目前範圍的主題（不在任何範圍內時不做事）"""
+    for topic in topics if topics is not None else current_progress_topics():
+        progress_events.publish(topic, event, data)
+
+class ProgressiveVote:
+    """
+    漸進式投票：模型依完成順序加入，第一個成功的模型立即以 provisional_result 發布，
+    之後每個模型加入時只發布勝出值或信心度有變化的欄位 (field_updates)；
+    信心度以已送出的模型數為分母，尚未回應的模型不算同意，因此只會隨著模型加入而上升或被推翻
+    """
+    
+    def __init__(self, topics, page_number=None):
+        self.topics = topics
+        self.page_number = page_number
+        self.expected_models = 0
+        self.received_models = 0
+        self.tally = VoteTally()
+        self.published = {}
+        self.finalized = False
+        self._lock = threading.Lock()
+    
+    def expect(self, count):
+        with self._lock:
+            self.expected_models += count
+    
+    def _event_data(self, **data):
         return {
-            'success': True,
-            'images': images,
-            'count': len(images)
+            **data,
+            'page_number': self.page_number,
+            'models_received': self.received_models,
+            'models_expected': self.expected_models
         }
-        
-    except Exception as e:
-        print(f"❌ 獲取圖片列表錯誤: {str(e)}")
-        return {
-            'success': False,
-            'error': str(e),
-            'images': [],
-            'count': 0
-        }
-    """遞歸轉換所有 float 為 Decimal，用於 DynamoDB 存儲"""
-    if isinstance(obj, float):
-        return Decimal(str(obj))
-    elif isinstance(obj, dict):
-        return {key: convert_floats_to_decimal(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_floats_to_decimal(item) for item in obj]
-    else:
-        return obj
-
-def save_to_dynamodb(data, processing_mode, confidence_score=None, human_reviewed=False):
-    """Save OCR results to DynamoDB"""
-    try:
-        # Generate unique ID
-        record_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-        
-        # Convert confidence_score to Decimal if it's a float
-        if confidence_score is not None:
-            confidence_score = Decimal(str(confidence_score))
-        
-        # 設置默認值
-        data_with_defaults = set_default_values(data)
-        print(f"🔧 設置默認值完成: {json.dumps(data_with_defaults, indent=2, ensure_ascii=False)}")
-        
-        # 正規化動物醫院初診表數據
-        normalized_data = normalize_vet_form_data(data_with_defaults)
-        print(f"🐾 動物醫院初診表數據正規化完成: {json.dumps(normalized_data, indent=2, ensure_ascii=False)}")
-        
-        # Convert all float values in data to Decimal
-        converted_data = convert_floats_to_decimal(normalized_data)
-        
-        # Prepare DynamoDB item
-        item = {
-            'id': record_id,
-            'timestamp': timestamp,
-            'processing_mode': processing_mode,  # 'automatic' or 'human_review'
-            'human_reviewed': human_reviewed,
-            'data': converted_data,
-            'created_at': timestamp,
-            'updated_at': timestamp
-        }
-        
-        # Only add confidence_score if it's not None
-        if confidence_score is not None:
-            item['confidence_score'] = confidence_score
-        
-        # Save to DynamoDB
-        response = dynamodb_table.put_item(Item=item)
-        
-        return {
-            'success': True,
-            'record_id': record_id,
-            'timestamp': timestamp,
-            'dynamodb_response': response
-        }
-        
-    except Exception as e:
-        print(f"❌ DynamoDB 存儲錯誤: {str(e)}")
-        return {
-            'success': False,
-            'error': str(e)
-        }
-
-def process_with_claude_latest(image_data, for_human_review=False):
-    """Process with Claude Sonnet 4 for final validation or human review"""
-    try:
-        if for_human_review:
-            prompt = """
-            請分析這份動物醫院初診表並提取所有資訊，以結構化的 JSON 格式返回。
-            這個結果將提供給人工審核，請確保提取的資訊準確且完整。
+    
+    def _changed_fields(self, fields):
+        """fields: {欄位: (勝出值, 信心度, 票數)}，回傳與上次發布不同的欄位並記錄"""
+        updates = []
+        for field_path, (value, confidence, votes) in fields.items():
+            if self.published.get(field_path) == (value, confidence):
+                continue
+            self.published[field_path] = (value, confidence)
+            updates.append({
+                'field': field_path,
+                'value': decode_vote_value(value),
+                'confidence': confidence,
+                'votes': votes
+            })
+        return updates
+    
+    def add(self, result):
+        """加入一個模型結果（於模型執行緒的完成回呼中呼叫）"""
+        with self._lock:
+            if self.finalized:
+                return  # 逾時後才完成的呼叫不影響已發布的最終結果
+            self.received_models += 1
+            data = result.get('extracted_data') if result.get('success') else None
+            if not data:
+                return
+            first = not len(self.tally)
+            self.tally.add(data, result['model'], result['run_number'])
             
-            請返回以下格式的 JSON（只返回 JSON，不要其他格式）：
-            {
-                "basic_info": {
-                    "chart_number": "",
-                    "first_visit_date": ""
-                },
-                "pet_info": {
-                    "pet_name": "",
-                    "species": "",
-                    "breed": "",
-                    "pet_gender": "",
-                    "desexed": "",
-                    "color": "",
-                    "pet_age": "",
-                    "pet_birth_date": ""
-                },
-                "medical_history": {
-                    "past_medical_history": ""
-                },
-                "owner_info": {
-                    "owner_id": "",
-                    "owner_name": "",
-                    "owner_birth_date": "",
-                    "phone": "",
-                    "line_id": "",
-                    "email": "",
-                    "registered_address": "",
-                    "mailing_address": ""
-                },
-                "preventive_care": {
-                    "monthly_preventive_treatment": "",
-                    "monthly_preventive_yes": "",
-                    "monthly_preventive_no": "",
-                    "major_illness_surgery": "",
-                    "vaccine_types": "",
-                    "vaccine_rabies": "",
-                    "vaccine_3in1": "",
-                    "vaccine_4in1": "",
-                    "vaccine_5in1": "",
-                    "vaccine_others": "",
-                    "vaccine_others_detail": ""
-                },
-                "visit_info": {
-                    "visit_purpose": "",
-                    "remarks": ""
-                }
+            denominator = max(self.expected_models, 1)
+            fields = {
+                field_path: (winner, round(count / denominator, 4), count)
+                for field_path, winner, count, _ in self.tally.winners()
             }
+            updates = self._changed_fields(fields)
             
-            特別注意：
-            1. 寵物年齡請填入pet_age欄位（如：2歲3個月），寵物出生日期請填入pet_birth_date欄位
-            2. 預防醫療資料中的勾選框請仔細識別：
-               - 每月定期施打預防針：如果勾選"是"填入monthly_preventive_yes，如果勾選"否"填入monthly_preventive_no
-               - 疫苗類型：勾選的疫苗類型請在對應欄位填入"已施打"
-               - 如果勾選"其他疫苗"，請在vaccine_others_detail中填入具體內容（如：兔用疫苗）
-            3. 重大病史及手術：如果顯示"無"請填入"無"，如果有具體內容請詳細填入
-            4. 病史資料只需要填入過去病史欄位即可
-            
-            請仔細提取所有可見的文字並適當地組織到相應的欄位中。
-            如果某個欄位沒有資訊，請留空字串。
-            只返回 JSON，不要 markdown 格式。
-            """
-        else:
-            prompt = get_medical_extraction_prompt()
+            if first:
+                publish_progress('provisional_result', self._event_data(
+                    model=result['model'],
+                    run_number=result['run_number'],
+                    extracted_data=data.to_nested() if isinstance(data, VetFormRecord) else data,
+                    field_confidence={update['field']: update['confidence'] for update in updates}
+                ), topics=self.topics)
+            elif updates:
+                publish_progress('field_updates', self._event_data(
+                    model=result['model'],
+                    run_number=result['run_number'],
+                    updates=updates,
+                    final=False
+                ), topics=self.topics)
+    
+    def finalize(self, voting_result):
+        """投票（與低信心度重新提取）完成後，以最終的 vote_details 發布剩餘的變化"""
+        with self._lock:
+            updates = self._changed_fields({
+                field_path: (detail['winner'], round(detail['confidence'], 4), detail['votes'].get(detail['winner'], 0))
+                for field_path, detail in voting_result.get('vote_details', {}).items()
+            })
+            self.finalized = True
+            publish_progress('field_updates', self._event_data(updates=updates, final=True), topics=self.topics)
 
-        # Call Claude Sonnet 4
-        response = bedrock_client.converse(
-            modelId=CLAUDE_SONNET_LATEST_MODEL_ID,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"text": prompt},
-                    {"image": {"format": "png", "source": {"bytes": image_data}}}
-                ]
-            }],
-            inferenceConfig={"maxTokens": 2000, "temperature": 0.1}
-        )
+def decode_vote_value(value):
+    """投票時陣列欄位以 JSON 字串比較，發布時還原"""
+    if value.startswith('[') and value.endswith(']'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
 
-        response_text = response['output']['message']['content'][0]['text']
-        extracted_data = parse_json_response(response_text)
-        
-        return {
-            "success": True,
-            "model": "claude-sonnet-4",
-            "extracted_data": extracted_data,
-            "raw_response": response_text
-        }
+@contextlib.contextmanager
+def progressive_vote(page_number=None):
+    """進度範圍為 progressive 時，讓此執行緒中的 run_model_tasks 逐步發布投票結果；否則產生 None"""
+    scope = current_progress_scope()
+    if not scope or not scope['progressive']:
+        yield None
+        return
+    previous = getattr(progress_local, 'vote', None)
+    progress_local.vote = ProgressiveVote(scope['topics'][:1], page_number)
+    try:
+        yield progress_local.vote
+    finally:
+        progress_local.vote = previous
 
-    except Exception as e:
-        return {
-            "success": False,
-            "model": "claude-sonnet-4",
-            "error": str(e)
-        }
+# 所有請求共用的模型呼叫執行緒池，限制同時對 Bedrock 發出的請求數
+model_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MODEL_FANOUT_MAX_WORKERS,
+    thread_name_prefix='model-call'
+)
 
-def run_enhanced_voting_system(image_data):
-    """Enhanced voting system with Claude Sonnet 4 for automatic path"""
-    print("🗳️ 開始增強型多模型投票處理...")
+# Quorum 投票累計統計（用於觀察 Bedrock 呼叫節省量）
+quorum_stats = {
+    'requests': 0,
+    'quorum_reached': 0,
+    'tie_breaker_calls': 0,
+    'partial_tie_breaker_calls': 0,
+    'calls_saved': 0
+}
+quorum_stats_lock = threading.Lock()
+
+# 萃取結果快取
+# 鍵 = SHA-256(圖片) + SHA-256(提示詞) + 模型 ID + 推論參數，值為 converse 回應的 output/usage
+class MemoryExtractionCache:
+    """行程內 LRU 快取"""
+    name = 'memory'
     
-    # 準備所有任務 - 包含 Claude Sonnet 4
-    tasks = [
-        # Claude Sonnet 4 跑一次
-        (CLAUDE_SONNET_MODEL_ID, 1),
-        # Claude 3 Haiku 跑一次  
-        (CLAUDE_HAIKU_MODEL_ID, 1),
-        # Claude Sonnet 4 跑一次
-        (CLAUDE_SONNET_LATEST_MODEL_ID, 1)
-    ]
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
     
-    results = []
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
     
-    # 依序執行每個任務
-    for model_id, run_number in tasks:
-        print(f"🤖 執行 {model_id} - 第 {run_number} 次...")
+    def set(self, key, value):
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+class DiskExtractionCache:
+    """本機磁碟快取，同一台主機上的多個 gunicorn worker 共用"""
+    name = 'disk'
+    prune_every = 50
+    
+    def __init__(self, directory, max_entries, ttl_seconds):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.sets_since_prune = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+    
+    def get(self, key):
+        path = self._path(key)
         try:
-            result = process_with_claude_model(image_data, model_id, run_number)
-            results.append(result)
-            if result.get('success'):
-                print(f"✅ {model_id} 處理成功")
-            else:
-                print(f"❌ {model_id} 處理失敗: {result.get('error', 'Unknown error')}")
-        except Exception as e:
-            print(f"❌ {model_id} 執行異常: {str(e)}")
-            results.append({
-                "success": False,
-                "model": model_id,
-                "run_number": run_number,
-                "error": str(e)
-            })
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry['expires_at'] < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        os.utime(path)  # 以 mtime 作為 LRU 順序
+        return entry['value']
     
-    # 分析結果並投票
-    print("📊 開始分析和投票...")
-    voting_result = analyze_and_vote(results)
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'expires_at': time.time() + self.ttl_seconds, 'value': value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)  # 原子寫入，其他 worker 不會讀到一半的檔案
+        
+        with self.lock:
+            self.sets_since_prune += 1
+            if self.sets_since_prune < self.prune_every:
+                return 0
+            self.sets_since_prune = 0
+        return self.prune()
     
-    # 生成摘要
-    summary = generate_summary(results, voting_result)
+    def prune(self):
+        """刪除過期項目，並依 mtime 淘汰最舊的項目直到數量低於上限"""
+        entries = []
+        now = time.time()
+        evicted = 0
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    mtime = os.path.getmtime(path)
+                    if mtime + self.ttl_seconds < now:
+                        os.remove(path)
+                        evicted += 1
+                    else:
+                        entries.append((mtime, path))
+                except OSError:
+                    continue
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+                evicted += 1
+            except OSError:
+                pass
+        return evicted
+
+class S3ExtractionCache:
+    """S3 快取，所有任務共用；容量上限請以 S3 lifecycle rule 設定"""
+    name = 's3'
     
-    return {
-        "individual_results": results,
-        "voting_result": voting_result,
-        "summary": summary
-    }
+    def __init__(self, bucket, prefix, ttl_seconds):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+    
+    def get(self, key):
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        entry = json.loads(response['Body'].read().decode('utf-8'))
+        if entry['expires_at'] < time.time():
+            return None
+        return entry['value']
+    
+    def set(self, key, value):
+        s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{key}.json",
+            Body=json.dumps({'expires_at': time.time() + self.ttl_seconds, 'value': value}, ensure_ascii=False),
+            ContentType='application/json'
+        )
+        return 0
 
-def get_medical_extraction_prompt():
-    """根據動物醫院初診表格結構的醫療文件提取提示詞"""
-    return """
-    請分析這份動物醫院初診表並提取所有資訊，以結構化的 JSON 格式返回。
-
-    請返回以下格式的 JSON（只返回 JSON，不要其他格式）：
-    {
-        "basic_info": {
-            "chart_number": "",
-            "first_visit_date": ""
-        },
-        "pet_info": {
-            "pet_name": "",
-            "species": "",
-            "breed": "",
-            "pet_gender": "",
-            "desexed": "",
-            "color": "",
-            "pet_age": "",
-            "pet_birth_date": ""
-        },
-        "medical_history": {
-            "past_medical_history": ""
-        },
-        "owner_info": {
-            "owner_id": "",
-            "owner_name": "",
-            "owner_birth_date": "",
-            "phone": "",
-            "line_id": "",
-            "email": "",
-            "registered_address": "",
-            "mailing_address": ""
-        },
-        "preventive_care": {
-            "monthly_preventive_treatment": "",
-            "monthly_preventive_yes": "",
-            "monthly_preventive_no": "",
-            "major_illness_surgery": "",
-            "vaccine_types": "",
-            "vaccine_rabies": "",
-            "vaccine_3in1": "",
-            "vaccine_4in1": "",
-            "vaccine_5in1": "",
-            "vaccine_others": "",
-            "vaccine_others_detail": ""
-        },
-        "visit_info": {
-            "visit_purpose": "",
-            "remarks": ""
-        }
+def create_extraction_cache():
+    """根據 EXTRACTION_CACHE_BACKEND 建立快取後端"""
+    if EXTRACTION_CACHE_BACKEND == 'memory':
+        return MemoryExtractionCache(EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_CACHE_TTL_SECONDS)
+    if EXTRACTION_CACHE_BACKEND == 'disk':
+        return DiskExtractionCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_CACHE_TTL_SECONDS)
+    if EXTRACTION_CACHE_BACKEND == 's3':
+        return S3ExtractionCache(S3_BUCKET, EXTRACTION_CACHE_S3_PREFIX, EXTRACTION_CACHE_TTL_SECONDS)
+    return None
+
+extraction_cache = create_extraction_cache()
+extraction_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+extraction_cache_stats_lock = threading.Lock()
+
+# 模型輸出解析結果統計（mode = tool / text / refinement，outcome = tool_use / json / fenced_json / embedded_json / failed）
+extraction_parse_stats = Counter()
+extraction_parse_stats_lock = threading.Lock()
+
+def record_extraction_cache_stat(name, count=1):
+    with extraction_cache_stats_lock:
+        extraction_cache_stats[name] += count
+
+def build_extraction_cache_key(image_data, prompt, model_id, inference_config, variant=None, tool_config=None):
+    """以圖片內容、提示詞、模型、推論參數與工具 schema 組成快取鍵"""
+    image_hash = hashlib.sha256(image_data).hexdigest()
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    key = {
+        'image': image_hash,
+        'prompt': prompt_hash,
+        'model': model_id,
+        'inference_config': inference_config,
+        'variant': variant
     }
+    if tool_config is not None:
+        key['tool'] = hashlib.sha256(json.dumps(tool_config, sort_keys=True).encode('utf-8')).hexdigest()
+    key_material = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+class SchedulerTimeoutError(Exception):
+    """在 BEDROCK_SCHEDULER_MAX_WAIT_SECONDS 內未取得模型呼叫配額"""
+
+class TokenBucket:
+    """以每分鐘配額為容量、連續補充的 token bucket"""
+    
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount):
+        """取得 amount 個 token 還需要等待的秒數"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+    
+    def adjust(self, amount):
+        """以實際用量修正預扣數量（amount 為實際減去預估，可為負）"""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class ModelLane:
+    """單一模型的配額、並行上限與等待佇列"""
+    
+    def __init__(self, model_id, quota):
+        self.model_id = model_id
+        self.requests = TokenBucket(quota['rpm'])
+        self.tokens = TokenBucket(quota['tpm'])
+        self.max_concurrency = quota['max_concurrency']
+        self.concurrency_limit = float(quota['max_concurrency'])
+        self.in_flight = 0
+        self.waiters = []  # heap: (priority, sequence)
+        self.throttles = 0
+        self.last_decrease = 0.0
+
+class BedrockScheduler:
+    """
+    所有 Bedrock 模型呼叫的全域排程器：
+    - 每個模型有 RPM / TPM token bucket，呼叫前依預估 token 數預扣，完成後以實際用量修正
+    - 並行上限採 AIMD：成功時每輪加 1，遇到節流時減半
+    - 等待中的呼叫依優先權（數字越小越優先）與先後順序放行
+    """
+    
+    def __init__(self, quotas, default_quota, max_wait_seconds, decrease_cooldown_seconds=1.0):
+        self.quotas = quotas
+        self.default_quota = default_quota
+        self.max_wait_seconds = max_wait_seconds
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.condition = threading.Condition()
+        self.lanes = {}
+        self.sequence = itertools.count()
+    
+    def _lane(self, model_id):
+        lane = self.lanes.get(model_id)
+        if lane is None:
+            quota = dict(self.default_quota, **self.quotas.get(model_id, {}))
+            lane = self.lanes[model_id] = ModelLane(model_id, quota)
+        return lane
+    
+    def _admission_wait(self, lane, ticket, estimated_tokens, now):
+        """回傳 0 表示可以放行，否則回傳建議等待秒數（None 表示等待通知）"""
+        if lane.waiters[0] != ticket or lane.in_flight >= max(1, int(lane.concurrency_limit)):
+            return None
+        lane.requests.refill(now)
+        lane.tokens.refill(now)
+        return max(lane.requests.wait_time(1), lane.tokens.wait_time(estimated_tokens))
+    
+    def acquire(self, model_id, priority, estimated_tokens):
+        """阻塞直到可以呼叫 model_id，回傳排隊等待的秒數"""
+        started = time.monotonic()
+        deadline = started + self.max_wait_seconds
+        with self.condition:
+            lane = self._lane(model_id)
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(lane.waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._admission_wait(lane, ticket, estimated_tokens, now)
+                    if wait == 0:
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise SchedulerTimeoutError(
+                            f"{model_id} 排隊超過 {self.max_wait_seconds:.0f} 秒（並行上限 {int(lane.concurrency_limit)}）"
+                        )
+                    self.condition.wait(min(wait if wait is not None else 1.0, remaining))
+                heapq.heappop(lane.waiters)
+                lane.requests.take(1)
+                lane.tokens.take(estimated_tokens)
+                lane.in_flight += 1
+            except SchedulerTimeoutError:
+                lane.waiters.remove(ticket)
+                heapq.heapify(lane.waiters)
+                raise
+            finally:
+                self.condition.notify_all()
+        return time.monotonic() - started
+    
+    def release(self, model_id, outcome, estimated_tokens, actual_tokens=None):
+        """呼叫結束：outcome 為 success / throttled / error"""
+        with self.condition:
+            lane = self._lane(model_id)
+            lane.in_flight -= 1
+            if actual_tokens is not None:
+                lane.tokens.adjust(actual_tokens - estimated_tokens)
+            if outcome == 'throttled':
+                lane.throttles += 1
+                now = time.monotonic()
+                # 同一波並行請求同時被節流時只減半一次
+                if now - lane.last_decrease >= self.decrease_cooldown_seconds:
+                    lane.concurrency_limit = max(1.0, lane.concurrency_limit / 2)
+                    lane.last_decrease = now
+            elif outcome == 'success':
+                lane.concurrency_limit = min(
+                    float(lane.max_concurrency), lane.concurrency_limit + 1.0 / lane.concurrency_limit
+                )
+            self.condition.notify_all()
+    
+    def snapshot(self):
+        with self.condition:
+            return {
+                model_id: {
+                    'concurrency_limit': round(lane.concurrency_limit, 2),
+                    'max_concurrency': lane.max_concurrency,
+                    'in_flight': lane.in_flight,
+                    'waiting': len(lane.waiters),
+                    'throttles': lane.throttles,
+                    'request_tokens_available': round(lane.requests.tokens, 1),
+                    'tpm_tokens_available': round(lane.tokens.tokens)
+                }
+                for model_id, lane in self.lanes.items()
+            }
+    
+    def gauges(self):
+        gauges = []
+        for model_id, lane in self.snapshot().items():
+            labels = {'model': model_id}
+            gauges.append(('bedrock_scheduler_concurrency_limit', labels, lane['concurrency_limit']))
+            gauges.append(('bedrock_scheduler_in_flight', labels, lane['in_flight']))
+            gauges.append(('bedrock_scheduler_waiting', labels, lane['waiting']))
+        return gauges
+
+bedrock_scheduler = BedrockScheduler(
+    BEDROCK_MODEL_QUOTAS,
+    {'rpm': BEDROCK_DEFAULT_RPM, 'tpm': BEDROCK_DEFAULT_TPM, 'max_concurrency': BEDROCK_DEFAULT_MAX_CONCURRENCY},
+    BEDROCK_SCHEDULER_MAX_WAIT_SECONDS
+)
+metrics.describe('bedrock_scheduler_queue_wait_seconds', 'histogram', 'Time Bedrock calls waited in the scheduler by model and priority')
+metrics.describe('bedrock_scheduler_timeouts_total', 'counter', 'Bedrock calls rejected after waiting too long in the scheduler')
+metrics.describe('bedrock_scheduler_concurrency_limit', 'gauge', 'Current AIMD concurrency limit per model')
+metrics.describe('bedrock_scheduler_in_flight', 'gauge', 'Bedrock calls in flight per model')
+metrics.describe('bedrock_scheduler_waiting', 'gauge', 'Bedrock calls waiting in the scheduler per model')
+metrics.register_gauges(bedrock_scheduler.gauges)
+
+class CircuitBreaker:
+    """
+    單一模型的斷路器（closed → open → half_open → closed）
+    - closed: 滑動視窗內錯誤率或慢呼叫比例超過門檻時開啟
+    - open: 拒絕呼叫，經過 open_seconds 後進入 half_open
+    - half_open: 只放行一次試探呼叫，成功則關閉，失敗或過慢則再次開啟
+    """
+    
+    def __init__(self, window_seconds, min_calls, error_rate_threshold, slow_call_seconds,
+                 slow_rate_threshold, open_seconds):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_seconds = open_seconds
+        self.events = deque()  # (timestamp, failed, slow)
+        self.state = 'closed'
+        self.opened_at = None
+        self.probe_started_at = None
+        self.times_opened = 0
+        self.lock = threading.Lock()
+    
+    def _trim(self, now):
+        while self.events and now - self.events[0][0] > self.window_seconds:
+            self.events.popleft()
+    
+    def _rates(self):
+        calls = len(self.events)
+        if not calls:
+            return 0.0, 0.0
+        return (sum(1 for _, failed, _ in self.events if failed) / calls,
+                sum(1 for _, _, slow in self.events if slow) / calls)
+    
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.probe_started_at = None
+        self.times_opened += 1
+    
+    def allow_request(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now - self.opened_at < self.open_seconds:
+                return False
+            # half_open: 一次只放行一個試探呼叫（試探結果若因快取命中未回報，逾時後可再試探）
+            if self.probe_started_at is not None and now - self.probe_started_at < self.open_seconds:
+                return False
+            self.state = 'half_open'
+            self.probe_started_at = now
+            return True
+    
+    def record(self, success, latency_seconds):
+        now = time.monotonic()
+        slow = latency_seconds >= self.slow_call_seconds
+        with self.lock:
+            if self.state == 'half_open':
+                if success and not slow:
+                    self.state = 'closed'
+                    self.events.clear()
+                    self.probe_started_at = None
+                else:
+                    self._open(now)
+                return
+            
+            self.events.append((now, not success, slow))
+            self._trim(now)
+            if self.state == 'closed' and len(self.events) >= self.min_calls:
+                error_rate, slow_rate = self._rates()
+                if error_rate >= self.error_rate_threshold or slow_rate >= self.slow_rate_threshold:
+                    self._open(now)
+    
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            error_rate, slow_rate = self._rates()
+            return {
+                'state': self.state,
+                'calls_in_window': len(self.events),
+                'error_rate': round(error_rate, 3),
+                'slow_rate': round(slow_rate, 3),
+                'times_opened': self.times_opened,
+                'open_for_seconds': round(now - self.opened_at, 1) if self.state != 'closed' else None
+            }
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+CIRCUIT_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+def get_circuit_breaker(model_id):
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(model_id)
+        if breaker is None:
+            breaker = circuit_breakers[model_id] = CircuitBreaker(
+                CIRCUIT_WINDOW_SECONDS, CIRCUIT_MIN_CALLS, CIRCUIT_ERROR_RATE_THRESHOLD,
+                CIRCUIT_SLOW_CALL_SECONDS, CIRCUIT_SLOW_RATE_THRESHOLD, CIRCUIT_OPEN_SECONDS
+            )
+        return breaker
+
+def get_circuit_breaker_states():
+    with circuit_breakers_lock:
+        breakers = dict(circuit_breakers)
+    return {model_id: breaker.snapshot() for model_id, breaker in breakers.items()}
 
-    請仔細提取所有可見的文字並適當地組織到相應的欄位中：
-
-    基本資料 Basic Information:
-    - chart_number: 病歷號碼
-    - first_visit_date: 初診日期
-
-    寵物資料 Pet Information:
-    - pet_name: 寵物名
-    - species: 物種（犬/貓/兔/其他）
-    - breed: 品種
-    - pet_gender: 性別（公/母）
-    - desexed: 絕育（是/否）
-    - color: 毛色
-    - pet_age: 寵物年齡
-    - pet_birth_date: 寵物出生日期
-
-    病史資料 Medical History:
-    - past_medical_history: 過去病史
-
-    飼主資料 Owner Information:
-    - owner_id: 身份證/護照號碼
-    - owner_name: 飼主姓名
-    - owner_birth_date: 出生日期
-    - phone: 電話
-    - line_id: Line ID
-    - email: E-mail
-    - registered_address: 戶籍地址
-    - mailing_address: 通訊地址
-
-    預防醫療資料 Preventive Care:
-    - monthly_preventive_treatment: 每月定期施打預防針 Monthly Preventive Treatment（整體描述）
-    - monthly_preventive_yes: 每月定期施打預防針-是（如果勾選"是"則填入"是"）
-    - monthly_preventive_no: 每月定期施打預防針-否（如果勾選"否"則填入"否"）
-    - major_illness_surgery: 重大病史及手術 Major Illness or Surgery
-    - vaccine_types: 曾施打疫苗類型 Types of Vaccines Given（整體描述）
-    - vaccine_rabies: 狂犬疫苗 Rabies（如果勾選則填入"已施打"）
-    - vaccine_3in1: 三合一疫苗 3-in-1（如果勾選則填入"已施打"）
-    - vaccine_4in1: 四合一疫苗 4-in-1（如果勾選則填入"已施打"）
-    - vaccine_5in1: 五合一疫苗 5-in-1（如果勾選則填入"已施打"）
-    - vaccine_others: 其他疫苗 Others（如果勾選則填入"已施打"）
-    - vaccine_others_detail: 其他疫苗的詳細內容（如：兔用疫苗）
-
-    就診資訊 Visit Information:
-    - visit_purpose: 初診目的
-    - remarks: 備註
-
-    特別注意：
-    1. 寵物年齡請填入pet_age欄位（如：2歲3個月），寵物出生日期請填入pet_birth_date欄位
-    2. 預防醫療資料中的勾選框請仔細識別，勾選的項目請標註為相應的值
-    3. 疫苗類型如果有勾選"其他"，請特別注意提取其詳細內容
-    4. 所有日期格式請保持一致（YYYY-MM-DD或原始格式）
-    5. 病史資料只需要填入過去病史欄位即可
-    
-
-    如果某個欄位沒有資訊，請留空字串。
-    只返回 JSON，不要 markdown 格式。"""
-
-def process_with_claude_model(image_data, model_id, run_number):
-    """使用指定的 Claude 模型處理醫療文件"""
+def route_ensemble_model(model_id):
+    """
+    回傳投票成員實際要呼叫的模型：斷路器開啟時改用 CIRCUIT_FALLBACK_MODELS 中可用的替代模型，
+    沒有可用替代時回傳 None（略過此成員）
+    """
+    if not CIRCUIT_BREAKER_ENABLED or get_circuit_breaker(model_id).allow_request():
+        return model_id
+    fallback = CIRCUIT_FALLBACK_MODELS.get(model_id)
+    if fallback and get_circuit_breaker(fallback).allow_request():
+        metrics.inc('ensemble_circuit_routing_total', {'model': model_id, 'action': 'substituted'})
+        return fallback
+    metrics.inc('ensemble_circuit_routing_total', {'model': model_id, 'action': 'skipped'})
+    return None
+
+metrics.describe('circuit_breaker_state', 'gauge', 'Per-model circuit breaker state (0 = closed, 1 = half open, 2 = open)')
+metrics.describe('ensemble_circuit_routing_total', 'counter', 'Ensemble members substituted or skipped because their circuit was open')
+metrics.register_gauges(lambda: [
+    ('circuit_breaker_state', {'model': model_id}, CIRCUIT_STATE_VALUES[state['state']])
+    for model_id, state in get_circuit_breaker_states().items()
+])
+
+def current_scheduling_priority():
+    """依路由決定排程優先權：互動式人工審核優先，背景重新處理最後"""
+    return SCHEDULER_ROUTE_PRIORITIES.get(current_metrics_route(), SCHEDULER_PRIORITY_DEFAULT)
+
+def estimate_call_tokens(prompt, inference_config, tool_config=None):
+    """預估一次呼叫會計入 TPM 的 token 數（中英混合約每 3 字元 1 token，加上圖片、工具 schema 與輸出上限）"""
+    tool_chars = len(json.dumps(tool_config, ensure_ascii=False)) if tool_config else 0
+    return (len(prompt) + tool_chars) // 3 + BEDROCK_IMAGE_TOKEN_ESTIMATE + inference_config.get('maxTokens', 0)
+
+def converse_with_image(model_id, prompt, image_data, inference_config, tool_config=None):
+    """實際送出 converse 請求，並記錄延遲、錯誤、節流與 token 用量"""
+    model_labels = {'model': model_id, 'route': current_metrics_route()}
+    extra_args = {'toolConfig': tool_config} if tool_config else {}
+    started = time.perf_counter()
     try:
-        prompt = get_medical_extraction_prompt()
-        
-        # Call Claude
         response = bedrock_client.converse(
             modelId=model_id,
             messages=[{
                 "role": "user",
                 "content": [
                     {"text": prompt},
-                    {"image": {"format": "png", "source": {"bytes": image_data}}}
+                    build_media_block(image_data)
                 ]
             }],
-            inferenceConfig={"maxTokens": 2000, "temperature": 0.5}
+            inferenceConfig=inference_config,
+            **extra_args
         )
+    except Exception as e:
+        error_code = e.response['Error']['Code'] if isinstance(e, ClientError) else type(e).__name__
+        metrics.inc('bedrock_model_errors_total', {**model_labels, 'code': error_code})
+        if error_code in THROTTLING_ERROR_CODES:
+            # 節流代表配額不足而不是模型異常，交由 bedrock_scheduler 處理
+            metrics.inc('bedrock_model_throttles_total', model_labels)
+        else:
+            get_circuit_breaker(model_id).record(False, time.perf_counter() - started)
+        raise
+    finally:
+        metrics.observe('bedrock_model_call_duration_seconds', time.perf_counter() - started, model_labels)
+    
+    hedge_policy.record_latency(model_id, time.perf_counter() - started)
+    get_circuit_breaker(model_id).record(True, time.perf_counter() - started)
+    usage = response.get('usage', {})
+    metrics.inc('bedrock_input_tokens_total', model_labels, usage.get('inputTokens', 0))
+    metrics.inc('bedrock_output_tokens_total', model_labels, usage.get('outputTokens', 0))
+    return response
 
-        response_text = response['output']['message']['content'][0]['text']
-        
-        # Parse JSON response
-        extracted_data = parse_json_response(response_text)
-        
-        return {
-            "success": True,
-            "model": model_id,
-            "run_number": run_number,
-            "extracted_data": extracted_data,
-            "raw_response": response_text
-        }
+def is_transient_bedrock_error(error):
+    """5xx 與連線中斷等暫時性錯誤（不含節流），boto3 standard 模式原本會重試這些錯誤"""
+    if isinstance(error, TRANSIENT_CONNECTION_ERRORS):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return error.response['Error']['Code'] in TRANSIENT_ERROR_CODES or status >= 500
+    return False
 
-    except Exception as e:
-        return {
-            "success": False,
-            "model": model_id,
-            "run_number": run_number,
-            "error": str(e)
-        }
+def scheduled_converse(model_id, prompt, image_data, inference_config, tool_config=None, on_admitted=None):
+    """
+    經由 bedrock_scheduler 排隊後呼叫模型；節流時降低並行數並重新排隊
+    bedrock_client 已關閉 boto3 內建重試，5xx 與連線錯誤在這裡重新排隊（不降低並行數）
+    on_admitted 在第一次取得排程許可（實際送出請求前）時呼叫，讓對沖計時不包含排隊時間
+    """
+    if not BEDROCK_SCHEDULER_ENABLED:
+        if on_admitted:
+            on_admitted()
+        return converse_with_image(model_id, prompt, image_data, inference_config, tool_config)
+    
+    priority = current_scheduling_priority()
+    estimated_tokens = estimate_call_tokens(prompt, inference_config, tool_config)
+    throttle_retries = 0
+    transient_retries = 0
+    admitted = False
+    while True:
+        try:
+            waited = bedrock_scheduler.acquire(model_id, priority, estimated_tokens)
+        except SchedulerTimeoutError:
+            metrics.inc('bedrock_scheduler_timeouts_total', {'model': model_id})
+            raise
+        metrics.observe('bedrock_scheduler_queue_wait_seconds', waited, {'model': model_id, 'priority': str(priority)})
+        if on_admitted and not admitted:
+            on_admitted()
+        admitted = True
+        
+        outcome = 'error'
+        actual_tokens = None
+        try:
+            response = converse_with_image(model_id, prompt, image_data, inference_config, tool_config)
+            usage = response.get('usage', {})
+            actual_tokens = usage.get('inputTokens', 0) + usage.get('outputTokens', 0) or None
+            outcome = 'success'
+            return response
+        except Exception as e:
+            if isinstance(e, ClientError) and e.response['Error']['Code'] in THROTTLING_ERROR_CODES:
+                outcome = 'throttled'
+                if throttle_retries == BEDROCK_THROTTLE_RETRIES:
+                    raise
+                throttle_retries += 1
+                print(f"⏳ {model_id} 被節流，第 {throttle_retries} 次重新排隊")
+                backoff_attempt = throttle_retries
+            elif is_transient_bedrock_error(e) and transient_retries < BEDROCK_TRANSIENT_RETRIES:
+                transient_retries += 1
+                print(f"🔁 {model_id} 暫時性錯誤 ({type(e).__name__})，第 {transient_retries} 次重試")
+                backoff_attempt = transient_retries
+            else:
+                raise
+            time.sleep(random.uniform(0, 0.5 * 2 ** (backoff_attempt - 1)))
+        finally:
+            bedrock_scheduler.release(model_id, outcome, estimated_tokens, actual_tokens)
 
-def parse_json_response(response_text):
-    """解析 JSON 回應"""
+class HedgePolicy:
+    """
+    追蹤每個模型近期成功呼叫的延遲，決定何時送出對沖請求，
+    並以滑動一分鐘視窗限制對沖次數
+    """
+    
+    def __init__(self, percentile, window, min_samples, min_delay_seconds, max_per_minute):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay_seconds = min_delay_seconds
+        self.max_per_minute = max_per_minute
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.recent_hedges = deque()
+        self.lock = threading.Lock()
+    
+    def record_latency(self, model_id, seconds):
+        with self.lock:
+            self.latencies[model_id].append(seconds)
+    
+    def hedge_delay(self, model_id):
+        """回傳送出對沖前應等待的秒數；樣本不足時回傳 None（不對沖）"""
+        with self.lock:
+            samples = sorted(self.latencies[model_id])
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * self.percentile))
+        return max(self.min_delay_seconds, samples[index])
+    
+    def try_acquire_hedge(self):
+        """在每分鐘上限內登記一次對沖，超過上限回傳 False"""
+        now = time.monotonic()
+        with self.lock:
+            while self.recent_hedges and now - self.recent_hedges[0] > 60:
+                self.recent_hedges.popleft()
+            if len(self.recent_hedges) >= self.max_per_minute:
+                return False
+            self.recent_hedges.append(now)
+            return True
+
+hedge_policy = HedgePolicy(
+    HEDGE_LATENCY_PERCENTILE, HEDGE_LATENCY_WINDOW, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY_SECONDS, HEDGE_MAX_PER_MINUTE
+)
+# 對沖使用獨立的執行緒池，避免與 model_executor 互相等待
+hedge_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MODEL_FANOUT_MAX_WORKERS * 2,
+    thread_name_prefix='model-hedge'
+)
+metrics.describe('bedrock_hedges_total', 'counter', 'Hedged Bedrock requests by model and outcome (issued, won, lost, capped)')
+
+def hedged_converse(model_id, prompt, image_data, inference_config, tool_config=None):
+    """
+    超過模型近期延遲百分位數仍未回應時，對 HEDGE_ALTERNATE_MODELS（或同一模型）送出重複請求，
+    取先成功的結果；較慢的請求若尚未開始則取消，否則忽略其結果
+    回應中的 answered_model 為實際回答的模型（對沖到替代模型時與 model_id 不同）
+    """
+    delay = hedge_policy.hedge_delay(model_id) if HEDGING_ENABLED else None
+    if delay is None:
+        return dict(scheduled_converse(model_id, prompt, image_data, inference_config, tool_config), answered_model=model_id)
+    
+    route = current_metrics_route()
+    admitted = threading.Event()
+    primary = hedge_executor.submit(
+        run_with_metrics_route, route, scheduled_converse, model_id, prompt, image_data, inference_config, tool_config,
+        admitted.set
+    )
+    # hedge_delay 來自純 converse 延遲，所以從取得排程許可才開始計時；排隊中逾時或失敗時也會結束等待
+    primary.add_done_callback(lambda _: admitted.set())
+    admitted.wait()
     try:
-        # 直接解析 JSON
-        return json.loads(response_text)
-    except json.JSONDecodeError:
+        return dict(primary.result(timeout=delay), answered_model=model_id)
+    except concurrent.futures.TimeoutError:
+        pass
+    
+    hedge_model_id = HEDGE_ALTERNATE_MODELS.get(model_id, model_id)
+    labels = {'model': model_id}
+    if not hedge_policy.try_acquire_hedge():
+        metrics.inc('bedrock_hedges_total', {**labels, 'outcome': 'capped'})
+        return dict(primary.result(), answered_model=model_id)
+    
+    print(f"🪃 {model_id} 超過 {delay:.1f}s 未回應，對沖送出 {hedge_model_id}")
+    metrics.inc('bedrock_hedges_total', {**labels, 'outcome': 'issued'})
+    hedge = hedge_executor.submit(
+        run_with_metrics_route, route, scheduled_converse, hedge_model_id, prompt, image_data, inference_config, tool_config
+    )
+    
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                first_error = first_error or future.exception()
+                continue
+            for loser in pending:
+                loser.cancel()
+            metrics.inc('bedrock_hedges_total', {**labels, 'outcome': 'won' if future is hedge else 'lost'})
+            return dict(future.result(), answered_model=hedge_model_id if future is hedge else model_id)
+    raise first_error
+
+def invoke_model(model_id, prompt, image_data, inference_config, cache_variant=None, tool_config=None):
+    """
+    呼叫 Bedrock converse，先查詢萃取結果快取
+    cache_variant 用於區分同一模型的多次取樣（例如 run_number）
+    tool_config 為結構化輸出的 toolConfig（見 get_extraction_tool_config）
+    回應中的 model 為實際回答的模型
+    """
+    cache_key = None
+    if extraction_cache is not None:
+        cache_key = build_extraction_cache_key(image_data, prompt, model_id, inference_config, cache_variant, tool_config)
         try:
-            # 處理 markdown 包裝的 JSON
-            json_match = re.search(r'```(?:json)?\s*\n?(.*?)\n?```', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1).strip()
-                return json.loads(json_str)
-            else:
-                # 嘗試找到 JSON 內容
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(0)
-                    return json.loads(json_str)
-                else:
-                    return {"raw_text": response_text, "parsing_error": "無法提取 JSON"}
-        except json.JSONDecodeError:
+            cached = extraction_cache.get(cache_key)
+        except Exception as e:
+            print(f"⚠️ 快取讀取錯誤: {str(e)}")
+            record_extraction_cache_stat('errors')
+            cached = None
+        if cached is not None:
+            record_extraction_cache_stat('hits')
+            print(f"⚡ 快取命中: {model_id}")
+            return dict(cached, cached=True, model=model_id)
+        record_extraction_cache_stat('misses')
+    
+    response = hedged_converse(model_id, prompt, image_data, inference_config, tool_config)
+    answered_model = response['answered_model']
+    payload = {
+        'output': response['output'],
+        'stopReason': response.get('stopReason'),
+        'usage': response.get('usage', {}),
+        'model': answered_model
+    }
+    
+    # 對沖到替代模型時不寫入快取，避免以主模型的鍵保存另一個模型的輸出
+    if cache_key is not None and answered_model == model_id:
+        try:
+            evicted = extraction_cache.set(cache_key, payload)
+            record_extraction_cache_stat('stores')
+            if evicted:
+                record_extraction_cache_stat('evictions', evicted)
+        except Exception as e:
+            print(f"⚠️ 快取寫入錯誤: {str(e)}")
+            record_extraction_cache_stat('errors')
+    
+    return dict(payload, cached=False)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
+PDF_EXTENSIONS = {'pdf'}  # 只有支援多頁處理的路由接受
+
+def allowed_file(filename, allow_pdf=False):
+    if '.' not in filename:
+        return False
+    extension = filename.rsplit('.', 1)[1].lower()
+    return extension in ALLOWED_EXTENSIONS and (allow_pdf or extension not in PDF_EXTENSIONS)
+
+def is_pdf_file(file_data):
+    return file_data[:5] == b'%PDF-'
+
+def is_pdf_filename(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in PDF_EXTENSIONS
+
+# 人工審核一次只顯示一張圖片，多頁 PDF 只能走自動處理
+PDF_HUMAN_REVIEW_ERROR = '人工審核不支援 PDF，多頁 PDF 請使用自動處理'
+
+def build_media_block(media_data):
+    """圖片使用 image 區塊；沒有內嵌圖片的 PDF 頁面以 document 區塊送出"""
+    if is_pdf_file(media_data):
+        return {"document": {"format": "pdf", "name": "page", "source": {"bytes": media_data}}}
+    return {"image": {"format": detect_image_format(media_data), "source": {"bytes": media_data}}}
+
+def detect_image_format(image_data):
+    """依檔頭判斷 Bedrock converse 使用的圖片格式"""
+    if image_data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'webp'
+    if image_data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return 'png'
+
+def is_effectively_grayscale(image):
+    """檢查彩色圖片是否實際上只有灰階內容（縮小後比較 RGB 通道差異）"""
+    if image.mode in ('L', '1'):
+        return True
+    sample = image.convert('RGB').resize((64, 64))
+    red, green, blue = sample.split()
+    max_diff = max(
+        ImageChops.difference(red, green).getextrema()[1],
+        ImageChops.difference(green, blue).getextrema()[1],
+        ImageChops.difference(red, blue).getextrema()[1]
+    )
+    return max_diff <= IMAGE_GRAYSCALE_MAX_CHANNEL_DIFF
+
+@timed_stage('image_preprocess')
+def preprocess_image(file_data):
+    """
+    送往模型前的圖片前處理（每次上傳執行一次，結果供所有模型共用）
+    - 套用 EXIF 旋轉
+    - 長邊縮至 IMAGE_MAX_LONG_EDGE
+    - 實際為灰階內容時轉為灰階
+    - 以原始格式重新編碼（JPEG 使用 IMAGE_JPEG_QUALITY，其餘使用 PNG）
+    回傳處理後的 bytes、格式與縮減統計
+    """
+    report = {
+        'enabled': IMAGE_PREPROCESSING_ENABLED,
+        'original_bytes': len(file_data),
+        'processed_bytes': len(file_data),
+        'format': detect_image_format(file_data)
+    }
+    if not IMAGE_PREPROCESSING_ENABLED:
+        return {'image_data': file_data, 'report': report}
+    
+    try:
+        started = time.perf_counter()
+        image = Image.open(io.BytesIO(file_data))
+        source_format = 'jpeg' if image.format == 'JPEG' else 'png'
+        original_size = image.size
+        rotated = image.getexif().get(0x0112, 1) != 1  # EXIF Orientation
+        if source_format == 'jpeg':
+            # 讓 JPEG 解碼器直接以 DCT 縮放解碼，避免完整解碼大張手機照片
+            image.draft('RGB', (IMAGE_MAX_LONG_EDGE, IMAGE_MAX_LONG_EDGE))
+        image = ImageOps.exif_transpose(image)
+        
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').split()[-1])
+            image = background
+        
+        resized = max(image.size) > IMAGE_MAX_LONG_EDGE
+        if resized:
+            image.thumbnail((IMAGE_MAX_LONG_EDGE, IMAGE_MAX_LONG_EDGE), Image.LANCZOS)
+        
+        grayscale = is_effectively_grayscale(image)
+        image = image.convert('L' if grayscale else 'RGB')
+        
+        output = io.BytesIO()
+        if source_format == 'jpeg':
+            image.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        else:
+            image.save(output, format='PNG', optimize=True)
+        processed = output.getvalue()
+        
+        # 沒有旋轉或縮圖且重新編碼沒有變小時，保留原始檔案
+        if not resized and not rotated and len(processed) >= len(file_data):
+            processed = file_data
+        
+        report.update({
+            'format': detect_image_format(processed),
+            'processed_bytes': len(processed),
+            'byte_reduction': 1 - len(processed) / len(file_data) if file_data else 0,
+            'original_pixels': original_size[0] * original_size[1],
+            'processed_pixels': image.size[0] * image.size[1],
+            'pixel_reduction': 1 - (image.size[0] * image.size[1]) / (original_size[0] * original_size[1]),
+            'original_dimensions': list(original_size),
+            'processed_dimensions': list(image.size),
+            'rotated': rotated,
+            'resized': resized,
+            'grayscale': grayscale,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+        print(f"🖼️ 圖片前處理: {report['original_bytes']} → {report['processed_bytes']} bytes, "
+              f"{original_size[0]}x{original_size[1]} → {image.size[0]}x{image.size[1]}")
+        return {'image_data': processed, 'report': report}
+        
+    except Exception as e:
+        print(f"⚠️ 圖片前處理失敗，使用原始檔案: {str(e)}")
+        report['error'] = str(e)
+        return {'image_data': file_data, 'report': report}
+
+def convert_floats_to_decimal(obj):
+    """遞歸轉換所有 float 為 Decimal，用於 DynamoDB 存儲"""
+    if isinstance(obj, float):
+        return Decimal(str(obj))
+    elif isinstance(obj, dict):
+        return {key: convert_floats_to_decimal(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_floats_to_decimal(item) for item in obj]
+    else:
+        return obj
+
+def build_image_metadata_item(filename, s3_key, file_size, content_type, session_id=None):
+    """圖片元數據記錄（單筆上傳與批次上傳共用）"""
+    timestamp = datetime.now().isoformat()
+    
+    # 使用現有表格，添加 record_type 來區分數據類型
+    item = {
+        'id': str(uuid.uuid4()),
+        'record_type': 'image_metadata',  # 區分圖片元數據和OCR結果
+        'timestamp': timestamp,
+        'filename': filename,
+        's3_key': s3_key,
+        'file_size': file_size,
+        'content_type': content_type,
+        'processing_status': 'uploaded',  # uploaded, processing, completed, failed
+        'created_at': timestamp,
+        'updated_at': timestamp
+    }
+    
+    if session_id:
+        item['session_id'] = session_id
+    
+    return item
+
+def save_image_metadata_to_dynamodb(filename, s3_key, file_size, content_type, session_id=None):
+    """保存圖片元數據到現有的 DynamoDB 表格"""
+    try:
+        item = build_image_metadata_item(filename, s3_key, file_size, content_type, session_id)
+        response = dynamodb_table.put_item(Item=item)
+        
+        return {
+            'success': True,
+            'image_id': item['id'],
+            'timestamp': item['timestamp']
+        }
+        
+    except Exception as e:
+        print(f"❌ 圖片元數據存儲錯誤: {str(e)}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+TERMINAL_IMAGE_STATUSES = {'completed', 'failed', 'pending_review'}
+
+def update_image_processing_status(image_id, status, ocr_result_id=None, extra_attributes=None):
+    """更新圖片處理狀態（同時發布 status 事件）；extra_attributes 與狀態寫在同一次更新中"""
+    try:
+        update_expression = "SET processing_status = :status, updated_at = :updated_at"
+        expression_values = {
+            ':status': status,
+            ':updated_at': datetime.now().isoformat()
+        }
+        
+        if ocr_result_id:
+            update_expression += ", ocr_result_id = :ocr_result_id"
+            expression_values[':ocr_result_id'] = ocr_result_id
+        
+        for name, value in (extra_attributes or {}).items():
+            update_expression += f", {name} = :{name}"
+            expression_values[f':{name}'] = value
+        
+        response = dynamodb_table.update_item(
+            Key={'id': image_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=expression_values
+        )
+        
+        progress_events.publish(image_topic(image_id), 'status', {
+            'image_id': image_id,
+            'status': status,
+            'ocr_result_id': ocr_result_id,
+            'updated_at': expression_values[':updated_at']
+        }, terminal=status in TERMINAL_IMAGE_STATUSES)
+        return {'success': True}
+        
+    except Exception as e:
+        print(f"❌ 更新圖片狀態錯誤: {str(e)}")
+        return {'success': False, 'error': str(e)}
+
+def encode_page_cursor(last_key):
+    """將 DynamoDB LastEvaluatedKey 編碼為不透明的分頁游標"""
+    if not last_key:
+        return None
+    raw = json.dumps(convert_decimals_for_json(last_key), sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor):
+    """解碼分頁游標，格式錯誤時拋出 ValueError"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('無效的分頁游標')
+    if not isinstance(last_key, dict) or set(last_key) != {'id', 'record_type', 'created_at'}:
+        raise ValueError('無效的分頁游標')
+    return last_key
+
+def convert_decimals_for_json(obj):
+    """遞歸轉換 DynamoDB 回傳的 Decimal 為 int/float"""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    elif isinstance(obj, dict):
+        return {key: convert_decimals_for_json(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_decimals_for_json(item) for item in obj]
+    else:
+        return obj
+
+def get_uploaded_images(limit=50, cursor=None, statuses=None, ascending=False):
+    """
+    以 record_type + created_at GSI 查詢已上傳的圖片列表（依建立時間排序、分頁）
+    - cursor: 上一頁回傳的 next_cursor
+    - statuses: 只回傳指定的 processing_status
+    - ascending: False 時最新的在前
+    """
+    try:
+        limit = max(1, min(int(limit), IMAGES_PAGE_MAX_LIMIT))
+        query_kwargs = {
+            'IndexName': DYNAMODB_RECORD_TYPE_INDEX,
+            'KeyConditionExpression': Key('record_type').eq('image_metadata'),
+            'ScanIndexForward': ascending
+        }
+        if statuses:
+            query_kwargs['FilterExpression'] = Attr('processing_status').is_in(list(statuses))
+        
+        exclusive_start_key = decode_page_cursor(cursor)
+        items = []
+        next_key = None
+        
+        # 有狀態篩選時 DynamoDB 先套用 Limit 再過濾，因此持續查詢直到湊滿一頁
+        while True:
+            if exclusive_start_key:
+                query_kwargs['ExclusiveStartKey'] = exclusive_start_key
+            query_kwargs['Limit'] = limit - len(items) if not statuses else max(limit - len(items), 25)
+            response = dynamodb_table.query(**query_kwargs)
+            page_items = response.get('Items', [])
+            exclusive_start_key = response.get('LastEvaluatedKey')
+            
+            remaining = limit - len(items)
+            if len(page_items) > remaining:
+                # 讀超過一頁：以最後一筆回傳的項目作為下一頁起點
+                items.extend(page_items[:remaining])
+                last_item = items[-1]
+                next_key = {'id': last_item['id'], 'record_type': last_item['record_type'], 'created_at': last_item['created_at']}
+                break
+            
+            items.extend(page_items)
+            if not exclusive_start_key:
+                break
+            if len(items) >= limit:
+                next_key = exclusive_start_key
+                break
+        
+        images = []
+        for item in items:
+            # 生成預簽名URL用於圖片預覽
+            presigned_url = generate_image_url(item['s3_key'])
+            
+            images.append({
+                'id': item['id'],
+                'filename': item['filename'],
+                's3_key': item['s3_key'],
+                'file_size': item['file_size'],
+                'content_type': item['content_type'],
+                'processing_status': item['processing_status'],
+                'created_at': item['created_at'],
+                'updated_at': item['updated_at'],
+                'session_id': item.get('session_id'),
+                'ocr_result_id': item.get('ocr_result_id'),
+                'presigned_url': presigned_url
+            })
+        
+        return {
+            'success': True,
+            'images': images,
+            'count': len(images),
+            'next_cursor': encode_page_cursor(next_key)
+        }
+        
+    except ValueError as e:
+        return {
+            'success': False,
+            'error': str(e),
+            'images': [],
+            'count': 0
+        }
+    except Exception as e:
+        print(f"❌ 獲取圖片列表錯誤: {str(e)}")
+        if 'index' in str(e).lower():
+            print(f"💡 請執行 python create_dynamodb_table.py 建立 {DYNAMODB_RECORD_TYPE_INDEX}")
+        return {
+            'success': False,
+            'error': str(e),
+            'images': [],
+            'count': 0
+        }
+
+@timed_stage('save_to_dynamodb')
+def save_to_dynamodb(data, processing_mode, confidence_score=None, human_reviewed=False, extra_attributes=None):
+    """Save OCR results to DynamoDB（extra_attributes 例如 PDF 的 session_id / page_number）"""
+    try:
+        # Generate unique ID
+        record_id = str(uuid.uuid4())
+        timestamp = datetime.now().isoformat()
+        
+        # Convert confidence_score to Decimal if it's a float
+        if confidence_score is not None:
+            confidence_score = Decimal(str(confidence_score))
+        
+        # 預設值、日期、英文選項值與 Decimal 轉換一次完成
+        converted_data = normalize_form_record(data)
+        print(f"🐾 動物醫院初診表數據正規化完成: {len(converted_data) if isinstance(converted_data, dict) else 0} 個區塊")
+        
+        # Prepare DynamoDB item
+        item = {
+            'id': record_id,
+            'timestamp': timestamp,
+            'processing_mode': processing_mode,  # 'automatic' or 'human_review'
+            'human_reviewed': human_reviewed,
+            'data': converted_data,
+            'created_at': timestamp,
+            'updated_at': timestamp
+        }
+        
+        # Only add confidence_score if it's not None
+        if confidence_score is not None:
+            item['confidence_score'] = confidence_score
+        
+        if extra_attributes:
+            item.update(extra_attributes)
+        
+        # Save to DynamoDB
+        response = dynamodb_table.put_item(Item=item)
+        publish_progress('dynamodb_saved', {
+            'record_id': record_id,
+            'processing_mode': processing_mode,
+            'page_number': (extra_attributes or {}).get('page_number')
+        })
+        
+        return {
+            'success': True,
+            'record_id': record_id,
+            'timestamp': timestamp,
+            'dynamodb_response': response
+        }
+        
+    except Exception as e:
+        print(f"❌ DynamoDB 存儲錯誤: {str(e)}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+@timed_stage('model_call')
+def process_with_claude_latest(image_data, for_human_review=False):
+    """Process with Claude Sonnet 4 for final validation or human review（兩者使用相同的提取提示詞）"""
+    try:
+        # Call Claude Sonnet 4
+        extracted_data, response_text, extraction_prompt, answered_model = run_extraction_call(
+            CLAUDE_SONNET_LATEST_MODEL_ID,
+            image_data,
+            {"maxTokens": 2000, "temperature": 0.1}
+        )
+        
+        return {
+            "success": True,
+            "model": "claude-sonnet-4" if answered_model == CLAUDE_SONNET_LATEST_MODEL_ID else answered_model,
+            "extracted_data": extracted_data,
+            "raw_response": response_text,
+            "prompt_version": extraction_prompt['version']
+        }
+
+    except Exception as e:
+        return {
+            "success": False,
+            "model": "claude-sonnet-4",
+            "error": str(e)
+        }
+
+def run_enhanced_voting_system(image_data, voting_mode=None):
+    """Enhanced voting system with Claude Sonnet 4 for automatic path"""
+    if (voting_mode or VOTING_MODE) == 'quorum':
+        return run_quorum_voting_system(image_data)
+    
+    print("🗳️ 開始增強型多模型投票處理...")
+    
+    # 準備所有任務 - 包含 Claude Sonnet 4
+    tasks = [
+        # Claude Sonnet 4 跑一次
+        (CLAUDE_SONNET_MODEL_ID, 1),
+        # Claude 3 Haiku 跑一次  
+        (CLAUDE_HAIKU_MODEL_ID, 1),
+        # Claude Sonnet 4 跑一次
+        (CLAUDE_SONNET_LATEST_MODEL_ID, 1)
+    ]
+    
+    # 並行執行所有任務，結果順序與 tasks 相同
+    results = run_model_tasks(image_data, tasks)
+    
+    # 分析結果並投票
+    print("📊 開始分析和投票...")
+    voting_result = analyze_and_vote(results)
+    refinement = refine_low_confidence_fields(image_data, voting_result)
+    
+    # 生成摘要
+    summary = generate_summary(results, voting_result)
+    summary['refinement'] = refinement
+    
+    return {
+        "individual_results": results,
+        "voting_result": voting_result,
+        "summary": summary
+    }
+
+def get_field_label(field_path):
+    """欄位路徑對應的中文名稱（例如 pet_info.pet_name → 寵物名）"""
+    return VET_FORM_FIELDS.get(field_path.split('.')[-1], field_path)
+
+def get_refinement_prompt(candidates):
+    """只要求重新辨識指定欄位的精簡提示詞，candidates 為 {欄位路徑: [候選值]}"""
+    field_lines = "\n".join(
+        f"- {field_path}（{get_field_label(field_path)}）: 候選值 {json.dumps(values, ensure_ascii=False)}"
+        for field_path, values in candidates.items()
+    )
+    return f"""
+    這是一份動物醫院初診表。多個模型對以下欄位的辨識結果不一致，請只重新仔細辨識這些欄位：
+    {field_lines}
+
+    請以圖片上實際的內容為準，候選值只供參考，可以都不採用；圖片上沒有填寫則返回空字串。
+    只返回以欄位路徑為鍵的扁平 JSON（例如 {{"pet_info.pet_name": "小白"}}），不要 markdown 格式。
+    """
+
+@timed_stage('refinement')
+def refine_low_confidence_fields(image_data, voting_result):
+    """
+    針對投票信心度低於 REFINEMENT_CONFIDENCE_THRESHOLD 的欄位，
+    以 REFINEMENT_MODEL_ID 做一次小型重新提取，並透過 set_nested_field 合併回 final_result
+    回傳精修摘要；vote_details 中被精修的欄位會標記 refined
+    """
+    vote_details = voting_result.get('vote_details', {})
+    disputed = {
+        field_path: [value for value in detail['votes'] if value]
+        for field_path, detail in vote_details.items()
+        if detail.get('confidence', 0) < REFINEMENT_CONFIDENCE_THRESHOLD
+    }
+    candidates = {field_path: values for field_path, values in disputed.items() if values}
+    info = {
+        "attempted": False,
+        "model": REFINEMENT_MODEL_ID,
+        "requested_fields": list(candidates),
+        "refined_fields": []
+    }
+    if not REFINEMENT_ENABLED or not candidates:
+        return info
+    if len(candidates) > REFINEMENT_MAX_FIELDS:
+        info["skipped_reason"] = f"低信心欄位 {len(candidates)} 個，超過上限 {REFINEMENT_MAX_FIELDS}"
+        return info
+    
+    print(f"🎯 精修 {len(candidates)} 個低信心欄位: {list(candidates)}")
+    info["attempted"] = True
+    try:
+        response = invoke_model(
+            REFINEMENT_MODEL_ID,
+            get_refinement_prompt(candidates),
+            image_data,
+            {"maxTokens": REFINEMENT_MAX_TOKENS, "temperature": 0.0}
+        )
+        refined_values = parse_json_response(response['output']['message']['content'][0]['text'], mode='refinement')
+    except Exception as e:
+        print(f"⚠️ 低信心欄位精修失敗: {str(e)}")
+        info["error"] = str(e)
+        return info
+    
+    for field_path, value in refined_values.items():
+        if field_path not in candidates or isinstance(value, (dict, list)):
+            continue
+        value = str(value) if value else ""
+        detail = vote_details[field_path]
+        # 精修結果視為額外一票，信心度依與原本候選值一致的票數重新計算
+        agreeing_votes = detail['votes'].get(value, 0)
+        detail.update({
+            "refined": True,
+            "previous_winner": detail['winner'],
+            "previous_confidence": detail['confidence'],
+            "winner": value,
+            "confidence": (agreeing_votes + 1) / (sum(detail['votes'].values()) + 1)
+        })
+        set_nested_field(voting_result['final_result'], field_path, value)
+        info["refined_fields"].append(field_path)
+    
+    print(f"✅ 精修完成: {len(info['refined_fields'])}/{len(candidates)} 個欄位")
+    return info
+
+def find_disputed_fields(results):
+    """找出多個模型結果之間不一致（或有缺漏）的欄位路徑"""
+    return [
+        field_path
+        for field_path, _, winner_count, total in tally_votes(results).winners()
+        if total < len(results) or winner_count < total
+    ]
+
+def run_quorum_voting_system(image_data):
+    """
+    Quorum 投票：先執行兩個模型，只有在欄位意見不一致時才呼叫第三個模型
+    - 兩個模型完全一致：跳過第三個模型
+    - 部分區塊不一致：第三個模型只重新提取有爭議的區塊
+    - 任一模型失敗或結果無法對應到已知區塊：第三個模型完整提取
+    """
+    print("🗳️ 開始 Quorum 多模型投票處理...")
+    
+    tasks = [(model_id, 1) for model_id in QUORUM_PRIMARY_MODEL_IDS]
+    results = run_model_tasks(image_data, tasks)
+    full_calls = len(tasks) + 1
+    
+    successful_results = [r for r in results if r.get('success')]
+    if len(successful_results) < len(results):
+        disputed_fields = None
+        disputed_sections = None
+    else:
+        disputed_fields = find_disputed_fields(successful_results)
+        disputed_sections = sorted({field_path.split('.')[0] for field_path in disputed_fields})
+    
+    tie_breaker_sections = None
+    if disputed_fields == []:
+        print("✅ 前兩個模型結果一致，跳過第三個模型")
+    elif disputed_sections and all(section in VET_FORM_SECTIONS for section in disputed_sections) \
+            and len(disputed_sections) < len(VET_FORM_SECTIONS):
+        print(f"⚖️ 有爭議的區塊: {disputed_sections}，第三個模型只重新提取這些區塊")
+        tie_breaker_sections = disputed_sections
+    else:
+        print("⚖️ 前兩個模型無法形成共識，第三個模型完整提取")
+    
+    if disputed_fields != []:
+        results += run_model_tasks(image_data, [(QUORUM_TIE_BREAKER_MODEL_ID, 1)],
+                                   sections=tie_breaker_sections)
+    
+    quorum_info = {
+        "mode": "quorum",
+        "quorum_reached": disputed_fields == [],
+        "tie_breaker_invoked": disputed_fields != [],
+        "partial_tie_breaker": tie_breaker_sections is not None,
+        "disputed_fields": disputed_fields or [],
+        "disputed_sections": disputed_sections or [],
+        "calls_made": len(results),
+        "calls_saved": full_calls - len(results)
+    }
+    
+    with quorum_stats_lock:
+        quorum_stats['requests'] += 1
+        quorum_stats['calls_saved'] += quorum_info['calls_saved']
+        if quorum_info['quorum_reached']:
+            quorum_stats['quorum_reached'] += 1
+        if quorum_info['tie_breaker_invoked']:
+            quorum_stats['tie_breaker_calls'] += 1
+        if quorum_info['partial_tie_breaker']:
+            quorum_stats['partial_tie_breaker_calls'] += 1
+    
+    print("📊 開始分析和投票...")
+    voting_result = analyze_and_vote(results)
+    refinement = refine_low_confidence_fields(image_data, voting_result)
+    summary = generate_summary(results, voting_result)
+    summary['quorum'] = quorum_info
+    summary['refinement'] = refinement
+    
+    return {
+        "individual_results": results,
+        "voting_result": voting_result,
+        "summary": summary
+    }
+
+class ModelTaskClock:
+    """記錄模型任務在 model_executor 中實際開始執行的時間，讓逾時不包含在共用執行緒池排隊的時間"""
+    
+    def __init__(self):
+        self.started = threading.Event()
+        self.started_at = None
+    
+    def run(self, func, *args):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return func(*args)
+    
+    def remaining(self, timeout):
+        return max(0, timeout - (time.monotonic() - self.started_at))
+
+@timed_stage('model_ensemble')
+def run_model_tasks(image_data, tasks, timeout=None, prompt=None, sections=None):
+    """
+    並行執行多個模型任務 (model_id, run_number)
+    - 使用共用的 model_executor，同時呼叫數受 MODEL_FANOUT_MAX_WORKERS 限制
+    - 每個呼叫從實際開始執行起算最多等待 timeout 秒，逾時視為失敗；
+      在執行緒池排隊超過 timeout 秒仍未開始的呼叫會被取消
+    - 回傳結果的順序與 tasks 相同
+    - prompt 為 None 時依模型使用產生的提取提示詞變體；只提取部分區塊時以 sections 指定這些區塊
+    - 斷路器開啟的模型改用替代模型（結果標記 substituted_for）或略過（結果標記 skipped）
+    """
+    if timeout is None:
+        timeout = MODEL_CALL_TIMEOUT_SECONDS
+    
+    route = current_metrics_route()
+    progress_topics = current_progress_topics()
+    vote = getattr(progress_local, 'vote', None)
+    runs_per_model = Counter(model_id for model_id, _ in tasks)
+    submitted = []
+    for model_id, run_number in tasks:
+        routed_model_id = route_ensemble_model(model_id)
+        if routed_model_id is None:
+            print(f"⛔ {model_id} 斷路器開啟且沒有可用的替代模型，略過")
+            submitted.append((model_id, None, run_number, None, None))
+            continue
+        if routed_model_id != model_id:
+            # 替代模型使用新的 run_number，避免與同一模型的其他成員共用快取結果
+            runs_per_model[routed_model_id] += 1
+            print(f"🔀 {model_id} 斷路器開啟，改用 {routed_model_id}")
+            run_number = runs_per_model[routed_model_id]
+        print(f"🤖 執行 {routed_model_id} - 第 {run_number} 次...")
+        clock = ModelTaskClock()
+        future = model_executor.submit(
+            clock.run, run_with_metrics_route, route, process_with_claude_model, image_data, routed_model_id, run_number, prompt, sections
+        )
+        if progress_topics:
+            if vote is not None:
+                vote.expect(1)
+            future.add_done_callback(functools.partial(publish_model_result, progress_topics, vote, routed_model_id, run_number))
+        submitted.append((model_id, routed_model_id, run_number, future, clock))
+    
+    results = []
+    for requested_model_id, model_id, run_number, future, clock in submitted:
+        if future is None:
+            results.append({
+                "success": False,
+                "model": requested_model_id,
+                "run_number": run_number,
+                "skipped": True,
+                "error": "模型斷路器開啟，已略過"
+            })
+            continue
+        
+        if not clock.started.wait(timeout) and future.cancel():
+            result = {
+                "success": False,
+                "model": model_id,
+                "run_number": run_number,
+                "error": f"模型呼叫排隊逾時 ({timeout:.0f}s)"
+            }
+        else:
+            clock.started.wait()
+            try:
+                result = future.result(timeout=clock.remaining(timeout))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                result = {
+                    "success": False,
+                    "model": model_id,
+                    "run_number": run_number,
+                    "error": f"模型呼叫逾時 ({timeout:.0f}s)"
+                }
+            except Exception as e:
+                result = {
+                    "success": False,
+                    "model": model_id,
+                    "run_number": run_number,
+                    "error": str(e)
+                }
+        
+        if model_id != requested_model_id:
+            result['substituted_for'] = requested_model_id
+        
+        if result.get('success'):
+            print(f"✅ {model_id} 處理成功")
+        else:
+            print(f"❌ {model_id} 處理失敗: {result.get('error', 'Unknown error')}")
+        results.append(result)
+    
+    return results
+
+def publish_model_result(topics, vote, model_id, run_number, future):
+    """模型呼叫完成時（依完成順序，不等待其他模型）發布 model_result 事件，漸進模式下同時加入投票"""
+    if future.cancelled():
+        return
+    error = future.exception()
+    result = {'success': False, 'error': str(error)} if error else future.result()
+    publish_progress('model_result', {
+        'model': result.get('model', model_id),
+        'run_number': run_number,
+        'success': bool(result.get('success')),
+        'error': result.get('error')
+    }, topics=topics)
+    if vote is not None:
+        vote.add(result)
+
+def publish_vote_complete(voting_results, page_number=None, vote=None):
+    """投票完成時發布 vote_complete 事件（只含摘要）；漸進模式下先發布最終的欄位變化"""
+    if vote is not None:
+        vote.finalize(voting_results['voting_result'])
+    summary = voting_results.get('summary') or {}
+    publish_progress('vote_complete', {
+        'page_number': page_number,
+        'successful_runs': summary.get('successful_runs'),
+        'total_runs': summary.get('total_runs'),
+        'average_confidence': summary.get('average_confidence'),
+        'low_confidence_fields': summary.get('low_confidence_fields', [])
+    })
+
+# 提取提示詞的區塊標題與欄位補充說明（欄位名稱本身來自 VET_FORM_FIELDS）
+VET_FORM_SECTION_TITLES = {
+    'basic_info': '基本資料 Basic Information',
+    'pet_info': '寵物資料 Pet Information',
+    'medical_history': '病史資料 Medical History',
+    'owner_info': '飼主資料 Owner Information',
+    'preventive_care': '預防醫療資料 Preventive Care',
+    'visit_info': '就診資訊 Visit Information'
+}
+
+VET_FORM_FIELD_HINTS = {
+    'species': '犬/貓/兔/其他',
+    'pet_gender': '公/母',
+    'desexed': '是/否',
+    'pet_age': '如：2歲3個月',
+    'monthly_preventive_treatment': '整體描述',
+    'monthly_preventive_yes': '如果勾選"是"則填入"是"',
+    'monthly_preventive_no': '如果勾選"否"則填入"否"',
+    'vaccine_types': '整體描述',
+    'vaccine_rabies': '如果勾選則填入"已施打"',
+    'vaccine_3in1': '如果勾選則填入"已施打"',
+    'vaccine_4in1': '如果勾選則填入"已施打"',
+    'vaccine_5in1': '如果勾選則填入"已施打"',
+    'vaccine_others': '如果勾選則填入"已施打"',
+    'vaccine_others_detail': '如：兔用疫苗'
+}
+
+# 特別注意事項：(相關區塊, 說明)，區塊為 None 表示一律加入
+EXTRACTION_PROMPT_NOTES = [
+    ('pet_info', '寵物年齡請填入pet_age欄位（如：2歲3個月），寵物出生日期請填入pet_birth_date欄位'),
+    ('preventive_care', '預防醫療資料中的勾選框請仔細識別，勾選的項目請標註為相應的值'),
+    ('preventive_care', '疫苗類型如果有勾選"其他"，請特別注意提取其詳細內容'),
+    (None, '所有日期格式請保持一致（YYYY-MM-DD或原始格式）'),
+    ('medical_history', '病史資料只需要填入過去病史欄位即可')
+]
+
+EXTRACTION_PROMPT_VARIANT_NAMES = ('full', 'compact')
+
+def build_compact_field_keys():
+    """compact 變體的短鍵：欄位名稱各單字的首字母（例如 first_visit_date → fvd），重複時加上序號"""
+    keys = {}
+    for section, fields in VET_FORM_SECTIONS.items():
+        for field in fields:
+            base = ''.join(part[0] for part in field.split('_'))
+            key, suffix = base, 2
+            while key in keys:
+                key, suffix = f"{base}{suffix}", suffix + 1
+            keys[key] = (section, field)
+    return keys
+
+COMPACT_FIELD_KEYS = build_compact_field_keys()  # 短鍵 → (區塊, 欄位)
+FIELD_COMPACT_KEYS = {field: key for key, (_, field) in COMPACT_FIELD_KEYS.items()}
+
+def describe_form_field(field):
+    hint = VET_FORM_FIELD_HINTS.get(field)
+    return f"{VET_FORM_FIELDS[field]}（{hint}）" if hint else VET_FORM_FIELDS[field]
+
+def build_full_prompt_text(sections, output_mode):
+    partial = len(sections) < len(VET_FORM_SECTIONS)
+    notes = [note for section, note in EXTRACTION_PROMPT_NOTES if section is None or section in sections]
+    note_lines = "\n".join(f"{number}. {note}" for number, note in enumerate(notes, 1))
+    scope = "只提取以下區塊的資訊" if partial else "提取所有資訊"
+    if output_mode == 'tool':
+        # 結構與逐欄說明已在工具 schema 中，不重複 JSON 骨架與輸出格式要求，只保留注意事項
+        return (
+            f"請分析這份動物醫院初診表並{scope}，以 {EXTRACTION_TOOL_NAME} 回傳。\n\n"
+            f"特別注意：\n{note_lines}\n\n"
+            f"如果某個欄位沒有資訊，請留空字串。"
+        )
+    skeleton = {section: {field: "" for field in VET_FORM_SECTIONS[section]} for section in sections}
+    field_blocks = "\n\n".join(
+        f"{VET_FORM_SECTION_TITLES[section]}:\n" + "\n".join(
+            f"- {field}: {describe_form_field(field)}" for field in VET_FORM_SECTIONS[section]
+        )
+        for section in sections
+    )
+    return (
+        f"請分析這份動物醫院初診表並{scope}，以結構化的 JSON 格式返回。\n\n"
+        f"請返回以下格式的 JSON（只返回 JSON，不要其他格式）：\n"
+        f"{json.dumps(skeleton, ensure_ascii=False, indent=4)}\n\n"
+        f"請仔細提取所有可見的文字並適當地組織到相應的欄位中：\n\n"
+        f"{field_blocks}\n\n"
+        f"特別注意：\n{note_lines}\n\n"
+        f"如果某個欄位沒有資訊，請留空字串。\n"
+        f"只返回 JSON，不要 markdown 格式。"
+    )
+
+def build_compact_prompt_text(sections, output_mode):
+    fields = [field for section in sections for field in VET_FORM_SECTIONS[section]]
+    if output_mode == 'tool':
+        # 欄位說明已在工具 schema 的 description 中，不重複
+        return f"提取動物醫院初診表，以 {EXTRACTION_TOOL_NAME} 回傳，鍵為欄位代號。勾選的疫苗填\"已施打\"，日期照原格式，無資訊填\"\"。"
+    codes = ";".join(f"{FIELD_COMPACT_KEYS[field]}={describe_form_field(field)}" for field in fields)
+    skeleton = json.dumps({FIELD_COMPACT_KEYS[field]: "" for field in fields}, separators=(',', ':'))
+    return (
+        "提取動物醫院初診表。勾選的疫苗填\"已施打\"，日期照原格式，無資訊填\"\"。\n"
+        f"欄位代號：{codes}\n"
+        f"只回傳 JSON：{skeleton}"
+    )
+
+def estimate_prompt_tokens(prompt, tool_config=None):
+    """提示詞與工具 schema 的輸入 token 估計（中英混合約每 3 字元 1 token）"""
+    tool_chars = len(json.dumps(tool_config, ensure_ascii=False)) if tool_config else 0
+    return (len(prompt) + tool_chars) // 3
+
+@functools.lru_cache(maxsize=None)
+def build_extraction_prompt(variant, sections, output_mode):
+    """
+    由 VET_FORM_SECTIONS / VET_FORM_FIELDS 產生提取提示詞（依參數快取，每種組合只產生一次）
+    - full：完整 JSON 骨架、逐欄說明與注意事項（tool 模式下結構與說明在工具 schema 中，只保留注意事項）
+    - compact：扁平短鍵（COMPACT_FIELD_KEYS）與精簡說明，輸出需以 expand_compact_output 還原
+    version 為提示詞與工具 schema 的雜湊，用於追蹤結果是由哪一版提示詞產生
+    """
+    if variant not in EXTRACTION_PROMPT_VARIANT_NAMES:
+        raise ValueError(f"未知的提示詞變體: {variant}")
+    sections = sections or tuple(VET_FORM_SECTIONS)
+    if variant == 'compact':
+        text = build_compact_prompt_text(sections, output_mode)
+    else:
+        text = build_full_prompt_text(sections, output_mode)
+    tool_config = get_extraction_tool_config(sections, variant) if output_mode == 'tool' else None
+    fingerprint = json.dumps({'text': text, 'tool': tool_config}, ensure_ascii=False, sort_keys=True)
+    return {
+        'variant': variant,
+        'text': text,
+        'tool_config': tool_config,
+        'version': f"{variant}-{hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:12]}",
+        'estimated_tokens': estimate_prompt_tokens(text, tool_config)
+    }
+
+def get_extraction_prompt(variant='full', sections=None):
+    """目前輸出模式下的提取提示詞（sections 為只提取部分區塊時的區塊清單）"""
+    sections = tuple(section for section in VET_FORM_SECTIONS if section in sections) if sections else None
+    return build_extraction_prompt(variant, sections, EXTRACTION_OUTPUT_MODE)
+
+def extraction_prompt_variant(model_id):
+    """模型使用的提示詞變體（EXTRACTION_PROMPT_VARIANTS 依模型指定，否則用 EXTRACTION_PROMPT_VARIANT）"""
+    variant = EXTRACTION_PROMPT_VARIANTS.get(model_id, EXTRACTION_PROMPT_VARIANT)
+    return variant if variant in EXTRACTION_PROMPT_VARIANT_NAMES else 'full'
+
+def expand_compact_output(data):
+    """compact 變體的扁平短鍵輸出 → 巢狀的完整欄位；模型仍回傳完整結構或無法對應的鍵時原樣保留"""
+    if not isinstance(data, dict):
+        return data
+    nested = {}
+    for key, value in data.items():
+        target = COMPACT_FIELD_KEYS.get(key)
+        if target:
+            nested.setdefault(target[0], {})[target[1]] = value
+        elif key in VET_FORM_SECTIONS and isinstance(value, dict):
+            nested.setdefault(key, {}).update(value)
+        else:
+            nested[key] = value
+    return nested
+
+def get_medical_extraction_prompt():
+    """根據動物醫院初診表格結構的醫療文件提取提示詞"""
+    return get_extraction_prompt('full')['text']
+
+def get_section_extraction_prompt(sections):
+    """只提取指定區塊的提示詞（用於 quorum 投票中重新詢問有爭議的區塊）"""
+    return get_extraction_prompt('full', sections)['text']
+
+@functools.lru_cache(maxsize=None)
+def get_extraction_tool_config(sections=None, variant='full'):
+    """
+    由 VET_FORM_SECTIONS / VET_FORM_FIELDS 產生的 converse toolConfig（sections 為 tuple 時只包含這些區塊）
+    toolChoice 強制模型呼叫此工具，回應中 toolUse.input 即為表單資料，不需要解析自由文字
+    variant=compact 時為扁平的短鍵 schema（COMPACT_FIELD_KEYS）
+    """
+    sections = sections or tuple(VET_FORM_SECTIONS)
+    if variant == 'compact':
+        fields = [field for section in sections for field in VET_FORM_SECTIONS[section]]
+        schema = {
+            'type': 'object',
+            'properties': {
+                FIELD_COMPACT_KEYS[field]: {'type': 'string', 'description': describe_form_field(field)}
+                for field in fields
+            },
+            'required': [FIELD_COMPACT_KEYS[field] for field in fields]
+        }
+    else:
+        schema = {
+            'type': 'object',
+            'properties': {
+                section: {
+                    'type': 'object',
+                    'properties': {
+                        field: {'type': 'string', 'description': describe_form_field(field)}
+                        for field in VET_FORM_SECTIONS[section]
+                    },
+                    'required': list(VET_FORM_SECTIONS[section])
+                }
+                for section in sections
+            },
+            'required': list(sections)
+        }
+    return {
+        'tools': [{
+            'toolSpec': {
+                'name': EXTRACTION_TOOL_NAME,
+                'description': '記錄從動物醫院初診表提取的欄位，沒有資訊的欄位填入空字串',
+                'inputSchema': {'json': schema}
+            }
+        }],
+        'toolChoice': {'tool': {'name': EXTRACTION_TOOL_NAME}}
+    }
+
+def extraction_tool_config(sections=None, variant='full'):
+    """EXTRACTION_OUTPUT_MODE=tool 時回傳 toolConfig，text 模式回傳 None"""
+    if EXTRACTION_OUTPUT_MODE != 'tool':
+        return None
+    return get_extraction_tool_config(tuple(sections) if sections else None, variant)
+
+# 啟動時產生各變體的完整表單提示詞（之後的呼叫直接取用快取）
+EXTRACTION_PROMPTS = {variant: get_extraction_prompt(variant) for variant in EXTRACTION_PROMPT_VARIANT_NAMES}
+for _prompt in EXTRACTION_PROMPTS.values():
+    print(f"📝 提取提示詞 {_prompt['version']}: 約 {_prompt['estimated_tokens']} 個輸入 token")
+
+# 各提示詞變體實際的輸入 token（只計入未命中快取的呼叫）
+prompt_usage_stats = defaultdict(lambda: {'calls': 0, 'input_tokens': 0})
+prompt_usage_stats_lock = threading.Lock()
+
+def record_prompt_usage(variant, model_id, usage):
+    input_tokens = (usage or {}).get('inputTokens')
+    if input_tokens is None:
+        return
+    with prompt_usage_stats_lock:
+        entry = prompt_usage_stats[(variant, model_id)]
+        entry['calls'] += 1
+        entry['input_tokens'] += input_tokens
+
+def get_prompt_variant_summary():
+    """各變體的版本、估計 token 與各模型實測的平均輸入 token（含圖片）"""
+    with prompt_usage_stats_lock:
+        usage = {key: dict(entry) for key, entry in prompt_usage_stats.items()}
+    variants = {}
+    for variant in EXTRACTION_PROMPT_VARIANT_NAMES:
+        prompt = get_extraction_prompt(variant)
+        variants[variant] = {
+            'version': prompt['version'],
+            'estimated_prompt_tokens': prompt['estimated_tokens'],
+            'measured': {
+                model_id: {
+                    'calls': entry['calls'],
+                    'avg_input_tokens': round(entry['input_tokens'] / entry['calls'], 1)
+                }
+                for (entry_variant, model_id), entry in usage.items()
+                if entry_variant == variant and entry['calls']
+            }
+        }
+    return {
+        'default_variant': EXTRACTION_PROMPT_VARIANT,
+        'model_variants': EXTRACTION_PROMPT_VARIANTS,
+        'variants': variants
+    }
+
+def run_extraction_call(model_id, image_data, inference_config, prompt=None, sections=None, cache_variant=None):
+    """
+    送出一次表單提取呼叫，回傳 (資料, 原始回應文字, 提示詞資訊, 實際回答的模型)
+    prompt 為 None 時依模型選用提示詞變體；compact 變體的輸出會還原為完整欄位
+    """
+    if prompt is None:
+        extraction_prompt = get_extraction_prompt(extraction_prompt_variant(model_id), sections)
+    else:
+        extraction_prompt = {'variant': 'custom', 'text': prompt, 'version': None,
+                             'tool_config': extraction_tool_config(sections)}
+    response = invoke_model(
+        model_id,
+        extraction_prompt['text'],
+        image_data,
+        inference_config,
+        cache_variant=cache_variant,
+        tool_config=extraction_prompt['tool_config']
+    )
+    answered_model = response.get('model', model_id)
+    if not response.get('cached'):
+        record_prompt_usage(extraction_prompt['variant'], answered_model, response.get('usage'))
+    extracted_data, response_text = parse_model_output(response, extraction_prompt['tool_config'])
+    if extraction_prompt['variant'] == 'compact':
+        extracted_data = expand_compact_output(extracted_data)
+    return extracted_data, response_text, extraction_prompt, answered_model
+
+def record_extraction_parse(mode, outcome):
+    with extraction_parse_stats_lock:
+        extraction_parse_stats[(mode, outcome)] += 1
+
+def get_extraction_parse_summary():
+    """各輸出模式的解析方式次數與失敗率（text 為結構化輸出之前的基準）"""
+    with extraction_parse_stats_lock:
+        stats = dict(extraction_parse_stats)
+    summary = {}
+    for (mode, outcome), count in stats.items():
+        summary.setdefault(mode, {'outcomes': {}, 'total': 0})
+        summary[mode]['outcomes'][outcome] = count
+        summary[mode]['total'] += count
+    for entry in summary.values():
+        entry['failure_rate'] = round(entry['outcomes'].get('failed', 0) / entry['total'], 4)
+    return summary
+
+def parse_model_output(response, tool_config=None):
+    """
+    讀取模型輸出，回傳 (資料, 原始回應文字)
+    有 tool_config 時直接取 toolUse 的輸入；模型沒有呼叫工具時才退回解析文字
+    """
+    content = response['output']['message']['content']
+    if tool_config is not None:
+        for block in content:
+            tool_use = block.get('toolUse')
+            if tool_use and tool_use.get('name') == EXTRACTION_TOOL_NAME and isinstance(tool_use.get('input'), dict):
+                record_extraction_parse('tool', 'tool_use')
+                return tool_use['input'], json.dumps(tool_use['input'], ensure_ascii=False)
+    response_text = ''.join(block.get('text', '') for block in content)
+    return parse_json_response(response_text, mode='tool' if tool_config is not None else 'text'), response_text
+
+def process_with_claude_model(image_data, model_id, run_number, prompt=None, sections=None):
+    """使用指定的 Claude 模型處理醫療文件（sections 為只提取部分區塊時的區塊清單，決定提示詞與工具 schema）"""
+    try:
+        # 讀取 toolUse 輸入（text 模式則解析 JSON 回應）
+        extracted_data, response_text, extraction_prompt, answered_model = run_extraction_call(
+            model_id,
+            image_data,
+            {"maxTokens": 2000, "temperature": 0.5},
+            prompt=prompt,
+            sections=sections,
+            cache_variant=run_number
+        )
+        
+        if isinstance(extracted_data, dict):
+            # 每次執行只保留 VetFormRecord，模型輸出的巢狀 dict 不再保存
+            extracted_data = VetFormRecord.from_nested(extracted_data)
+        result = {
+            "success": True,
+            "model": answered_model,
+            "run_number": run_number,
+            "extracted_data": extracted_data,
+            "raw_response": response_text,
+            "prompt_version": extraction_prompt['version']
+        }
+        if answered_model != model_id:
+            # 對沖由替代模型回答：投票明細記在實際回答的模型名下
+            result['hedged_from'] = model_id
+        return result
+
+    except Exception as e:
+        return {
+            "success": False,
+            "model": model_id,
+            "run_number": run_number,
+            "error": str(e)
+        }
+
+def parse_json_response(response_text, mode='text'):
+    """解析 JSON 回應（依 mode 記錄使用了哪一種解析方式，供比較結構化輸出前後的解析失敗率）"""
+    try:
+        # 直接解析 JSON
+        parsed = json.loads(response_text)
+        record_extraction_parse(mode, 'json')
+        return parsed
+    except json.JSONDecodeError:
+        try:
+            # 處理 markdown 包裝的 JSON
+            json_match = re.search(r'```(?:json)?\s*\n?(.*?)\n?```', response_text, re.DOTALL)
+            if json_match:
+                json_str = json_match.group(1).strip()
+                parsed = json.loads(json_str)
+                record_extraction_parse(mode, 'fenced_json')
+                return parsed
+            else:
+                # 嘗試找到 JSON 內容
+                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+                if json_match:
+                    json_str = json_match.group(0)
+                    parsed = json.loads(json_str)
+                    record_extraction_parse(mode, 'embedded_json')
+                    return parsed
+                else:
+                    record_extraction_parse(mode, 'failed')
+                    return {"raw_text": response_text, "parsing_error": "無法提取 JSON"}
+        except json.JSONDecodeError:
+            record_extraction_parse(mode, 'failed')
             return {"raw_text": response_text, "parsing_error": "JSON 解析失敗"}
 
-def run_multi_model_voting(image_data):
-    """執行多模型投票系統"""
-    print("🗳️ 開始多模型投票處理...")
+def run_multi_model_voting(image_data):
+    """執行多模型投票系統"""
+    print("🗳️ 開始多模型投票處理...")
+    
+    # 準備所有任務
+    tasks = [
+        # Claude Sonnet 4 跑兩次
+        (CLAUDE_SONNET_MODEL_ID, 1),
+        (CLAUDE_SONNET_MODEL_ID, 2),
+        # Claude 3 Haiku 跑兩次
+        (CLAUDE_HAIKU_MODEL_ID, 1),
+        (CLAUDE_HAIKU_MODEL_ID, 2)
+    ]
+    
+    # 並行執行所有任務，結果順序與 tasks 相同
+    results = run_model_tasks(image_data, tasks)
+    
+    # 分析結果並投票
+    voting_result = analyze_and_vote(results)
+    refinement = refine_low_confidence_fields(image_data, voting_result)
+    
+    summary = generate_summary(results, voting_result)
+    summary['refinement'] = refinement
+    
+    return {
+        "individual_results": results,
+        "voting_result": voting_result,
+        "summary": summary
+    }
+
+@timed_stage('analyze_and_vote')
+def analyze_and_vote(results):
+    """分析結果並進行投票"""
+    print("📊 分析結果並進行投票...")
+    
+    successful_results = [r for r in results if r.get('success')]
+    
+    if not successful_results:
+        print("❌ 所有模型都處理失敗")
+        return {
+            "error": "所有模型都處理失敗",
+            "final_result": {},
+            "vote_details": {},
+            "successful_models": 0,
+            "total_models": len(results)
+        }
+    
+    print(f"✅ {len(successful_results)}/{len(results)} 個模型處理成功")
+    
+    # 收集所有欄位的值
+    tally = VoteTally()
+    
+    for result in successful_results:
+        data = result.get('extracted_data', {})
+        if not data:
+            print(f"⚠️ 模型 {result.get('model', 'unknown')} 沒有提取到資料")
+            continue
+        
+        record = data if isinstance(data, VetFormRecord) else VetFormRecord.from_nested(data)
+        # 調試：打印每個模型提取的欄位數
+        non_empty_fields = sum(1 for value in record.values() if value)
+        print(f"🔍 模型 {result.get('model', 'unknown')} 提取了 {len(record)} 個欄位, {non_empty_fields} 個有值")
+        
+        tally.add(record, result['model'], result['run_number'])
+    
+    if not len(tally):
+        print("❌ 沒有收集到任何欄位資料")
+        return {
+            "error": "沒有收集到任何欄位資料",
+            "final_result": {},
+            "vote_details": {},
+            "successful_models": len(successful_results),
+            "total_models": len(results)
+        }
+    
+    # 對每個欄位進行投票
+    vote_details = tally.vote_details
+    print(f"✅ 投票完成，處理了 {len(vote_details)} 個欄位")
+    
+    return {
+        "final_result": tally.final_result,
+        "vote_details": vote_details,
+        "successful_models": len(successful_results),
+        "total_models": len(results)
+    }
+
+def collect_field_votes(data, field_votes, model, run_number):
+    """收集欄位投票（data 可為巢狀 dict 或 VetFormRecord）"""
+    record = data if isinstance(data, VetFormRecord) else VetFormRecord.from_nested(data)
+    for field_path, value in record.items():
+        if isinstance(value, list):
+            # 對於陣列，轉換為字串進行投票
+            value = json.dumps(value, ensure_ascii=False)
+        else:
+            value = str(value) if value else ""
+        field_votes[field_path].append({
+            'value': value,
+            'model': model,
+            'run': run_number
+        })
+
+def vote_for_field(votes):
+    """對單一欄位進行投票"""
+    if not votes:
+        return "", {"winner": "", "votes": [], "confidence": 0}
+    
+    # 統計投票
+    vote_counts = Counter(vote['value'] for vote in votes)
+    
+    # 找出最高票數
+    winner = vote_counts.most_common(1)[0][0]
+    winner_count = vote_counts[winner]
+    
+    # 計算信心度
+    confidence = winner_count / len(votes)
+    
+    return winner, {
+        "winner": winner,
+        "votes": vote_counts,
+        "confidence": confidence,
+        "details": votes
+    }
+
+def set_nested_field(obj, field_path, value):
+    """設置嵌套欄位值"""
+    keys = field_path.split('.')
+    current = obj
+    
+    for key in keys[:-1]:
+        if key not in current:
+            current[key] = {}
+        current = current[key]
+    
+    # 處理陣列值
+    final_key = keys[-1]
+    if value.startswith('[') and value.endswith(']'):
+        try:
+            current[final_key] = json.loads(value)
+        except:
+            current[final_key] = value
+    else:
+        current[final_key] = value
+
+class VoteTally:
+    """
+    以固定欄位 index 統計多個模型結果的投票：
+    - FORM_FIELD_PATHS 中的欄位使用預先配置的陣列位置，schema 以外的欄位才動態加入
+    - 每個欄位保存 {候選值: 票數}（依首次出現順序，與 Counter.most_common 的平手規則相同）與投票來源
+    - final_result / vote_details 在第一次讀取時才建立
+    """
+    __slots__ = ('paths', 'index', 'counts', 'voters', '_final_result', '_vote_details')
+    
+    def __init__(self):
+        self.paths = list(FORM_FIELD_PATHS)
+        self.index = FORM_FIELD_INDEX  # 出現 schema 以外的欄位時才複製
+        self.counts = [None] * len(FORM_FIELD_PATHS)
+        self.voters = [None] * len(FORM_FIELD_PATHS)
+        self._final_result = None
+        self._vote_details = None
+    
+    def __len__(self):
+        """有收到投票的欄位數"""
+        return sum(1 for counts in self.counts if counts)
+    
+    def _vote(self, position, value, voter):
+        if isinstance(value, list):
+            value = json.dumps(value, ensure_ascii=False)  # 陣列以 JSON 字串比較
+        else:
+            value = str(value) if value else ""
+        counts = self.counts[position]
+        if counts is None:
+            self.counts[position] = {value: 1}
+            self.voters[position] = [(value, voter)]
+        else:
+            counts[value] = counts.get(value, 0) + 1
+            self.voters[position].append((value, voter))
+    
+    def _position(self, field_path):
+        position = self.index.get(field_path)
+        if position is None:
+            if self.index is FORM_FIELD_INDEX:
+                self.index = dict(FORM_FIELD_INDEX)
+            position = self.index[field_path] = len(self.paths)
+            self.paths.append(field_path)
+            self.counts.append(None)
+            self.voters.append(None)
+        return position
+    
+    def add(self, data, model, run_number):
+        """加入一個模型結果（巢狀 dict 或 VetFormRecord）"""
+        record = data if isinstance(data, VetFormRecord) else VetFormRecord.from_nested(data)
+        voter = (model, run_number)
+        self._final_result = self._vote_details = None
+        counts_by_field, voters_by_field = self.counts, self.voters
+        for position, value in enumerate(record.values(_UNSET)):
+            if value is _UNSET:
+                continue
+            if isinstance(value, dict):
+                for field_path, item in flatten_form_value(value, FORM_FIELD_PATHS[position]):
+                    self._vote(self._position(field_path), item, voter)
+                continue
+            # 與 _vote 相同，schema 欄位佔絕大多數，內聯以省去函數呼叫
+            if isinstance(value, list):
+                value = json.dumps(value, ensure_ascii=False)
+            else:
+                value = str(value) if value else ""
+            counts = counts_by_field[position]
+            if counts is None:
+                counts_by_field[position] = {value: 1}
+                voters_by_field[position] = [(value, voter)]
+            else:
+                counts[value] = counts.get(value, 0) + 1
+                voters_by_field[position].append((value, voter))
+        if record.extras:
+            for path, value in record.extras.items():
+                for field_path, item in flatten_form_value(value, path):
+                    self._vote(self._position(field_path), item, voter)
+    
+    def _winners(self):
+        """依欄位順序產生 (位置, 勝出值, 勝出票數, 總票數)"""
+        for position, counts in enumerate(self.counts):
+            if not counts:
+                continue
+            winner, winner_count = "", 0
+            for value, count in counts.items():
+                if count > winner_count:
+                    winner, winner_count = value, count
+            yield position, winner, winner_count, len(self.voters[position])
+    
+    def winners(self):
+        """依欄位順序產生 (欄位路徑, 勝出值, 勝出票數, 總票數)"""
+        for position, winner, winner_count, total in self._winners():
+            yield self.paths[position], winner, winner_count, total
+    
+    @property
+    def final_result(self):
+        if self._final_result is None:
+            final_result = {}
+            schema_size = len(FORM_FIELD_KEYS)
+            for position, winner, _, _ in self._winners():
+                if position < schema_size:
+                    # schema 欄位的區塊 / 欄位名稱已預先拆好，不需再分割路徑
+                    section, field = FORM_FIELD_KEYS[position]
+                    section_result = final_result.get(section)
+                    if section_result is None:
+                        section_result = final_result[section] = {}
+                    section_result[field] = decode_vote_value(winner)
+                else:
+                    set_nested_field(final_result, self.paths[position], winner)
+            self._final_result = final_result
+        return self._final_result
+    
+    @property
+    def vote_details(self):
+        if self._vote_details is None:
+            self._vote_details = {
+                self.paths[position]: {
+                    "winner": winner,
+                    "votes": dict(self.counts[position]),
+                    "confidence": winner_count / total,
+                    "details": [
+                        {'value': value, 'model': model, 'run': run}
+                        for value, (model, run) in self.voters[position]
+                    ]
+                }
+                for position, winner, winner_count, total in self._winners()
+            }
+        return self._vote_details
+
+def tally_votes(results):
+    """以 VoteTally 統計成功的模型結果"""
+    tally = VoteTally()
+    for result in results:
+        data = result.get('extracted_data') if result.get('success', True) else None
+        if data:
+            tally.add(data, result['model'], result['run_number'])
+    return tally
+
+def vote_documents(documents):
+    """
+    便利函數（大量重新處理用）：documents 為每份文件的模型結果串列，逐份以 tally_votes 投票
+    並非跨文件的向量化計算，成本與逐份呼叫 tally_votes 相同；final_result / vote_details 在讀取時才建立
+    """
+    return [tally_votes(results) for results in documents]
+
+def generate_summary(individual_results, voting_result):
+    """生成摘要報告"""
+    successful = len([r for r in individual_results if r.get('success')])
+    total = len(individual_results)
+    
+    model_performance = {}
+    for result in individual_results:
+        model_name = result['model'].split('.')[-1]  # 簡化模型名稱
+        if model_name not in model_performance:
+            model_performance[model_name] = {'success': 0, 'total': 0}
+        
+        model_performance[model_name]['total'] += 1
+        if result.get('success'):
+            model_performance[model_name]['success'] += 1
+    
+    # 計算投票信心度
+    vote_details = voting_result.get('vote_details', {})
+    avg_confidence = sum(detail['confidence'] for detail in vote_details.values()) / len(vote_details) if vote_details else 0
+    
+    return {
+        "total_runs": total,
+        "successful_runs": successful,
+        "success_rate": successful / total if total > 0 else 0,
+        "model_performance": model_performance,
+        "average_confidence": avg_confidence,
+        "high_confidence_fields": [field for field, detail in vote_details.items() if detail.get('confidence', 0) >= 0.75],
+        "low_confidence_fields": [field for field, detail in vote_details.items() if detail.get('confidence', 0) < 0.5],
+        "circuit_breaker": {
+            "skipped_models": [r['model'] for r in individual_results if r.get('skipped')],
+            "substituted_models": {r['substituted_for']: r['model'] for r in individual_results if r.get('substituted_for')},
+            "degraded": any(r.get('skipped') or r.get('substituted_for') for r in individual_results)
+        }
+    }
+
+def store_upload(file_data, filename, content_type, processing_mode, key_prefix):
+    """上傳檔案到 S3 並建立圖片元數據記錄"""
+    session_id = str(uuid.uuid4())
+    s3_key = f"{key_prefix}/{datetime.now().strftime('%Y/%m/%d')}/{session_id}/{filename}"
+    with stage_timer('s3_upload'):
+        s3_client.put_object(
+            Bucket=S3_BUCKET, 
+            Key=s3_key, 
+            Body=file_data, 
+            ContentType=content_type,
+            Metadata={
+                'session_id': session_id,
+                'processing_mode': processing_mode,
+                'original_filename': filename
+            }
+        )
+    
+    image_metadata = save_image_metadata_to_dynamodb(
+        filename=filename,
+        s3_key=s3_key,
+        file_size=len(file_data),
+        content_type=content_type,
+        session_id=session_id
+    )
+    
+    if not image_metadata['success']:
+        return {'success': False, 'error': image_metadata['error']}
+    
+    publish_progress('upload_stored', {
+        'image_id': image_metadata['image_id'],
+        'filename': filename,
+        's3_key': s3_key,
+        'file_size': len(file_data)
+    }, topics=[image_topic(image_metadata['image_id'])])
+    return {
+        'success': True,
+        'image_id': image_metadata['image_id'],
+        'session_id': session_id,
+        's3_key': s3_key
+    }
+
+@progress_scoped
+def run_automatic_pipeline(image_id, session_id, filename, file_data, voting_mode=None):
+    """自動處理流程：前處理 → 多模型投票 → 存入 DynamoDB → 結果寫入 S3"""
+    # 更新處理狀態為 processing
+    update_image_processing_status(image_id, 'processing')
+    
+    # 圖片前處理（所有模型共用）後執行增強型投票處理 (3個模型，quorum 模式下可能只需 2 個)
+    preprocessed = preprocess_image(file_data)
+    with progressive_vote() as vote:
+        voting_results = run_enhanced_voting_system(preprocessed['image_data'], voting_mode=voting_mode)
+    
+    # 調試：打印投票結果結構
+    print("🔍 調試 - 投票結果結構:")
+    if voting_results and 'voting_result' in voting_results:
+        final_result = voting_results['voting_result'].get('final_result', {})
+        print(f"  - final_result 鍵: {list(final_result.keys())}")
+        for section, content in final_result.items():
+            if isinstance(content, dict):
+                print(f"  - {section}: {list(content.keys())}")
+            else:
+                print(f"  - {section}: {type(content)}")
+    
+    # 檢查投票結果結構
+    if not voting_results or 'voting_result' not in voting_results:
+        update_image_processing_status(image_id, 'failed')
+        return {'success': False, 'error': '投票處理失敗：無效的結果結構'}
+        
+    if 'final_result' not in voting_results['voting_result']:
+        update_image_processing_status(image_id, 'failed')
+        return {'success': False, 'error': '投票處理失敗：缺少最終結果'}
+    
+    publish_vote_complete(voting_results, vote=vote)
+    
+    # 計算平均信心度
+    vote_details = voting_results['voting_result'].get('vote_details', {})
+    avg_confidence = sum(detail['confidence'] for detail in vote_details.values()) / len(vote_details) if vote_details else 0
+    
+    # 自動存入 DynamoDB
+    final_result = voting_results['voting_result']['final_result']
+    db_result = save_to_dynamodb(
+        data=final_result,
+        processing_mode='automatic',
+        confidence_score=avg_confidence,
+        human_reviewed=False
+    )
+    
+    # 更新圖片處理狀態
+    if db_result['success']:
+        update_image_processing_status(image_id, 'completed', db_result['record_id'])
+    else:
+        update_image_processing_status(image_id, 'failed')
+    
+    # 儲存處理結果到 S3
+    results_key = f"automatic_results/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
+    with stage_timer('s3_result_write'):
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=results_key,
+            Body=json.dumps({
+                'session_id': session_id,
+                'image_id': image_id,
+                'filename': filename,
+                'processed_at': datetime.now().isoformat(),
+                'processing_mode': 'automatic',
+                'voting_results': voting_results,
+                'dynamodb_result': db_result
+            }, indent=2, ensure_ascii=False, default=form_json_default),
+            ContentType='application/json'
+        )
+    
+    return {
+        'success': True,
+        'image_preprocessing': preprocessed['report'],
+        'voting_results': voting_results,
+        'dynamodb_result': db_result,
+        'confidence_score': avg_confidence
+    }
+
+def extract_pdf_page(page):
+    """
+    取出單一 PDF 頁面送往模型的內容：
+    掃描檔每頁通常是一張內嵌圖片，取面積最大者；沒有可用圖片時輸出只含該頁的 PDF
+    """
+    try:
+        candidates = []
+        for embedded in page.images:
+            try:
+                with Image.open(io.BytesIO(embedded.data)) as image:
+                    candidates.append((image.width * image.height, embedded.data))
+            except Exception:
+                continue
+        if candidates:
+            return {'data': max(candidates, key=lambda candidate: candidate[0])[1], 'source': 'embedded_image'}
+    except Exception as e:
+        print(f"⚠️ PDF 頁面圖片讀取失敗，改送整頁 PDF: {str(e)}")
+    
+    writer = PdfWriter()
+    writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return {'data': buffer.getvalue(), 'source': 'pdf_page'}
+
+def iter_pdf_pages(file_data):
+    """
+    開啟 PDF 並檢查頁數（無法開啟或超過上限時直接拋出例外），回傳逐頁產生 (頁碼, 頁面內容, 錯誤) 的產生器；
+    頁面在被取用時才解析與取出圖片，單頁取出失敗只標記該頁
+    """
+    reader = PdfReader(io.BytesIO(file_data))
+    page_count = len(reader.pages)
+    if page_count > PDF_MAX_PAGES:
+        raise ValueError(f"PDF 共 {page_count} 頁，超過上限 {PDF_MAX_PAGES} 頁")
+    
+    def pages():
+        for index in range(page_count):
+            try:
+                page, error = extract_pdf_page(reader.pages[index]), None
+            except Exception as e:
+                print(f"❌ PDF 第 {index + 1} 頁取出失敗: {str(e)}")
+                page, error = None, f'頁面取出失敗: {str(e)}'
+            yield index + 1, page, error
+    
+    return pages()
+
+def process_pdf_page(image_id, session_id, s3_key, page_number, page, voting_mode=None):
+    """單一頁面：前處理 → 頁面圖片寫入 S3 → 多模型投票 → 存入 DynamoDB（與整份 PDF 共用 session_id / image_id）"""
+    try:
+        report = None
+        media_data = page['data']
+        if page['source'] == 'embedded_image':
+            preprocessed = preprocess_image(media_data)
+            media_data = preprocessed['image_data']
+            report = preprocessed['report']
+        
+        extension = 'pdf' if is_pdf_file(media_data) else detect_image_format(media_data)
+        page_s3_key = f"{s3_key.rsplit('/', 1)[0]}/pages/page-{page_number:04d}.{extension}"
+        with stage_timer('s3_upload'):
+            s3_client.put_object(
+                Bucket=S3_BUCKET,
+                Key=page_s3_key,
+                Body=media_data,
+                ContentType='application/pdf' if extension == 'pdf' else f'image/{extension}',
+                Metadata={'session_id': session_id, 'page_number': str(page_number)}
+            )
+        
+        with progressive_vote(page_number=page_number) as vote:
+            voting_results = run_enhanced_voting_system(media_data, voting_mode=voting_mode)
+        voting_result = voting_results['voting_result']
+        if not voting_result.get('final_result'):
+            return {'page_number': page_number, 'success': False, 'page_s3_key': page_s3_key,
+                    'error': voting_result.get('error', '投票處理失敗：缺少最終結果')}
+        publish_vote_complete(voting_results, page_number=page_number, vote=vote)
+        
+        vote_details = voting_result.get('vote_details', {})
+        avg_confidence = sum(detail['confidence'] for detail in vote_details.values()) / len(vote_details) if vote_details else 0
+        db_result = save_to_dynamodb(
+            data=voting_result['final_result'],
+            processing_mode='automatic',
+            confidence_score=avg_confidence,
+            human_reviewed=False,
+            extra_attributes={
+                'session_id': session_id,
+                'image_id': image_id,
+                'page_number': page_number,
+                'page_s3_key': page_s3_key
+            }
+        )
+        return {
+            'page_number': page_number,
+            'success': db_result['success'],
+            'source': page['source'],
+            'page_s3_key': page_s3_key,
+            'record_id': db_result.get('record_id'),
+            'confidence_score': avg_confidence,
+            'image_preprocessing': report,
+            'summary': voting_results['summary'],
+            'error': db_result.get('error')
+        }
+    
+    except Exception as e:
+        print(f"❌ PDF 第 {page_number} 頁處理失敗: {str(e)}")
+        return {'page_number': page_number, 'success': False, 'error': str(e)}
+
+@progress_scoped
+def run_pdf_pipeline(image_id, session_id, filename, file_data, s3_key, voting_mode=None):
+    """
+    多頁 PDF 自動處理：逐頁取出內容，最多 PDF_PAGE_CONCURRENCY 頁同時處理，
+    有空位時才取出下一頁；每頁存成一筆 OCR 結果，共用同一筆圖片元數據
+    記憶體上限為整份上傳檔（PdfReader 需要可隨機讀取的來源）加上 PDF_PAGE_CONCURRENCY 頁的內容
+    """
+    update_image_processing_status(image_id, 'processing')
+    
+    route = current_metrics_route()
+    progress = current_progress_scope()
+    page_results = []
+    try:
+        pages = iter_pdf_pages(file_data)
+    except Exception as e:
+        update_image_processing_status(image_id, 'failed')
+        return {'success': False, 'error': f'PDF 讀取失敗: {str(e)}'}
+    
+    # 單頁失敗（取出或處理）只記錄在該頁結果，其他頁面照常處理並連結到 ocr_result_ids
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PDF_PAGE_CONCURRENCY, thread_name_prefix='pdf-page') as executor:
+        in_flight = set()
+        for page_number, page, error in pages:
+            if error:
+                page_results.append({'page_number': page_number, 'success': False, 'error': error})
+                continue
+            in_flight.add(executor.submit(
+                run_with_metrics_route, route, run_with_progress_scope, progress, process_pdf_page,
+                image_id, session_id, s3_key, page_number, page, voting_mode
+            ))
+            page = None
+            # 等到有空位才回到產生器取出下一頁，處理中加上已取出的頁面不超過 PDF_PAGE_CONCURRENCY
+            if len(in_flight) >= PDF_PAGE_CONCURRENCY:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                page_results.extend(future.result() for future in done)
+        page_results.extend(future.result() for future in concurrent.futures.as_completed(in_flight))
+    
+    page_results.sort(key=lambda result: result['page_number'])
+    record_ids = [result['record_id'] for result in page_results if result['success']]
+    failed_pages = [result['page_number'] for result in page_results if not result['success']]
+    
+    # 頁面連結與終止狀態寫在同一次更新，看到 completed 的用戶端一定讀得到 ocr_result_ids
+    update_image_processing_status(
+        image_id, 'completed' if record_ids else 'failed', record_ids[0] if record_ids else None,
+        extra_attributes={'page_count': len(page_results), 'ocr_result_ids': record_ids, 'failed_pages': failed_pages}
+    )
+    
+    confidences = [result['confidence_score'] for result in page_results if result['success']]
+    confidence_score = sum(confidences) / len(confidences) if confidences else 0
+    
+    results_key = f"automatic_results/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
+    with stage_timer('s3_result_write'):
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=results_key,
+            Body=json.dumps({
+                'session_id': session_id,
+                'image_id': image_id,
+                'filename': filename,
+                'processed_at': datetime.now().isoformat(),
+                'processing_mode': 'automatic',
+                'document_type': 'pdf',
+                'pages': page_results
+            }, indent=2, ensure_ascii=False),
+            ContentType='application/json'
+        )
+    
+    if not record_ids:
+        return {'success': False, 'error': f'PDF 所有頁面處理失敗（共 {len(page_results)} 頁）', 'pages': page_results}
+    
+    return {
+        'success': True,
+        'page_count': len(page_results),
+        'failed_pages': failed_pages,
+        'pages': page_results,
+        'confidence_score': confidence_score
+    }
+
+@progress_scoped
+def run_human_review_pipeline(image_id, session_id, filename, file_data):
+    """人工審核流程：前處理 → Claude Sonnet 處理 → 待審核結果寫入 S3"""
+    # 更新處理狀態為 processing
+    update_image_processing_status(image_id, 'processing')
+    
+    # 圖片前處理後使用 Claude Sonnet 4 處理
+    preprocessed = preprocess_image(file_data)
+    claude_result = process_with_claude_latest(preprocessed['image_data'], for_human_review=True)
+    publish_progress('model_result', {
+        'model': claude_result.get('model'),
+        'run_number': 1,
+        'success': claude_result['success'],
+        'error': claude_result.get('error')
+    })
+    scope = current_progress_scope()
+    if scope and scope['progressive'] and claude_result['success']:
+        # 審核流程只有一個模型：結果一回來就送出，不等待 S3 寫入與狀態更新
+        publish_progress('provisional_result', {
+            'model': claude_result.get('model'),
+            'run_number': 1,
+            'extracted_data': claude_result.get('extracted_data'),
+            'models_received': 1,
+            'models_expected': 1
+        }, topics=scope['topics'][:1])
+    status = 'pending_review' if claude_result['success'] else 'failed'
+    
+    # 更新狀態為待審核或失敗
+    update_image_processing_status(image_id, status)
+    
+    # 儲存待審核結果到 S3
+    pending_key = f"pending_review/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
+    with stage_timer('s3_result_write'):
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=pending_key,
+            Body=json.dumps({
+                'session_id': session_id,
+                'image_id': image_id,
+                'filename': filename,
+                'processed_at': datetime.now().isoformat(),
+                'processing_mode': 'human_review',
+                'status': status,
+                'claude_result': claude_result
+            }, indent=2, ensure_ascii=False),
+            ContentType='application/json'
+        )
+    
+    return {
+        'success': claude_result['success'],
+        'status': status,
+        'image_preprocessing': preprocessed['report'],
+        'claude_result': claude_result,
+        'pending_key': pending_key
+    }
+
+# 非同步處理工作池
+# 上傳先存到 S3 並標記為 queued，由背景執行緒從 S3 讀回圖片後執行相同的處理流程
+job_queue = queue.Queue(maxsize=JOB_QUEUE_MAX_DEPTH)
+job_stats = {'submitted': 0, 'rejected': 0, 'running': 0, 'succeeded': 0, 'failed': 0}
+job_stats_lock = threading.Lock()
+job_workers = []
+job_workers_lock = threading.Lock()
+
+def start_job_workers():
+    """啟動背景工作執行緒（只在第一次提交工作時啟動）"""
+    with job_workers_lock:
+        if job_workers:
+            return
+        for index in range(JOB_WORKER_COUNT):
+            worker = threading.Thread(target=job_worker_loop, name=f'ocr-job-{index}', daemon=True)
+            worker.start()
+            job_workers.append(worker)
+        print(f"🧵 已啟動 {JOB_WORKER_COUNT} 個背景處理執行緒，佇列上限 {JOB_QUEUE_MAX_DEPTH}")
+
+def submit_processing_job(job):
+    """
+    提交處理工作，佇列已滿時回傳 False（設定持久化佇列時改送到該佇列，由 worker.py 處理）
+    漸進模式只在沒有持久化佇列時使用（見 is_progressive_request），所以一律在本行程執行
+    """
+    if durable_job_queue is not None:
+        try:
+            durable_job_queue.send(job)
+        except Exception as e:
+            print(f"❌ 工作佇列寫入失敗: {str(e)}")
+            with job_stats_lock:
+                job_stats['rejected'] += 1
+            return False
+        with job_stats_lock:
+            job_stats['submitted'] += 1
+        return True
+    
+    start_job_workers()
+    try:
+        job_queue.put_nowait(job)
+    except queue.Full:
+        with job_stats_lock:
+            job_stats['rejected'] += 1
+        return False
+    
+    with job_stats_lock:
+        job_stats['submitted'] += 1
+    return True
+
+def execute_processing_job(job):
+    """執行一個處理工作，回傳是否成功（批次工作以 batch_ 路由標籤執行，排程優先權較低）"""
+    route = f"{'batch' if job.get('batch_id') else 'job'}_{job['processing_mode']}"
+    with progress_scope(job['image_id'], job.get('batch_id'), progressive=job.get('progressive', False)):
+        return run_with_metrics_route(route, run_processing_job, job)
+
+def run_processing_job(job):
+    s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=job['s3_key'])
+    file_data = s3_response['Body'].read()
+    
+    if job['processing_mode'] == 'automatic' and is_pdf_file(file_data):
+        result = run_pdf_pipeline(
+            job['image_id'], job['session_id'], job['filename'], file_data, job['s3_key'],
+            voting_mode=job.get('voting_mode')
+        )
+    elif job['processing_mode'] == 'automatic':
+        result = run_automatic_pipeline(
+            job['image_id'], job['session_id'], job['filename'], file_data, voting_mode=job.get('voting_mode')
+        )
+    else:
+        result = run_human_review_pipeline(job['image_id'], job['session_id'], job['filename'], file_data)
+    
+    return result['success']
+
+def job_worker_loop():
+    while True:
+        job = job_queue.get()
+        with job_stats_lock:
+            job_stats['running'] += 1
+        
+        try:
+            print(f"🧵 開始處理工作: {job['image_id']} ({job['processing_mode']})")
+            succeeded = execute_processing_job(job)
+        except Exception as e:
+            print(f"❌ 背景處理失敗 {job['image_id']}: {str(e)}")
+            update_image_processing_status(job['image_id'], 'failed')
+            succeeded = False
+        finally:
+            with job_stats_lock:
+                job_stats['running'] -= 1
+            job_queue.task_done()
+        
+        with job_stats_lock:
+            job_stats['succeeded' if succeeded else 'failed'] += 1
+
+def job_queue_is_full():
+    return durable_job_queue is None and job_queue.full()
+
+def get_job_pool_stats():
+    """工作池大小、佇列深度與累計統計"""
+    with job_stats_lock:
+        stats = dict(job_stats)
+    if durable_job_queue is not None:
+        return {
+            'backend': durable_job_queue.name,
+            **durable_job_queue.depth(),
+            'submitted': stats['submitted'],
+            'rejected': stats['rejected']
+        }
+    return {
+        'backend': 'thread',
+        'workers': JOB_WORKER_COUNT,
+        'alive_workers': sum(1 for worker in job_workers if worker.is_alive()),
+        'queue_depth': job_queue.qsize(),
+        'queue_capacity': JOB_QUEUE_MAX_DEPTH,
+        **stats
+    }
+
+class SQLiteJobQueue:
+    """
+    本機持久化工作佇列（開發與測試用），語意與 SQS 相同：
+    接收後在 visibility timeout 內不可見，未刪除則重新出現；接收次數超過上限移到 dead_letters
+    """
+    name = 'sqlite'
     
-    # 準備所有任務
-    tasks = [
-        # Claude Sonnet 4 跑兩次
-        (CLAUDE_SONNET_MODEL_ID, 1),
-        (CLAUDE_SONNET_MODEL_ID, 2),
-        # Claude 3 Haiku 跑兩次
-        (CLAUDE_HAIKU_MODEL_ID, 1),
-        (CLAUDE_HAIKU_MODEL_ID, 2)
-    ]
+    def __init__(self, path, visibility_timeout, max_receives):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_receives = max_receives
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id TEXT PRIMARY KEY, body TEXT NOT NULL, created_at REAL NOT NULL, '
+                'visible_at REAL NOT NULL, receive_count INTEGER NOT NULL DEFAULT 0, receipt TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS dead_letters ('
+                'id TEXT PRIMARY KEY, body TEXT NOT NULL, receive_count INTEGER NOT NULL, '
+                'error TEXT, failed_at REAL NOT NULL)'
+            )
     
-    results = []
+    def _connect(self):
+        # 每次操作使用新連線，可在多執行緒與多行程之間安全共用
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
     
-    # 依序執行每個任務
-    for model_id, run_number in tasks:
-        print(f"🤖 執行 {model_id} - 第 {run_number} 次...")
-        result = process_with_claude_model(image_data, model_id, run_number)
-        results.append(result)
+    def send(self, job):
+        message_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO messages (id, body, created_at, visible_at) VALUES (?, ?, ?, ?)',
+                (message_id, json.dumps(job, ensure_ascii=False), now, now)
+            )
+        return message_id
     
-    # 分析結果並投票
-    voting_result = analyze_and_vote(results)
+    def receive(self, max_messages=1):
+        now = time.time()
+        received = []
+        expired_jobs = []
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT id, body, receive_count FROM messages WHERE visible_at <= ? '
+                    'ORDER BY created_at LIMIT ?',
+                    (now, max_messages)
+                ).fetchall()
+                for message_id, body, receive_count in rows:
+                    if receive_count >= self.max_receives:
+                        # 前幾次接收的 worker 未完成也未回報（例如中途終止），直接移到 dead-letter
+                        self._move_to_dead_letter(conn, message_id, body, receive_count, '超過最大接收次數')
+                        expired_jobs.append(json.loads(body))
+                        continue
+                    receipt = str(uuid.uuid4())
+                    conn.execute(
+                        'UPDATE messages SET visible_at = ?, receive_count = receive_count + 1, receipt = ? WHERE id = ?',
+                        (now + self.visibility_timeout, receipt, message_id)
+                    )
+                    received.append({
+                        'message_id': message_id,
+                        'receipt': receipt,
+                        'receive_count': receive_count + 1,
+                        'job': json.loads(body)
+                    })
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        for job in expired_jobs:
+            mark_dead_lettered_job(job)
+        return received
     
-    return {
-        "individual_results": results,
-        "voting_result": voting_result,
-        "summary": generate_summary(results, voting_result)
-    }
+    def delete(self, message):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM messages WHERE id = ? AND receipt = ?', (message['message_id'], message['receipt']))
+    
+    def release(self, message, delay_seconds=0):
+        """讓訊息在 delay_seconds 後重新可見（重試）"""
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE messages SET visible_at = ? WHERE id = ? AND receipt = ?',
+                (time.time() + delay_seconds, message['message_id'], message['receipt'])
+            )
+    
+    def extend_visibility(self, message):
+        """工作仍在處理中：把訊息的不可見時間延長一個 visibility timeout（receipt 已失效時不影響）"""
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE messages SET visible_at = ? WHERE id = ? AND receipt = ?',
+                (time.time() + self.visibility_timeout, message['message_id'], message['receipt'])
+            )
+    
+    def dead_letter(self, message, error):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT body, receive_count FROM messages WHERE id = ?', (message['message_id'],)).fetchone()
+                if row:
+                    self._move_to_dead_letter(conn, message['message_id'], row[0], row[1], error)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    
+    def _move_to_dead_letter(self, conn, message_id, body, receive_count, error):
+        conn.execute(
+            'INSERT OR REPLACE INTO dead_letters (id, body, receive_count, error, failed_at) VALUES (?, ?, ?, ?, ?)',
+            (message_id, body, receive_count, error, time.time())
+        )
+        conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+    
+    def depth(self):
+        now = time.time()
+        with self._connect() as conn:
+            visible = conn.execute('SELECT COUNT(*) FROM messages WHERE visible_at <= ?', (now,)).fetchone()[0]
+            in_flight = conn.execute('SELECT COUNT(*) FROM messages WHERE visible_at > ?', (now,)).fetchone()[0]
+            dead = conn.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+        return {'queue_depth': visible, 'in_flight': in_flight, 'dead_letter_depth': dead}
 
-def analyze_and_vote(results):
-    """分析結果並進行投票"""
-    print("📊 分析結果並進行投票...")
+class SQSJobQueue:
+    """
+    Amazon SQS 工作佇列
+    建議在佇列上設定 redrive policy (maxReceiveCount = JOB_MAX_RECEIVES) 指向 JOB_DEAD_LETTER_SQS_URL
+    """
+    name = 'sqs'
     
-    successful_results = [r for r in results if r.get('success')]
+    def __init__(self, queue_url, dead_letter_url, visibility_timeout, max_receives, wait_seconds=20,
+                 depth_cache_seconds=JOB_QUEUE_DEPTH_CACHE_SECONDS):
+        self.queue_url = queue_url
+        self.dead_letter_url = dead_letter_url
+        self.visibility_timeout = visibility_timeout
+        self.max_receives = max_receives
+        self.wait_seconds = wait_seconds
+        self.depth_cache_seconds = depth_cache_seconds
+        self.depth_lock = threading.Lock()
+        self.cached_depth = None
+        self.cached_depth_at = 0.0
+        self.client = aws_session.client('sqs')
     
-    if not successful_results:
-        print("❌ 所有模型都處理失敗")
-        return {
-            "error": "所有模型都處理失敗",
-            "final_result": {},
-            "vote_details": {},
-            "successful_models": 0,
-            "total_models": len(results)
-        }
+    def send(self, job):
+        response = self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job, ensure_ascii=False))
+        return response['MessageId']
     
-    print(f"✅ {len(successful_results)}/{len(results)} 個模型處理成功")
+    def receive(self, max_messages=1):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=self.wait_seconds,
+            VisibilityTimeout=self.visibility_timeout,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        return [{
+            'message_id': message['MessageId'],
+            'receipt': message['ReceiptHandle'],
+            'receive_count': int(message['Attributes'].get('ApproximateReceiveCount', 1)),
+            'job': json.loads(message['Body'])
+        } for message in response.get('Messages', [])]
     
-    # 收集所有欄位的值
-    field_votes = defaultdict(list)
+    def delete(self, message):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['receipt'])
     
-    for result in successful_results:
-        data = result.get('extracted_data', {})
-        if not data:
-            print(f"⚠️ 模型 {result.get('model', 'unknown')} 沒有提取到資料")
-            continue
-        
-        # 調試：打印每個模型提取的資料結構
-        print(f"🔍 模型 {result.get('model', 'unknown')} 提取的資料:")
-        for section, content in data.items():
-            if isinstance(content, dict):
-                non_empty_fields = [k for k, v in content.items() if v]
-                print(f"  - {section}: {len(content)} 個欄位, {len(non_empty_fields)} 個有值")
-            else:
-                print(f"  - {section}: {type(content)}")
-        
-        collect_field_votes(data, field_votes, result['model'], result['run_number'])
+    def release(self, message, delay_seconds=0):
+        self.client.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message['receipt'],
+            VisibilityTimeout=int(delay_seconds)
+        )
     
-    if not field_votes:
-        print("❌ 沒有收集到任何欄位資料")
-        return {
-            "error": "沒有收集到任何欄位資料",
-            "final_result": {},
-            "vote_details": {},
-            "successful_models": len(successful_results),
-            "total_models": len(results)
+    def extend_visibility(self, message):
+        self.client.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message['receipt'],
+            VisibilityTimeout=self.visibility_timeout
+        )
+    
+    def dead_letter(self, message, error):
+        if self.dead_letter_url:
+            self.client.send_message(
+                QueueUrl=self.dead_letter_url,
+                MessageBody=json.dumps({**message['job'], 'error': error}, ensure_ascii=False)
+            )
+        self.delete(message)
+    
+    def depth(self):
+        """佇列深度（ApproximateNumberOfMessages 本身就是近似值），在 depth_cache_seconds 內重複使用上次的結果"""
+        with self.depth_lock:
+            now = time.monotonic()
+            if self.cached_depth is None or now - self.cached_depth_at >= self.depth_cache_seconds:
+                self.cached_depth = self._fetch_depth()
+                self.cached_depth_at = now
+            return dict(self.cached_depth)
+    
+    def _fetch_depth(self):
+        attributes = self.client.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        result = {
+            'queue_depth': int(attributes.get('ApproximateNumberOfMessages', 0)),
+            'in_flight': int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0))
         }
+        if self.dead_letter_url:
+            dead_attributes = self.client.get_queue_attributes(
+                QueueUrl=self.dead_letter_url,
+                AttributeNames=['ApproximateNumberOfMessages']
+            )['Attributes']
+            result['dead_letter_depth'] = int(dead_attributes.get('ApproximateNumberOfMessages', 0))
+        return result
+
+def create_durable_job_queue():
+    """根據 JOB_QUEUE_BACKEND 建立持久化工作佇列，thread 模式回傳 None"""
+    if JOB_QUEUE_BACKEND == 'sqlite':
+        return SQLiteJobQueue(JOB_QUEUE_SQLITE_PATH, JOB_VISIBILITY_TIMEOUT_SECONDS, JOB_MAX_RECEIVES)
+    if JOB_QUEUE_BACKEND == 'sqs':
+        return SQSJobQueue(JOB_QUEUE_SQS_URL, JOB_DEAD_LETTER_SQS_URL, JOB_VISIBILITY_TIMEOUT_SECONDS, JOB_MAX_RECEIVES)
+    return None
+
+durable_job_queue = create_durable_job_queue()
+
+def mark_dead_lettered_job(job):
+    """工作移到 dead-letter 後的狀態記錄：圖片標記為 failed，批次工作計入失敗數"""
+    update_image_processing_status(job['image_id'], 'failed')
+    if job.get('batch_id'):
+        record_batch_job_outcome(job['batch_id'], job['image_id'], False)
+
+@contextlib.contextmanager
+def visibility_heartbeat(job_queue_backend, message, interval=None):
+    """工作執行期間由背景執行緒定期延長訊息的 visibility timeout，避免長時間的 PDF 工作被重複投遞"""
+    interval = JOB_HEARTBEAT_INTERVAL_SECONDS if interval is None else interval
+    stopped = threading.Event()
     
-    # 對每個欄位進行投票
-    final_result = {}
-    vote_details = {}
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                job_queue_backend.extend_visibility(message)
+            except Exception as e:
+                print(f"⚠️ 延長工作 {message['job'].get('image_id')} 的 visibility timeout 失敗: {str(e)}")
     
-    for field_path, votes in field_votes.items():
-        winner, vote_detail = vote_for_field(votes)
-        set_nested_field(final_result, field_path, winner)
-        vote_details[field_path] = vote_detail
+    heartbeat = threading.Thread(target=beat, name='job-heartbeat', daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        heartbeat.join()
+
+def handle_queue_message(job_queue_backend, message):
+    """
+    處理一則佇列訊息：成功則刪除；失敗則以指數退避重新排隊，
+    接收次數達到佇列的 max_receives 後移到 dead-letter 並標記為 failed
+    """
+    job = message['job']
+    try:
+        with visibility_heartbeat(job_queue_backend, message):
+            succeeded = execute_processing_job(job)
+        error = None if succeeded else '處理流程回傳失敗'
+    except Exception as e:
+        succeeded = False
+        error = str(e)
     
-    print(f"✅ 投票完成，處理了 {len(vote_details)} 個欄位")
+    if succeeded:
+        job_queue_backend.delete(message)
+        if job.get('batch_id'):
+            record_batch_job_outcome(job['batch_id'], job['image_id'], True)
+        return 'succeeded'
     
-    return {
-        "final_result": final_result,
-        "vote_details": vote_details,
-        "successful_models": len(successful_results),
-        "total_models": len(results)
-    }
+    if message['receive_count'] >= job_queue_backend.max_receives:
+        print(f"☠️ 工作 {job['image_id']} 重試 {message['receive_count']} 次仍失敗，移到 dead-letter: {error}")
+        job_queue_backend.dead_letter(message, error)
+        mark_dead_lettered_job(job)
+        return 'dead_lettered'
+    
+    delay = JOB_RETRY_BASE_DELAY_SECONDS * (2 ** (message['receive_count'] - 1))
+    print(f"🔁 工作 {job['image_id']} 失敗 ({error})，{delay} 秒後重試")
+    update_image_processing_status(job['image_id'], 'queued')
+    job_queue_backend.release(message, delay_seconds=delay)
+    return 'retried'
 
-def collect_field_votes(data, field_votes, model, run_number, prefix=""):
-    """收集欄位投票"""
-    for key, value in data.items():
-        field_path = f"{prefix}.{key}" if prefix else key
-        
-        if isinstance(value, dict):
-            collect_field_votes(value, field_votes, model, run_number, field_path)
-        elif isinstance(value, list):
-            # 對於陣列，轉換為字串進行投票
-            field_votes[field_path].append({
-                'value': json.dumps(value, ensure_ascii=False),
-                'model': model,
-                'run': run_number
-            })
+# 批次上傳
+# 多個檔案或 ZIP 內的檔案逐一串流到 S3，元數據以 batch_writer 寫入，處理工作以 BATCH_MAX_PARALLEL 並行執行
+# 批次進度記錄在 DynamoDB（record_type = batch），由處理結果以原子計數更新
+
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_MAX_PARALLEL, thread_name_prefix='batch')
+
+class BatchUploadRequest(Request):
+    """批次上傳路由使用較大的請求大小上限，其他路由維持 MAX_CONTENT_LENGTH"""
+    
+    @property
+    def max_content_length(self):
+        if self.path == '/api/batches':
+            return BATCH_MAX_UPLOAD_MB * 1024 * 1024
+        return super().max_content_length
+
+app.request_class = BatchUploadRequest
+
+def iter_zip_entries(archive):
+    """
+    逐一產生 ZIP 項目的 (檔名, 串流, 大小, 略過原因)；不信任標頭的 file_size：
+    每個項目最多讀取單檔上傳上限 (MAX_CONTENT_LENGTH) + 1 bytes，超過即略過，
+    解壓縮總量超過 BATCH_MAX_UNCOMPRESSED_MB 或項目數超過 BATCH_MAX_ZIP_ENTRIES 時停止讀取其餘項目
+    """
+    entry_limit = app.config['MAX_CONTENT_LENGTH']
+    remaining = BATCH_MAX_UNCOMPRESSED_MB * 1024 * 1024
+    entries = 0
+    for info in archive.infolist():
+        name = os.path.basename(info.filename)
+        if info.is_dir() or not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+            continue
+        entries += 1
+        if entries > BATCH_MAX_ZIP_ENTRIES:
+            yield name, None, 0, f'ZIP 項目超過上限 {BATCH_MAX_ZIP_ENTRIES} 個，其餘項目未讀取'
+            return
+        if info.file_size > entry_limit:
+            yield name, None, 0, f'檔案超過單檔上限 {entry_limit // (1024 * 1024)}MB'
+            continue
+        with archive.open(info) as stream:
+            data = stream.read(min(entry_limit, remaining) + 1)
+        if len(data) > entry_limit:
+            yield name, None, 0, f'檔案超過單檔上限 {entry_limit // (1024 * 1024)}MB'
+            continue
+        if len(data) > remaining:
+            yield name, None, 0, f'ZIP 解壓縮總量超過上限 {BATCH_MAX_UNCOMPRESSED_MB}MB，其餘項目未讀取'
+            return
+        remaining -= len(data)
+        yield name, io.BytesIO(data), len(data), None
+
+def iter_batch_files(files):
+    """逐一產生 (檔名, 串流, 大小, 略過原因)；ZIP 檔逐一以有上限的讀取取出其中的項目，不會把整個壓縮檔讀入記憶體"""
+    for file in files:
+        filename = file.filename or ''
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                yield from iter_zip_entries(archive)
         else:
-            field_votes[field_path].append({
-                'value': str(value) if value else "",
-                'model': model,
-                'run': run_number
-            })
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            yield filename, file.stream, size, None
 
-def vote_for_field(votes):
-    """對單一欄位進行投票"""
-    if not votes:
-        return "", {"winner": "", "votes": [], "confidence": 0}
+def create_batch(files, processing_mode, voting_mode=None):
+    """上傳批次中的所有檔案並排入處理，回傳批次摘要"""
+    batch_id = str(uuid.uuid4())
+    started = time.monotonic()
+    prefix = f"batch_uploads/{datetime.now().strftime('%Y/%m/%d')}/{batch_id}"
+    jobs = []
+    skipped = []
+    upload_failed = []
+    uploaded_bytes = 0
     
-    # 統計投票
-    vote_counts = Counter(vote['value'] for vote in votes)
+    with dynamodb_table.batch_writer() as writer:
+        for filename, stream, size, skip_reason in iter_batch_files(files):
+            if skip_reason:
+                skipped.append({'filename': filename, 'reason': skip_reason})
+                continue
+            safe_filename = secure_filename(filename)
+            if len(jobs) >= BATCH_MAX_FILES:
+                skipped.append({'filename': filename, 'reason': f'超過批次上限 {BATCH_MAX_FILES} 個檔案'})
+                continue
+            if safe_filename and processing_mode != 'automatic' and is_pdf_filename(safe_filename):
+                skipped.append({'filename': filename, 'reason': PDF_HUMAN_REVIEW_ERROR})
+                continue
+            if not safe_filename or not allowed_file(safe_filename, allow_pdf=processing_mode == 'automatic'):
+                skipped.append({'filename': filename, 'reason': '不支援的檔案類型'})
+                continue
+            
+            session_id = str(uuid.uuid4())
+            s3_key = f"{prefix}/{session_id}/{safe_filename}"
+            content_type = mimetypes.guess_type(safe_filename)[0] or 'application/octet-stream'
+            try:
+                with stage_timer('s3_upload'):
+                    s3_client.upload_fileobj(stream, S3_BUCKET, s3_key, ExtraArgs={
+                        'ContentType': content_type,
+                        'Metadata': {
+                            'session_id': session_id,
+                            'batch_id': batch_id,
+                            'processing_mode': processing_mode,
+                            'original_filename': safe_filename
+                        }
+                    })
+            except Exception as e:
+                print(f"❌ 批次檔案上傳失敗 {safe_filename}: {str(e)}")
+                upload_failed.append({'filename': safe_filename, 'error': str(e)})
+                continue
+            
+            item = build_image_metadata_item(safe_filename, s3_key, size, content_type, session_id)
+            item.update({'processing_status': 'queued', 'batch_id': batch_id})
+            writer.put_item(Item=item)
+            uploaded_bytes += size
+            publish_progress('upload_stored', {
+                'image_id': item['id'],
+                'batch_id': batch_id,
+                'filename': safe_filename,
+                's3_key': s3_key,
+                'file_size': size
+            }, topics=[image_topic(item['id']), batch_topic(batch_id)])
+            jobs.append({
+                'image_id': item['id'],
+                'session_id': session_id,
+                'filename': safe_filename,
+                's3_key': s3_key,
+                'processing_mode': processing_mode,
+                'voting_mode': voting_mode,
+                'batch_id': batch_id
+            })
     
-    # 找出最高票數
-    winner = vote_counts.most_common(1)[0][0]
-    winner_count = vote_counts[winner]
+    upload_seconds = time.monotonic() - started
+    timestamp = datetime.now().isoformat()
+    dynamodb_table.put_item(Item={
+        'id': batch_id,
+        'record_type': 'batch',
+        'timestamp': timestamp,
+        'processing_mode': processing_mode,
+        'total_files': len(jobs) + len(skipped) + len(upload_failed),
+        'uploaded_count': len(jobs),
+        'uploaded_bytes': uploaded_bytes,
+        'skipped': skipped,
+        'upload_failed': upload_failed,
+        'succeeded_count': 0,
+        'failed_count': 0,
+        'failed_image_ids': [],
+        'upload_seconds': Decimal(str(round(upload_seconds, 3))),
+        'started_epoch': Decimal(str(round(time.time(), 3))),
+        'created_at': timestamp,
+        'updated_at': timestamp
+    })
     
-    # 計算信心度
-    confidence = winner_count / len(votes)
+    for job in jobs:
+        if durable_job_queue is not None:
+            if not submit_processing_job(job):
+                update_image_processing_status(job['image_id'], 'failed')
+                record_batch_job_outcome(batch_id, job['image_id'], False)
+        else:
+            batch_executor.submit(run_batch_job, job)
     
-    return winner, {
-        "winner": winner,
-        "votes": vote_counts,
-        "confidence": confidence,
-        "details": votes
+    return {
+        'batch_id': batch_id,
+        'total_files': len(jobs) + len(skipped) + len(upload_failed),
+        'uploaded': len(jobs),
+        'skipped': skipped,
+        'upload_failed': upload_failed,
+        'uploaded_bytes': uploaded_bytes,
+        'upload_seconds': round(upload_seconds, 3)
     }
 
-def set_nested_field(obj, field_path, value):
-    """設置嵌套欄位值"""
-    keys = field_path.split('.')
-    current = obj
-    
-    for key in keys[:-1]:
-        if key not in current:
-            current[key] = {}
-        current = current[key]
-    
-    # 處理陣列值
-    final_key = keys[-1]
-    if value.startswith('[') and value.endswith(']'):
-        try:
-            current[final_key] = json.loads(value)
-        except:
-            current[final_key] = value
-    else:
-        current[final_key] = value
+def run_batch_job(job):
+    """在 batch_executor 中處理一個批次檔案並更新批次進度"""
+    try:
+        succeeded = execute_processing_job(job)
+    except Exception as e:
+        print(f"❌ 批次處理失敗 {job['image_id']}: {str(e)}")
+        update_image_processing_status(job['image_id'], 'failed')
+        succeeded = False
+    record_batch_job_outcome(job['batch_id'], job['image_id'], succeeded)
+    return succeeded
 
-def generate_summary(individual_results, voting_result):
-    """生成摘要報告"""
-    successful = len([r for r in individual_results if r.get('success')])
-    total = len(individual_results)
+def record_batch_job_outcome(batch_id, image_id, succeeded):
+    """以原子計數更新批次進度並發布 batch_progress 事件"""
+    values = {
+        ':one': 1,
+        ':updated_at': datetime.now().isoformat(),
+        ':updated_epoch': Decimal(str(round(time.time(), 3)))
+    }
+    if succeeded:
+        update_expression = "ADD succeeded_count :one SET updated_at = :updated_at, updated_epoch = :updated_epoch"
+    else:
+        update_expression = ("ADD failed_count :one SET updated_at = :updated_at, updated_epoch = :updated_epoch, "
+                             "failed_image_ids = list_append(if_not_exists(failed_image_ids, :empty), :image_ids)")
+        values.update({':empty': [], ':image_ids': [image_id]})
+    try:
+        response = dynamodb_table.update_item(
+            Key={'id': batch_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+    except Exception as e:
+        print(f"❌ 更新批次進度錯誤 {batch_id}: {str(e)}")
+        return
     
-    model_performance = {}
-    for result in individual_results:
-        model_name = result['model'].split('.')[-1]  # 簡化模型名稱
-        if model_name not in model_performance:
-            model_performance[model_name] = {'success': 0, 'total': 0}
-        
-        model_performance[model_name]['total'] += 1
-        if result.get('success'):
-            model_performance[model_name]['success'] += 1
+    # 以更新後的計數發布進度，所有檔案都處理完時結束批次的事件串流
+    item = response.get('Attributes', {})
+    uploaded = int(item.get('uploaded_count', 0))
+    finished = int(item.get('succeeded_count', 0)) + int(item.get('failed_count', 0))
+    progress_events.publish(batch_topic(batch_id), 'batch_progress', {
+        'batch_id': batch_id,
+        'image_id': image_id,
+        'succeeded': succeeded,
+        'succeeded_count': int(item.get('succeeded_count', 0)),
+        'failed_count': int(item.get('failed_count', 0)),
+        'uploaded': uploaded,
+        'progress': round(finished / uploaded, 4) if uploaded else 1.0,
+        'status': 'completed' if uploaded and finished >= uploaded else 'processing'
+    }, terminal=bool(uploaded) and finished >= uploaded)
+
+def get_batch_progress(batch_id):
+    """讀取批次記錄並計算進度與處理速度，找不到時回傳 None"""
+    item = dynamodb_table.get_item(Key={'id': batch_id}).get('Item')
+    if not item or item.get('record_type') != 'batch':
+        return None
     
-    # 計算投票信心度
-    vote_details = voting_result.get('vote_details', {})
-    avg_confidence = sum(detail['confidence'] for detail in vote_details.values()) / len(vote_details) if vote_details else 0
+    uploaded = int(item['uploaded_count'])
+    succeeded = int(item.get('succeeded_count', 0))
+    failed = int(item.get('failed_count', 0))
+    finished = succeeded + failed
+    completed = finished >= uploaded
+    end_epoch = float(item.get('updated_epoch', item['started_epoch'])) if completed else time.time()
+    elapsed = max(0.001, end_epoch - float(item['started_epoch']))
     
     return {
-        "total_runs": total,
-        "successful_runs": successful,
-        "success_rate": successful / total if total > 0 else 0,
-        "model_performance": model_performance,
-        "average_confidence": avg_confidence,
-        "high_confidence_fields": [field for field, detail in vote_details.items() if detail.get('confidence', 0) >= 0.75],
-        "low_confidence_fields": [field for field, detail in vote_details.items() if detail.get('confidence', 0) < 0.5]
+        'batch_id': batch_id,
+        'status': 'completed' if completed else 'processing',
+        'processing_mode': item['processing_mode'],
+        'total_files': int(item['total_files']),
+        'uploaded': uploaded,
+        'skipped': item.get('skipped', []),
+        'upload_failed': item.get('upload_failed', []),
+        'succeeded': succeeded,
+        'failed': failed,
+        'pending': uploaded - finished,
+        'progress': round(finished / uploaded, 4) if uploaded else 1.0,
+        'failed_image_ids': item.get('failed_image_ids', []),
+        'upload_seconds': float(item['upload_seconds']),
+        'upload_throughput_mb_per_second': round(int(item['uploaded_bytes']) / 1024 / 1024 / max(0.001, float(item['upload_seconds'])), 3),
+        'elapsed_seconds': round(elapsed, 1),
+        'throughput_per_minute': round(finished / elapsed * 60, 2),
+        'created_at': item['created_at'],
+        'updated_at': item['updated_at']
     }
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint for load balancers and monitoring"""
+# 區塊式 OCR
+# 把表單切成數個區域（使用者選取或固定版面），各區域以只包含該區塊欄位的提示詞並行提取，最後合併成標準結構
+
+def normalize_block(block, index):
+    """統一各頁面送來的區塊格式 (type/label 或 suggested_type/suggested_label)"""
+    coordinates = block.get('coordinates') or {}
+    return {
+        'id': block.get('id', index + 1),
+        'type': block.get('type') or block.get('suggested_type') or 'general',
+        'label': block.get('label') or block.get('suggested_label') or f"區塊 {index + 1}",
+        'coordinates': {key: float(coordinates[key]) for key in ('x', 'y', 'width', 'height')}
+    }
+
+def get_vet_form_layout_blocks():
+    """固定版面區塊（auto-detect 頁面的建議區塊格式）"""
+    return [
+        {
+            'id': index + 1,
+            'coordinates': dict(block['coordinates']),
+            'suggested_type': block['type'],
+            'suggested_label': block['label'],
+            'confidence': 1.0,
+            'text_preview': '、'.join(VET_FORM_FIELDS[field] for field in VET_FORM_SECTIONS[block['type']][:4])
+        }
+        for index, block in enumerate(VET_FORM_BLOCK_LAYOUT)
+    ]
+
+def get_block_sections(block_type):
+    if block_type in VET_FORM_SECTIONS:
+        return [block_type]
+    return BLOCK_TYPE_SECTIONS.get(block_type, list(VET_FORM_SECTIONS))
+
+def crop_image_block(image, coordinates, padding_percent=None):
+    """依百分比座標（含邊界緩衝）裁切區塊，回傳 JPEG bytes"""
+    if padding_percent is None:
+        padding_percent = BLOCK_CROP_PADDING_PERCENT
+    width, height = image.size
+    left = max(0.0, coordinates['x'] - padding_percent)
+    top = max(0.0, coordinates['y'] - padding_percent)
+    right = min(100.0, coordinates['x'] + coordinates['width'] + padding_percent)
+    bottom = min(100.0, coordinates['y'] + coordinates['height'] + padding_percent)
+    box = (int(width * left / 100), int(height * top / 100), int(width * right / 100), int(height * bottom / 100))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        raise ValueError(f"區塊範圍無效: {coordinates}")
+    
+    crop = image.crop(box)
+    crop.thumbnail((IMAGE_MAX_LONG_EDGE, IMAGE_MAX_LONG_EDGE))
+    buffer = io.BytesIO()
+    crop.save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def extract_block(block, crop_data):
+    """以只包含該區塊欄位的提示詞提取單一區塊"""
+    sections = get_block_sections(block['type'])
+    started = time.perf_counter()
+    result = {
+        'block_id': block['id'],
+        'block_label': block['label'],
+        'block_type': block['type'],
+        'sections': sections,
+        'crop_bytes': len(crop_data)
+    }
     try:
-        # Test DynamoDB connection
-        dynamodb_table.scan(Limit=1)
-        
-        # Test S3 connection
-        s3_client.list_objects_v2(Bucket=S3_BUCKET, MaxKeys=1)
-        
-        # Test Bedrock connection (use bedrock client instead of bedrock-runtime)
-        bedrock_list_client = aws_session.client('bedrock')
-        bedrock_list_client.list_foundation_models()
-        
-        return jsonify({
-            'status': 'healthy',
-            'timestamp': datetime.now().isoformat(),
-            'version': '1.2.0',
-            'services': {
-                'dynamodb': 'ok',
-                's3': 'ok',
-                'bedrock': 'ok'
-            },
-            'environment': {
-                'region': AWS_REGION,
-                'table': DYNAMODB_TABLE_NAME,
-                'bucket': S3_BUCKET
-            }
-        }), 200
-        
+        tool_config = extraction_tool_config(sections)
+        response = invoke_model(
+            BLOCK_MODEL_ID,
+            get_section_extraction_prompt(sections),
+            crop_data,
+            {"maxTokens": BLOCK_MAX_TOKENS, "temperature": 0.1},
+            tool_config=tool_config
+        )
+        extracted, _ = parse_model_output(response, tool_config)
+        extracted_data = {
+            section: content for section, content in extracted.items()
+            if section in sections and isinstance(content, dict)
+        }
+        preview = '；'.join(
+            f"{VET_FORM_FIELDS.get(field, field)}: {value}"
+            for content in extracted_data.values()
+            for field, value in content.items() if value
+        )
+        result.update({
+            'success': True,
+            'extracted_data': extracted_data,
+            'original_text': preview,
+            'original_text_preview': preview[:120]
+        })
     except Exception as e:
-        return jsonify({
-            'status': 'unhealthy',
-            'timestamp': datetime.now().isoformat(),
-            'error': str(e),
-            'services': {
-                'dynamodb': 'unknown',
-                's3': 'unknown', 
-                'bedrock': 'unknown'
+        result.update({'success': False, 'error': str(e)})
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000)
+    return result
+
+@timed_stage('block_extraction')
+def run_block_extraction(file_data, blocks, timeout=None):
+    """裁切所有區塊後並行提取，結果順序與 blocks 相同"""
+    if timeout is None:
+        timeout = MODEL_CALL_TIMEOUT_SECONDS
+    
+    image = Image.open(io.BytesIO(file_data))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    
+    route = current_metrics_route()
+    submitted = []
+    for block in blocks:
+        try:
+            crop_data = crop_image_block(image, block['coordinates'])
+        except Exception as e:
+            submitted.append((block, None, str(e)))
+            continue
+        submitted.append((block, model_executor.submit(run_with_metrics_route, route, extract_block, block, crop_data), None))
+    
+    deadline = time.monotonic() + timeout
+    results = []
+    for block, future, error in submitted:
+        if future is not None:
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+                continue
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                error = f"區塊提取逾時 ({timeout:.0f}s)"
+        results.append({
+            'block_id': block['id'],
+            'block_label': block['label'],
+            'block_type': block['type'],
+            'success': False,
+            'error': error
+        })
+    return results
+
+def stitch_block_results(results):
+    """把各區塊的提取結果合併成標準的 basic_info / pet_info / ... 結構（先出現的非空值優先）"""
+    stitched = {section: {field: "" for field in fields} for section, fields in VET_FORM_SECTIONS.items()}
+    for result in results:
+        if not result.get('success'):
+            continue
+        for section, content in result['extracted_data'].items():
+            for field, value in content.items():
+                if field in stitched[section] and value and not stitched[section][field]:
+                    stitched[section][field] = value
+    return stitched
+
+# 依賴服務健康探測
+def probe_dynamodb():
+    dynamodb_table.get_item(Key={'id': '__health_check__'})
+
+def probe_s3():
+    s3_client.head_bucket(Bucket=S3_BUCKET)
+
+def probe_bedrock():
+    bedrock_control_client.list_foundation_models(byProvider='anthropic')
+
+HEALTH_PROBES = {
+    'dynamodb': probe_dynamodb,
+    's3': probe_s3,
+    'bedrock': probe_bedrock
+}
+
+process_started_at = time.monotonic()
+dependency_health = {
+    name: {'status': 'unknown', 'latency_ms': None, 'checked_at': None, 'checked_monotonic': None, 'error': None}
+    for name in HEALTH_PROBES
+}
+dependency_health_lock = threading.Lock()
+health_prober_thread = None
+health_prober_lock = threading.Lock()
+
+def run_dependency_probes():
+    """探測所有依賴服務一次並更新快取狀態"""
+    for name, probe in HEALTH_PROBES.items():
+        started = time.monotonic()
+        try:
+            probe()
+            status, error = 'ok', None
+        except Exception as e:
+            status, error = 'error', str(e)
+        finished = time.monotonic()
+        
+        with dependency_health_lock:
+            dependency_health[name] = {
+                'status': status,
+                'latency_ms': round((finished - started) * 1000, 1),
+                'checked_at': datetime.now().isoformat(),
+                'checked_monotonic': finished,
+                'error': error
+            }
+
+def health_prober_loop():
+    while True:
+        try:
+            run_dependency_probes()
+        except Exception as e:
+            print(f"⚠️ 健康檢查探測錯誤: {str(e)}")
+        time.sleep(HEALTH_PROBE_INTERVAL_SECONDS)
+
+def start_health_prober():
+    """啟動背景健康探測執行緒（第一次查詢 readiness 時啟動）"""
+    global health_prober_thread
+    with health_prober_lock:
+        if health_prober_thread is None or not health_prober_thread.is_alive():
+            health_prober_thread = threading.Thread(target=health_prober_loop, name='health-prober', daemon=True)
+            health_prober_thread.start()
+
+def get_readiness():
+    """根據快取的探測結果計算 readiness，不呼叫任何 AWS API"""
+    start_health_prober()
+    now = time.monotonic()
+    services = {}
+    with dependency_health_lock:
+        for name, state in dependency_health.items():
+            age = None if state['checked_monotonic'] is None else now - state['checked_monotonic']
+            stale = age is None or age > HEALTH_STALE_AFTER_SECONDS
+            services[name] = {
+                'status': 'stale' if stale and state['status'] != 'unknown' else state['status'],
+                'latency_ms': state['latency_ms'],
+                'checked_at': state['checked_at'],
+                'age_seconds': round(age, 1) if age is not None else None,
+                'error': state['error'],
+                'required': name in HEALTH_READY_DEPENDENCIES
             }
-        }), 503
+    ready = all(services[name]['status'] == 'ok' for name in HEALTH_READY_DEPENDENCIES if name in services)
+    return ready, services
+
+@app.route('/health/live')
+def health_live():
+    """Liveness: 只確認行程可回應，不呼叫任何依賴服務"""
+    return jsonify({
+        'status': 'alive',
+        'timestamp': datetime.now().isoformat(),
+        'uptime_seconds': round(time.monotonic() - process_started_at, 1)
+    }), 200
+
+@app.route('/health/ready')
+def health_ready():
+    """Readiness: 由背景探測的快取結果判斷依賴服務是否可用"""
+    ready, services = get_readiness()
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'timestamp': datetime.now().isoformat(),
+        'probe_interval_seconds': HEALTH_PROBE_INTERVAL_SECONDS,
+        'stale_after_seconds': HEALTH_STALE_AFTER_SECONDS,
+        'services': services,
+        'model_circuits': get_circuit_breaker_states()  # 只供觀察，不影響 readiness
+    }), 200 if ready else 503
+
+@app.route('/health')
+def health_check():
+    """Health check endpoint for load balancers and monitoring (served from cached probes)"""
+    ready, services = get_readiness()
+    return jsonify({
+        'status': 'healthy' if ready else 'unhealthy',
+        'timestamp': datetime.now().isoformat(),
+        'version': '1.2.0',
+        'services': {name: state['status'] for name, state in services.items()},
+        'environment': {
+            'region': AWS_REGION,
+            'table': DYNAMODB_TABLE_NAME,
+            'bucket': S3_BUCKET
+        }
+    }), 200 if ready else 503
+
+def collect_runtime_gauges():
+    """快取、工作池與健康探測的即時數值"""
+    gauges = [
+        ('extraction_cache_events_total', {'event': name}, value)
+        for name, value in dict(extraction_cache_stats).items()
+    ]
+    gauges += [
+        ('quorum_voting_events_total', {'event': name}, value)
+        for name, value in dict(quorum_stats).items()
+    ]
+    with extraction_parse_stats_lock:
+        gauges += [
+            ('extraction_parse_total', {'mode': mode, 'outcome': outcome}, value)
+            for (mode, outcome), value in extraction_parse_stats.items()
+        ]
+    with prompt_usage_stats_lock:
+        for (variant, model_id), entry in prompt_usage_stats.items():
+            gauges += [
+                ('extraction_prompt_calls_total', {'variant': variant, 'model': model_id}, entry['calls']),
+                ('extraction_prompt_input_tokens_total', {'variant': variant, 'model': model_id}, entry['input_tokens'])
+            ]
+    date_cache = get_date_normalization_summary()
+    gauges += [
+        ('date_normalization_cache_total', {'event': 'hit'}, date_cache['hits']),
+        ('date_normalization_cache_total', {'event': 'miss'}, date_cache['misses']),
+        ('date_normalization_cache_size', {}, date_cache['size'])
+    ]
+    job_pool = get_job_pool_stats()
+    gauges += [
+        ('job_queue_depth', {'backend': job_pool['backend']}, job_pool['queue_depth']),
+        ('job_running', {'backend': job_pool['backend']}, job_pool.get('running', 0))
+    ]
+    progress = progress_events.snapshot()
+    gauges += [
+        ('progress_event_subscribers', {}, progress['subscribers']),
+        ('progress_event_topics', {}, progress['topics']),
+        ('progress_events_total', {'outcome': 'published'}, progress['published']),
+        ('progress_events_total', {'outcome': 'dropped'}, progress['dropped'])
+    ]
+    with dependency_health_lock:
+        for name, state in dependency_health.items():
+            gauges.append(('dependency_up', {'dependency': name}, 1 if state['status'] == 'ok' else 0))
+            if state['latency_ms'] is not None:
+                gauges.append(('dependency_probe_latency_seconds', {'dependency': name}, state['latency_ms'] / 1000))
+    return gauges
+
+metrics.describe('extraction_cache_events_total', 'counter', 'Extraction cache hits, misses, stores, evictions and errors')
+metrics.describe('quorum_voting_events_total', 'counter', 'Quorum voting requests, tie-breaker calls and calls saved')
+metrics.describe('extraction_parse_total', 'counter', 'Model outputs by output mode and how they were parsed (failed = unusable output)')
+metrics.describe('extraction_prompt_calls_total', 'counter', 'Uncached extraction calls by prompt variant and model')
+metrics.describe('extraction_prompt_input_tokens_total', 'counter', 'Bedrock input tokens of uncached extraction calls by prompt variant and model')
+metrics.describe('date_normalization_cache_total', 'counter', 'Date normalization LRU cache hits and misses')
+metrics.describe('date_normalization_cache_size', 'gauge', 'Distinct date strings held in the date normalization cache')
+metrics.describe('job_queue_depth', 'gauge', 'Async processing jobs waiting in the queue')
+metrics.describe('job_running', 'gauge', 'Async processing jobs currently running in this process')
+metrics.describe('progress_event_subscribers', 'gauge', 'Open SSE progress streams in this process')
+metrics.describe('progress_event_topics', 'gauge', 'Image and batch topics retained by the progress event bus')
+metrics.describe('progress_events_total', 'counter', 'Progress events published, and deliveries dropped because a subscriber queue was full')
+metrics.describe('dependency_up', 'gauge', 'Last background probe result per dependency (1 = ok)')
+metrics.describe('dependency_probe_latency_seconds', 'gauge', 'Last background probe latency per dependency')
+metrics.register_gauges(collect_runtime_gauges)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 格式的延遲、錯誤、節流與 token 用量指標"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Routes
 @app.route('/')
@@ -1099,8 +4701,9 @@ def upload_and_vote():
         s3_key = f"voting_uploads/{session_id}/{secure_filename(file.filename)}"
         s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=file_data, ContentType=file.content_type)
         
-        # 執行多模型投票處理
-        voting_results = run_multi_model_voting(file_data)
+        # 圖片前處理後執行多模型投票處理
+        preprocessed = preprocess_image(file_data)
+        voting_results = run_multi_model_voting(preprocessed['image_data'])
         
         # 儲存結果
         results_key = f"voting_results/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
@@ -1112,146 +4715,200 @@ def upload_and_vote():
                 'filename': secure_filename(file.filename),
                 'processed_at': datetime.now().isoformat(),
                 'voting_results': voting_results
-            }, indent=2, ensure_ascii=False),
+            }, indent=2, ensure_ascii=False, default=form_json_default),
             ContentType='application/json'
         )
         
-        # 準備圖片顯示
-        file_base64 = base64.b64encode(file_data).decode('utf-8')
-        file_type = file.content_type.split('/')[-1]
-        
         return jsonify({
             'success': True,
             'session_id': session_id,
             'filename': secure_filename(file.filename),
-            'image_data': f"data:image/{file_type};base64,{file_base64}",
-            'voting_results': voting_results
+            'image_url': generate_image_url(s3_key),
+            'image_preprocessing': preprocessed['report'],
+            'voting_results': slim_voting_results(voting_results, get_response_fields())
         })
         
     except Exception as e:
         return jsonify({'error': f'處理失敗: {str(e)}'}), 500
 
+def generate_image_url(s3_key):
+    """產生圖片的 S3 預簽名 URL，讓瀏覽器直接從 S3 讀取圖片"""
+    try:
+        return s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+            ExpiresIn=IMAGE_URL_EXPIRES_SECONDS
+        )
+    except Exception as e:
+        print(f"⚠️ Failed to generate presigned URL: {str(e)}")
+        return None
+
+def get_response_fields():
+    """
+    解析 verbose / fields 查詢參數
+    預設不回傳模型原始回應 (raw_response) 與每票明細 (details)，verbose=true 時全部回傳
+    """
+    if (request.args.get('verbose') or '').lower() in ('1', 'true', 'yes'):
+        return {'raw_response', 'details'}
+    return {field for field in (request.args.get('fields') or '').split(',') if field}
+
+def slim_model_result(result, fields):
+    """移除未要求的 raw_response"""
+    if not result or 'raw_response' in fields or 'raw_response' not in result:
+        return result
+    return {key: value for key, value in result.items() if key != 'raw_response'}
+
+def slim_voting_results(voting_results, fields):
+    """移除未要求的 raw_response 與投票 details（不修改原始物件，S3 仍保存完整結果）"""
+    if not voting_results:
+        return voting_results
+    slimmed = dict(voting_results)
+    slimmed['individual_results'] = [slim_model_result(result, fields) for result in voting_results.get('individual_results', [])]
+    voting_result = voting_results.get('voting_result')
+    if voting_result and 'details' not in fields:
+        slimmed['voting_result'] = dict(voting_result)
+        slimmed['voting_result']['vote_details'] = {
+            field_path: {key: value for key, value in detail.items() if key != 'details'}
+            for field_path, detail in voting_result.get('vote_details', {}).items()
+        }
+    return slimmed
+
+def request_flag(name):
+    value = request.form.get(name) or request.args.get(name) or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def is_async_request():
+    """檢查請求是否要求非同步處理 (async=true，progressive=true 也一定是非同步)"""
+    return request_flag('async') or request_flag('progressive')
+
+def is_progressive_request():
+    """
+    檢查請求是否要求漸進式結果 (progressive=true)
+    逐步結果只透過行程內的事件匯流排送出，設定持久化佇列時改為一般非同步工作交給 worker，
+    進度改由 DynamoDB 狀態快照提供
+    """
+    return request_flag('progressive') and durable_job_queue is None
+
+def queue_full_response():
+    """工作無法排入時的 503；持久化佇列只會因寫入失敗而拒絕，回報後端名稱而不是行程內佇列的統計"""
+    if durable_job_queue is not None:
+        return jsonify({
+            'error': '工作佇列暫時無法寫入，請稍後再試',
+            'queue_backend': durable_job_queue.name
+        }), 503, {'Retry-After': '30'}
+    return jsonify({
+        'error': '處理佇列已滿，請稍後再試',
+        'queue_backend': 'thread',
+        'queue_depth': job_queue.qsize(),
+        'queue_capacity': JOB_QUEUE_MAX_DEPTH
+    }), 503, {'Retry-After': '30'}
+
+def enqueue_upload_response(upload, filename, processing_mode, voting_mode=None, progressive=False):
+    """將已儲存的上傳排入工作池並回傳 202（progressive 時附上 poll_url，結果會逐步發布）"""
+    image_id = upload['image_id']
+    update_image_processing_status(image_id, 'queued')
+    
+    queued = submit_processing_job({
+        'image_id': image_id,
+        'session_id': upload['session_id'],
+        'filename': filename,
+        's3_key': upload['s3_key'],
+        'processing_mode': processing_mode,
+        'voting_mode': voting_mode,
+        'progressive': progressive
+    })
+    if not queued:
+        update_image_processing_status(image_id, 'failed')
+        return queue_full_response()
+    
+    return jsonify({
+        'success': True,
+        'session_id': upload['session_id'],
+        'image_id': image_id,
+        'filename': filename,
+        'processing_mode': processing_mode,
+        'status': 'queued',
+        'progressive': progressive,
+        'status_url': f"/api/images/{image_id}/status",
+        'events_url': f"/api/images/{image_id}/events",
+        'poll_url': f"/api/images/{image_id}/progress",
+        'image_url': generate_image_url(upload['s3_key']),
+        's3_key': upload['s3_key']
+    }), 202
+
 @app.route('/process_automatic', methods=['POST'])
 def process_automatic():
-    """路徑1: 全自動處理 - 3個模型投票後直接存入DynamoDB"""
+    """路徑1: 全自動處理 - 3個模型投票後直接存入DynamoDB（async=true 時改為排入工作池，progressive=true 時逐步發布結果；支援多頁 PDF）"""
     if 'file' not in request.files:
         return jsonify({'error': '沒有上傳檔案'}), 400
     
     file = request.files['file']
-    if file.filename == '' or not allowed_file(file.filename):
+    if file.filename == '' or not allowed_file(file.filename, allow_pdf=True):
         return jsonify({'error': '無效的檔案'}), 400
     
+    run_async = is_async_request()
+    progressive = is_progressive_request()
+    if run_async and job_queue_is_full():
+        return queue_full_response()
+    
     try:
         # 讀取和處理檔案
         file_data = file.read()
-        session_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
         
-        # 儲存到 S3
-        s3_key = f"automatic_uploads/{datetime.now().strftime('%Y/%m/%d')}/{session_id}/{filename}"
-        s3_client.put_object(
-            Bucket=S3_BUCKET, 
-            Key=s3_key, 
-            Body=file_data, 
-            ContentType=file.content_type,
-            Metadata={
-                'session_id': session_id,
-                'processing_mode': 'automatic',
-                'original_filename': filename
-            }
-        )
-        
-        # 保存圖片元數據到 DynamoDB
-        image_metadata = save_image_metadata_to_dynamodb(
-            filename=filename,
-            s3_key=s3_key,
-            file_size=len(file_data),
-            content_type=file.content_type,
-            session_id=session_id
-        )
-        
-        if not image_metadata['success']:
-            return jsonify({'error': f'圖片元數據保存失敗: {image_metadata["error"]}'}), 500
-        
-        image_id = image_metadata['image_id']
+        # 儲存到 S3 並保存圖片元數據到 DynamoDB
+        upload = store_upload(file_data, filename, file.content_type, 'automatic', 'automatic_uploads')
+        if not upload['success']:
+            return jsonify({'error': f'圖片元數據保存失敗: {upload["error"]}'}), 500
         
-        # 更新處理狀態為 processing
-        update_image_processing_status(image_id, 'processing')
+        image_id = upload['image_id']
+        session_id = upload['session_id']
         
-        # 執行增強型投票處理 (3個模型)
-        voting_results = run_enhanced_voting_system(file_data)
-        
-        # 調試：打印投票結果結構
-        print("🔍 調試 - 投票結果結構:")
-        if voting_results and 'voting_result' in voting_results:
-            final_result = voting_results['voting_result'].get('final_result', {})
-            print(f"  - final_result 鍵: {list(final_result.keys())}")
-            for section, content in final_result.items():
-                if isinstance(content, dict):
-                    print(f"  - {section}: {list(content.keys())}")
-                else:
-                    print(f"  - {section}: {type(content)}")
+        if run_async:
+            return enqueue_upload_response(upload, filename, 'automatic', request.form.get('voting_mode'), progressive)
         
-        # 檢查投票結果結構
-        if not voting_results or 'voting_result' not in voting_results:
-            update_image_processing_status(image_id, 'failed')
-            return jsonify({'error': '投票處理失敗：無效的結果結構'}), 500
+        if is_pdf_file(file_data):
+            pipeline_result = run_pdf_pipeline(
+                image_id, session_id, filename, file_data, upload['s3_key'], voting_mode=request.form.get('voting_mode')
+            )
+            if not pipeline_result['success']:
+                return jsonify({'error': pipeline_result['error']}), 500
             
-        if 'final_result' not in voting_results['voting_result']:
-            update_image_processing_status(image_id, 'failed')
-            return jsonify({'error': '投票處理失敗：缺少最終結果'}), 500
-        
-        # 計算平均信心度
-        vote_details = voting_results['voting_result'].get('vote_details', {})
-        avg_confidence = sum(detail['confidence'] for detail in vote_details.values()) / len(vote_details) if vote_details else 0
-        
-        # 自動存入 DynamoDB
-        final_result = voting_results['voting_result']['final_result']
-        db_result = save_to_dynamodb(
-            data=final_result,
-            processing_mode='automatic',
-            confidence_score=avg_confidence,
-            human_reviewed=False
-        )
-        
-        # 更新圖片處理狀態
-        if db_result['success']:
-            update_image_processing_status(image_id, 'completed', db_result['record_id'])
-        else:
-            update_image_processing_status(image_id, 'failed')
-        
-        # 儲存處理結果到 S3
-        results_key = f"automatic_results/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=results_key,
-            Body=json.dumps({
+            return jsonify({
+                'success': True,
                 'session_id': session_id,
                 'image_id': image_id,
                 'filename': filename,
-                'processed_at': datetime.now().isoformat(),
                 'processing_mode': 'automatic',
-                'voting_results': voting_results,
-                'dynamodb_result': db_result
-            }, indent=2, ensure_ascii=False),
-            ContentType='application/json'
-        )
+                'document_type': 'pdf',
+                'page_count': pipeline_result['page_count'],
+                'failed_pages': pipeline_result['failed_pages'],
+                'pages': [
+                    dict(page, image_url=generate_image_url(page['page_s3_key']) if page.get('page_s3_key') else None)
+                    for page in pipeline_result['pages']
+                ],
+                'confidence_score': pipeline_result['confidence_score'],
+                's3_key': upload['s3_key']
+            })
         
-        # 準備圖片顯示
-        file_base64 = base64.b64encode(file_data).decode('utf-8')
-        file_type = file.content_type.split('/')[-1]
+        pipeline_result = run_automatic_pipeline(
+            image_id, session_id, filename, file_data, voting_mode=request.form.get('voting_mode')
+        )
+        if not pipeline_result['success']:
+            return jsonify({'error': pipeline_result['error']}), 500
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'image_id': image_id,
             'filename': filename,
-            'image_data': f"data:image/{file_type};base64,{file_base64}",
+            'image_url': generate_image_url(upload['s3_key']),
             'processing_mode': 'automatic',
-            'voting_results': voting_results,
-            'dynamodb_result': db_result,
-            'confidence_score': avg_confidence,
-            's3_key': s3_key
+            'image_preprocessing': pipeline_result['image_preprocessing'],
+            'voting_results': slim_voting_results(pipeline_result['voting_results'], get_response_fields()),
+            'dynamodb_result': pipeline_result['dynamodb_result'],
+            'confidence_score': pipeline_result['confidence_score'],
+            's3_key': upload['s3_key']
         })
         
     except Exception as e:
@@ -1262,100 +4919,391 @@ def process_automatic():
 
 @app.route('/process_human_review', methods=['POST'])
 def process_human_review():
-    """路徑2: 人工審核 - Claude Sonnet 4處理後等待人工確認"""
+    """路徑2: 人工審核 - Claude Sonnet 4處理後等待人工確認（async=true 時改為排入工作池，progressive=true 時逐步發布結果）"""
     if 'file' not in request.files:
         return jsonify({'error': '沒有上傳檔案'}), 400
     
     file = request.files['file']
+    if is_pdf_filename(file.filename):
+        return jsonify({'error': PDF_HUMAN_REVIEW_ERROR}), 400
     if file.filename == '' or not allowed_file(file.filename):
         return jsonify({'error': '無效的檔案'}), 400
     
+    run_async = is_async_request()
+    progressive = is_progressive_request()
+    if run_async and job_queue_is_full():
+        return queue_full_response()
+    
     try:
         # 讀取和處理檔案
         file_data = file.read()
-        session_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
         
-        # 儲存到 S3
-        s3_key = f"human_review_uploads/{datetime.now().strftime('%Y/%m/%d')}/{session_id}/{filename}"
-        s3_client.put_object(
-            Bucket=S3_BUCKET, 
-            Key=s3_key, 
-            Body=file_data, 
-            ContentType=file.content_type,
-            Metadata={
-                'session_id': session_id,
-                'processing_mode': 'human_review',
-                'original_filename': filename
-            }
-        )
+        # 儲存到 S3 並保存圖片元數據到 DynamoDB
+        upload = store_upload(file_data, filename, file.content_type, 'human_review', 'human_review_uploads')
+        if not upload['success']:
+            return jsonify({'error': f'圖片元數據保存失敗: {upload["error"]}'}), 500
         
-        # 保存圖片元數據到 DynamoDB
-        image_metadata = save_image_metadata_to_dynamodb(
-            filename=filename,
-            s3_key=s3_key,
-            file_size=len(file_data),
-            content_type=file.content_type,
-            session_id=session_id
-        )
+        image_id = upload['image_id']
+        session_id = upload['session_id']
         
-        if not image_metadata['success']:
-            return jsonify({'error': f'圖片元數據保存失敗: {image_metadata["error"]}'}), 500
+        if run_async:
+            return enqueue_upload_response(upload, filename, 'human_review', progressive=progressive)
         
-        image_id = image_metadata['image_id']
+        pipeline_result = run_human_review_pipeline(image_id, session_id, filename, file_data)
         
-        # 更新處理狀態為 processing
-        update_image_processing_status(image_id, 'processing')
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'image_id': image_id,
+            'filename': filename,
+            'image_url': generate_image_url(upload['s3_key']),
+            'processing_mode': 'human_review',
+            'status': pipeline_result['status'],
+            'image_preprocessing': pipeline_result['image_preprocessing'],
+            'claude_result': slim_model_result(pipeline_result['claude_result'], get_response_fields()),
+            's3_pending_key': pipeline_result['pending_key'],
+            's3_key': upload['s3_key']
+        })
         
-        # 使用 Claude Sonnet 4 處理
-        claude_result = process_with_claude_latest(file_data, for_human_review=True)
+    except Exception as e:
+        # 如果有 image_id，更新狀態為失敗
+        if 'image_id' in locals():
+            update_image_processing_status(image_id, 'failed')
+        return jsonify({'error': f'人工審核處理失敗: {str(e)}'}), 500
+
+@app.route('/upload_for_blocking', methods=['POST'])
+@app.route('/upload_and_auto_detect', methods=['POST'])
+@app.route('/upload_and_detect', methods=['POST'])
+def upload_for_blocking():
+    """區塊式 OCR 上傳：存到 S3，auto-detect 頁面另外回傳初診表固定版面的建議區塊"""
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': '沒有上傳檔案'}), 400
+    
+    file = request.files['file']
+    if file.filename == '' or not allowed_file(file.filename):
+        return jsonify({'success': False, 'error': '無效的檔案'}), 400
+    
+    try:
+        filename = secure_filename(file.filename)
+        upload = store_upload(file.read(), filename, file.content_type, 'block', 'block_uploads')
+        if not upload['success']:
+            return jsonify({'success': False, 'error': f'圖片元數據保存失敗: {upload["error"]}'}), 500
         
-        if claude_result['success']:
-            # 更新狀態為待審核
-            update_image_processing_status(image_id, 'pending_review')
+        response = {
+            'success': True,
+            'session_id': upload['session_id'],
+            'image_id': upload['image_id'],
+            's3_key': upload['s3_key'],
+            'filename': filename,
+            'image_url': generate_image_url(upload['s3_key'])
+        }
+        if request.path != '/upload_for_blocking':
+            response.update({
+                'auto_blocks': get_vet_form_layout_blocks(),
+                'detection_success': True,
+                'message': '使用動物醫院初診表固定版面'
+            })
+        return jsonify(response)
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'上傳失敗: {str(e)}'}), 500
+
+@app.route('/process_blocks', methods=['POST'])
+@app.route('/process_selected_blocks', methods=['POST'])
+def process_blocks():
+    """區塊式 OCR 處理：並行提取各區塊並合併成標準表單結構（未指定區塊時使用固定版面）"""
+    payload = request.get_json(silent=True) or {}
+    s3_key = payload.get('s3_key') or ''
+    image_id = payload.get('image_id') or ''
+    if not s3_key.startswith('block_uploads/') or not image_id:
+        return jsonify({'success': False, 'error': '無效的 s3_key 或 image_id'}), 400
+    
+    # 上傳時建立的圖片元數據必須對應同一個 s3_key / session_id，避免回傳或更新其他上傳的記錄
+    image_item = dynamodb_table.get_item(Key={'id': image_id}).get('Item')
+    if not image_item or image_item.get('record_type') != 'image_metadata' or image_item.get('s3_key') != s3_key \
+            or (payload.get('session_id') and payload['session_id'] != image_item.get('session_id')):
+        return jsonify({'success': False, 'error': '找不到對應的上傳記錄'}), 404
+    session_id = image_item.get('session_id')
+    
+    raw_blocks = payload.get('blocks') or payload.get('selected_blocks') or VET_FORM_BLOCK_LAYOUT
+    try:
+        blocks = [normalize_block(block, index) for index, block in enumerate(raw_blocks)]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'區塊格式錯誤: {str(e)}'}), 400
+    
+    try:
+        started = time.perf_counter()
+        update_image_processing_status(image_id, 'processing')
+        file_data = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)['Body'].read()
+        results = run_block_extraction(file_data, blocks)
+        successful = sum(1 for result in results if result['success'])
+        stitched_result = stitch_block_results(results)
+        
+        # 與 run_automatic_pipeline 相同：合併結果存入 DynamoDB，圖片記錄改為 completed / failed
+        db_result = {'success': False, 'error': '所有區塊提取失敗'}
+        if successful:
+            db_result = save_to_dynamodb(
+                data=stitched_result,
+                processing_mode='block',
+                confidence_score=successful / len(results),
+                human_reviewed=False,
+                extra_attributes={'session_id': session_id, 'image_id': image_id}
+            )
+        if db_result['success']:
+            update_image_processing_status(image_id, 'completed', db_result['record_id'])
         else:
-            # 更新狀態為失敗
             update_image_processing_status(image_id, 'failed')
         
-        # 儲存待審核結果到 S3
-        pending_key = f"pending_review/{datetime.now().strftime('%Y/%m/%d')}/{session_id}.json"
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=pending_key,
-            Body=json.dumps({
-                'session_id': session_id,
-                'image_id': image_id,
-                'filename': filename,
-                'processed_at': datetime.now().isoformat(),
-                'processing_mode': 'human_review',
-                'status': 'pending_review' if claude_result['success'] else 'failed',
-                'claude_result': claude_result
-            }, indent=2, ensure_ascii=False),
-            ContentType='application/json'
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'image_id': image_id,
+            'ocr_result_id': db_result.get('record_id'),
+            'save_error': db_result.get('error'),
+            'model': BLOCK_MODEL_ID,
+            'results': results,
+            'stitched_result': stitched_result,
+            'summary': {
+                'total': len(results),
+                'total_processed': len(results),
+                'successful': successful,
+                'failed': len(results) - successful,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000)
+            }
+        })
+    
+    except Exception as e:
+        update_image_processing_status(image_id, 'failed')
+        return jsonify({'success': False, 'error': f'區塊處理失敗: {str(e)}'}), 500
+
+@app.route('/api/batches', methods=['POST'])
+def api_create_batch():
+    """批次上傳：多個 files 欄位或 ZIP 壓縮檔，全部存到 S3 後在背景處理，回傳 202 與批次 ID"""
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': '沒有上傳檔案'}), 400
+    
+    processing_mode = request.form.get('processing_mode', 'automatic')
+    if processing_mode not in ('automatic', 'human_review'):
+        return jsonify({'error': f'不支援的 processing_mode: {processing_mode}'}), 400
+    
+    try:
+        batch = create_batch(files, processing_mode, voting_mode=request.form.get('voting_mode'))
+    except zipfile.BadZipFile:
+        return jsonify({'error': '無效的 ZIP 檔案'}), 400
+    except Exception as e:
+        return jsonify({'error': f'批次上傳失敗: {str(e)}'}), 500
+    
+    if not batch['uploaded']:
+        return jsonify({'error': '批次中沒有可處理的檔案', **batch}), 400
+    
+    return jsonify({
+        'success': True,
+        'processing_mode': processing_mode,
+        'status': 'processing',
+        'status_url': f"/api/batches/{batch['batch_id']}",
+        'events_url': f"/api/batches/{batch['batch_id']}/events",
+        **batch
+    }), 202
+
+@app.route('/api/batches/<batch_id>')
+def api_get_batch(batch_id):
+    """批次進度：完成數、失敗數、處理速度"""
+    try:
+        progress = get_batch_progress(batch_id)
+    except Exception as e:
+        return jsonify({'error': f'查詢批次失敗: {str(e)}'}), 500
+    if progress is None:
+        return jsonify({'error': '找不到批次'}), 404
+    return jsonify(convert_decimals_for_json(progress))
+
+@app.route('/api/images/<image_id>/status')
+def api_get_image_status(image_id):
+    """API: 輕量查詢圖片處理狀態（供非同步模式輪詢）"""
+    try:
+        response = dynamodb_table.get_item(
+            Key={'id': image_id},
+            ProjectionExpression='id, record_type, processing_status, updated_at, ocr_result_id'
         )
+        if 'Item' not in response:
+            return jsonify({'error': '圖片不存在'}), 404
         
-        # 準備圖片顯示
-        file_base64 = base64.b64encode(file_data).decode('utf-8')
-        file_type = file.content_type.split('/')[-1]
+        item = response['Item']
+        if item.get('record_type') != 'image_metadata':
+            return jsonify({'error': '無效的圖片記錄'}), 400
         
         return jsonify({
             'success': True,
-            'session_id': session_id,
             'image_id': image_id,
-            'filename': filename,
-            'image_data': f"data:image/{file_type};base64,{file_base64}",
-            'processing_mode': 'human_review',
-            'status': 'pending_review' if claude_result['success'] else 'failed',
-            'claude_result': claude_result,
-            's3_pending_key': pending_key,
-            's3_key': s3_key
+            'processing_status': item.get('processing_status'),
+            'updated_at': item.get('updated_at'),
+            'ocr_result_id': item.get('ocr_result_id')
         })
         
     except Exception as e:
-        # 如果有 image_id，更新狀態為失敗
-        if 'image_id' in locals():
-            update_image_processing_status(image_id, 'failed')
-        return jsonify({'error': f'人工審核處理失敗: {str(e)}'}), 500
+        print(f"❌ Status API error: {str(e)}")
+        return jsonify({'error': f'獲取處理狀態失敗: {str(e)}'}), 500
+
+def image_progress_snapshot(image_id):
+    """圖片目前的處理狀態，回傳 (event, data, terminal)；圖片不存在時回傳 None"""
+    item = dynamodb_table.get_item(
+        Key={'id': image_id},
+        ProjectionExpression='id, record_type, processing_status, updated_at, ocr_result_id'
+    ).get('Item')
+    if not item or item.get('record_type') != 'image_metadata':
+        return None
+    status = item.get('processing_status')
+    return 'status', {
+        'image_id': image_id,
+        'status': status,
+        'ocr_result_id': item.get('ocr_result_id'),
+        'updated_at': item.get('updated_at')
+    }, status in TERMINAL_IMAGE_STATUSES
+
+def batch_progress_snapshot(batch_id):
+    """批次目前的進度，回傳 (event, data, terminal)；批次不存在時回傳 None"""
+    progress = get_batch_progress(batch_id)
+    if progress is None:
+        return None
+    return 'batch_progress', convert_decimals_for_json(progress), progress['status'] == 'completed'
+
+def format_sse_event(record):
+    """轉成 text/event-stream 格式；只有經由事件匯流排的事件有 id（供 Last-Event-ID 續傳）"""
+    lines = [f"id: {record['id']}"] if 'id' in record else []
+    lines.append(f"event: {record['event']}")
+    lines.append(f"data: {json.dumps({**record['data'], 'topic': record['topic']}, ensure_ascii=False, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+def stream_progress_events(snapshots, last_event_id=0):
+    """
+    SSE 串流：先補發保留的事件，再補一次目前狀態（事件可能已過保留期，或由 worker.py 在其他行程發布），
+    之後轉送新事件；所有主題都收到結束事件時關閉。使用持久化佇列時，每次心跳都會重新查詢狀態
+    snapshots: {主題: 回傳 (event, data, terminal) 的函數}
+    """
+    topics = list(snapshots)
+    subscriber, replay = progress_events.subscribe(topics, last_event_id)
+    open_topics = set(topics)
+    last_snapshots = {}
+    
+    def emit(record):
+        if record.get('terminal'):
+            open_topics.discard(record['topic'])
+        return format_sse_event(record)
+    
+    def poll_snapshots():
+        for topic in list(open_topics):
+            try:
+                snapshot = snapshots[topic]()
+            except Exception as e:
+                print(f"⚠️ 讀取進度狀態失敗 {topic}: {str(e)}")
+                continue
+            if snapshot and snapshot != last_snapshots.get(topic):
+                last_snapshots[topic] = snapshot
+                event, data, terminal = snapshot
+                yield emit({'topic': topic, 'event': event, 'data': data, 'terminal': terminal})
+    
+    try:
+        yield f"retry: {int(SSE_HEARTBEAT_SECONDS * 1000)}\n\n"
+        for record in replay:
+            yield emit(record)
+        yield from poll_snapshots()
+        
+        deadline = time.monotonic() + SSE_STREAM_MAX_SECONDS
+        while open_topics and time.monotonic() < deadline:
+            try:
+                record = subscriber.get(timeout=SSE_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                if durable_job_queue is not None:
+                    yield from poll_snapshots()
+                continue
+            yield emit(record)
+    finally:
+        progress_events.unsubscribe(topics, subscriber)
+
+def progress_stream_response(snapshots):
+    """以 text/event-stream 回傳進度串流（關閉 proxy 緩衝）"""
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+    return Response(
+        stream_progress_events(snapshots, last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/images/<image_id>/events')
+def api_image_events(image_id):
+    """SSE: 單一圖片的處理階段事件（upload_stored / status / model_result / vote_complete / dynamodb_saved）"""
+    try:
+        if image_progress_snapshot(image_id) is None:
+            return jsonify({'error': '圖片不存在'}), 404
+    except Exception as e:
+        return jsonify({'error': f'獲取處理狀態失敗: {str(e)}'}), 500
+    return progress_stream_response({image_topic(image_id): functools.partial(image_progress_snapshot, image_id)})
+
+@app.route('/api/images/<image_id>/progress')
+def api_image_progress(image_id):
+    """
+    API: 以輪詢取得處理階段事件（不支援 SSE 的用戶端使用）
+    token 為上次回應的 next_token，只回傳之後的事件；done 為 true 時不需再輪詢
+    """
+    try:
+        token = int(request.args.get('token') or 0)
+    except ValueError:
+        return jsonify({'error': '無效的 token'}), 400
+    
+    try:
+        snapshot = image_progress_snapshot(image_id)
+    except Exception as e:
+        return jsonify({'error': f'獲取處理狀態失敗: {str(e)}'}), 500
+    if snapshot is None:
+        return jsonify({'error': '圖片不存在'}), 404
+    
+    events = progress_events.events_since(image_topic(image_id), token)
+    _, state, terminal = snapshot
+    return jsonify({
+        'success': True,
+        'image_id': image_id,
+        'processing_status': state['status'],
+        'ocr_result_id': state['ocr_result_id'],
+        'events': [
+            {'id': record['id'], 'event': record['event'], 'timestamp': record['timestamp'], 'data': record['data']}
+            for record in events
+        ],
+        'next_token': events[-1]['id'] if events else token,
+        'done': terminal
+    })
+
+@app.route('/api/batches/<batch_id>/events')
+def api_batch_events(batch_id):
+    """SSE: 批次的檔案上傳、各檔案處理階段與 batch_progress 事件"""
+    try:
+        if batch_progress_snapshot(batch_id) is None:
+            return jsonify({'error': '找不到批次'}), 404
+    except Exception as e:
+        return jsonify({'error': f'查詢批次失敗: {str(e)}'}), 500
+    return progress_stream_response({batch_topic(batch_id): functools.partial(batch_progress_snapshot, batch_id)})
+
+@app.route('/api/events')
+def api_events():
+    """SSE: 以一條連線同時觀察多張圖片 (?image_id=a,b,c)，供圖片列表使用"""
+    image_ids = [image_id for value in request.args.getlist('image_id') for image_id in value.split(',') if image_id]
+    if not image_ids:
+        return jsonify({'error': '缺少 image_id'}), 400
+    if len(image_ids) > SSE_MAX_TOPICS_PER_STREAM:
+        return jsonify({'error': f'一次最多觀察 {SSE_MAX_TOPICS_PER_STREAM} 張圖片'}), 400
+    return progress_stream_response({
+        image_topic(image_id): functools.partial(image_progress_snapshot, image_id)
+        for image_id in dict.fromkeys(image_ids)
+    })
+
+@app.route('/api/jobs/stats')
+def api_job_stats():
+    """API: 非同步工作池狀態"""
+    return jsonify({'success': True, 'job_pool': get_job_pool_stats()})
 
 @app.route('/submit_human_review', methods=['POST'])
 def submit_human_review():
@@ -1422,9 +5370,16 @@ def images_list():
 
 @app.route('/api/images')
 def api_get_images():
-    """API: 獲取圖片列表"""
+    """API: 獲取圖片列表（limit, cursor, status=a,b, order=asc|desc）"""
     limit = request.args.get('limit', 50, type=int)
-    result = get_uploaded_images(limit)
+    cursor = request.args.get('cursor')
+    status = request.args.get('status')
+    statuses = [value for value in status.split(',') if value] if status else None
+    ascending = request.args.get('order', 'desc').lower() == 'asc'
+    
+    result = get_uploaded_images(limit, cursor=cursor, statuses=statuses, ascending=ascending)
+    if not result['success'] and result['error'] == '無效的分頁游標':
+        return jsonify(result), 400
     return jsonify(result)
 
 @app.route('/api/images/<image_id>')
@@ -1442,15 +5397,7 @@ def api_get_image_details(image_id):
             return jsonify({'error': '無效的圖片記錄'}), 400
         
         # 生成S3預簽名URL用於圖片預覽
-        try:
-            image_url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': S3_BUCKET, 'Key': image_item['s3_key']},
-                ExpiresIn=3600  # 1小時過期
-            )
-        except Exception as e:
-            print(f"❌ Failed to generate presigned URL: {str(e)}")
-            image_url = None
+        image_url = generate_image_url(image_item['s3_key'])
         
         result = {
             'success': True,
@@ -1499,19 +5446,39 @@ def api_reprocess_image(image_id):
         if image_item.get('record_type') != 'image_metadata':
             return jsonify({'error': '無效的圖片記錄'}), 400
         
-        # 從 S3 下載圖片
+        # 從 S3 下載檔案
         s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=image_item['s3_key'])
         file_data = s3_response['Body'].read()
+        processing_mode = request.json.get('processing_mode', 'automatic')
+        
+        if is_pdf_file(file_data):
+            # 多頁 PDF 逐頁重新處理（run_pdf_pipeline 自行更新處理狀態與頁面連結）
+            if processing_mode != 'automatic':
+                return jsonify({'error': PDF_HUMAN_REVIEW_ERROR}), 400
+            pipeline_result = run_pdf_pipeline(
+                image_id, image_item.get('session_id') or str(uuid.uuid4()), image_item.get('filename'),
+                file_data, image_item['s3_key'], voting_mode=request.json.get('voting_mode')
+            )
+            if not pipeline_result['success']:
+                return jsonify({'error': f'重新處理失敗: {pipeline_result["error"]}'}), 500
+            return jsonify({
+                'success': True,
+                'message': '重新處理完成',
+                'page_count': pipeline_result['page_count'],
+                'failed_pages': pipeline_result['failed_pages'],
+                'ocr_result_ids': [page['record_id'] for page in pipeline_result['pages'] if page['success']]
+            })
+        
+        # 圖片前處理
+        file_data = preprocess_image(file_data)['image_data']
         
         # 更新處理狀態
         update_image_processing_status(image_id, 'processing')
         
         # 執行處理
-        processing_mode = request.json.get('processing_mode', 'automatic')
-        
         if processing_mode == 'automatic':
             # 執行自動處理
-            voting_results = run_enhanced_voting_system(file_data)
+            voting_results = run_enhanced_voting_system(file_data, voting_mode=request.json.get('voting_mode'))
             
             if voting_results and 'voting_result' in voting_results and 'final_result' in voting_results['voting_result']:
                 vote_details = voting_results['voting_result'].get('vote_details', {})
@@ -1546,7 +5513,7 @@ def api_reprocess_image(image_id):
                 return jsonify({
                     'success': True,
                     'message': '準備人工審核',
-                    'claude_result': claude_result,
+                    'claude_result': slim_model_result(claude_result, get_response_fields()),
                     'image_id': image_id
                 })
             else:
@@ -1608,7 +5575,7 @@ def api_get_image_for_review(image_id):
             print("🔄 No pending data found, reprocessing...")
             try:
                 s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=image_item['s3_key'])
-                file_data = s3_response['Body'].read()
+                file_data = preprocess_image(s3_response['Body'].read())['image_data']
                 claude_result = process_with_claude_latest(file_data, for_human_review=True)
                 print(f"✅ Reprocessed with result: {claude_result.get('success')}")
             except Exception as e:
@@ -1618,18 +5585,6 @@ def api_get_image_for_review(image_id):
         if not claude_result.get('success'):
             return jsonify({'error': '無法獲取處理結果'}), 500
         
-        # 從 S3 獲取原始圖片
-        try:
-            s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=image_item['s3_key'])
-            file_data = s3_response['Body'].read()
-        except Exception as e:
-            print(f"❌ Failed to get image from S3: {str(e)}")
-            return jsonify({'error': f'無法獲取原始圖片: {str(e)}'}), 500
-        
-        # 準備圖片顯示
-        file_base64 = base64.b64encode(file_data).decode('utf-8')
-        file_type = image_item['content_type'].split('/')[-1]
-        
         print(f"✅ Successfully prepared review data for {image_item['filename']}")
         
         return jsonify({
@@ -1637,10 +5592,10 @@ def api_get_image_for_review(image_id):
             'image_id': image_id,
             'session_id': session_id,
             'filename': image_item['filename'],
-            'image_data': f"data:image/{file_type};base64,{file_base64}",
+            'image_url': generate_image_url(image_item['s3_key']),
             'processing_mode': 'human_review',
             'status': 'pending_review',
-            'claude_result': claude_result
+            'claude_result': slim_model_result(claude_result, get_response_fields())
         })
         
     except Exception as e:
@@ -1658,15 +5613,30 @@ def enhanced_voting_ocr():
     edit_image_id = request.args.get('edit_image_id')
     if edit_image_id:
         # Edit mode - load existing OCR result for editing
-        return render_template('enhanced_voting_ocr.html', review_mode=True, image_id=edit_image_id, edit_mode=True)
+        return render_template('enhanced_voting_ocr.html', review_mode=True, image_id=edit_image_id, edit_mode=True, durable_queue=durable_job_queue is not None)
     else:
         # Normal mode - new upload
-        return render_template('enhanced_voting_ocr.html', review_mode=False, image_id=None, edit_mode=False)
+        return render_template('enhanced_voting_ocr.html', review_mode=False, image_id=None, edit_mode=False, durable_queue=durable_job_queue is not None)
+
+@app.route('/block_ocr')
+def block_ocr():
+    """手動選取區塊的 OCR 頁面"""
+    return render_template('block_ocr.html')
+
+@app.route('/auto_block_ocr')
+def auto_block_ocr():
+    """自動建議區塊（初診表固定版面）的 OCR 頁面"""
+    return render_template('auto_block_ocr.html')
+
+@app.route('/block_detect_ocr')
+def block_detect_ocr():
+    """自動建議區塊並勾選處理的 OCR 頁面"""
+    return render_template('index.html')
 
 @app.route('/review/<image_id>')
 def review_image(image_id):
     """人工審核頁面"""
-    return render_template('enhanced_voting_ocr.html', review_mode=True, image_id=image_id, edit_mode=False)
+    return render_template('enhanced_voting_ocr.html', review_mode=True, image_id=image_id, edit_mode=False, durable_queue=durable_job_queue is not None)
 
 @app.route('/api/images/<image_id>/ocr-result', methods=['GET'])
 def api_get_image_ocr_result(image_id):
@@ -1697,15 +5667,7 @@ def api_get_image_ocr_result(image_id):
         # 生成預簽名URL用於圖片預覽
         image_url = None
         if 's3_key' in image_item:
-            try:
-                image_url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': S3_BUCKET, 'Key': image_item['s3_key']},
-                    ExpiresIn=3600  # 1小時有效期
-                )
-            except Exception as e:
-                print(f"⚠️ Failed to generate presigned URL: {str(e)}")
-                image_url = None
+            image_url = generate_image_url(image_item['s3_key'])
         
         return jsonify({
             'success': True,
@@ -1762,16 +5724,9 @@ def api_update_ocr_result(image_id):
         
         ocr_item = ocr_response['Item']
         
-        # 設置默認值
-        data_with_defaults = set_default_values(data)
-        print(f"🔧 設置默認值完成: {json.dumps(data_with_defaults, indent=2, ensure_ascii=False)}")
-        
-        # 正規化日期格式
-        normalized_data = normalize_dates_in_data(data_with_defaults)
-        print(f"📅 更新OCR結果時日期正規化完成: {json.dumps(normalized_data, indent=2, ensure_ascii=False)}")
-        
-        # 轉換浮點數為Decimal
-        updated_data = convert_floats_to_decimal(normalized_data)
+        # 設置默認值、正規化日期並轉換浮點數（保留使用者輸入的文字，不做英文轉換）
+        updated_data = normalize_form_record(data, translate=False)
+        print(f"📅 更新OCR結果時資料正規化完成: {ocr_result_id}")
         
         # 更新OCR結果記錄
         update_expression = "SET #data = :data, updated_at = :updated_at, human_reviewed = :human_reviewed"
@@ -1900,7 +5855,24 @@ def debug_models():
         'aws_region': AWS_REGION,
         'aws_profile': AWS_PROFILE,
         's3_bucket': S3_BUCKET,
-        'dynamodb_table': DYNAMODB_TABLE_NAME
+        'dynamodb_table': DYNAMODB_TABLE_NAME,
+        'voting_mode': VOTING_MODE,
+        'quorum_voting': dict(quorum_stats),
+        'extraction_cache': {
+            'backend': extraction_cache.name if extraction_cache else 'none',
+            **extraction_cache_stats
+        },
+        'bedrock_scheduler': {
+            'enabled': BEDROCK_SCHEDULER_ENABLED,
+            'models': bedrock_scheduler.snapshot()
+        },
+        'circuit_breakers': get_circuit_breaker_states(),
+        'extraction_output': {
+            'mode': EXTRACTION_OUTPUT_MODE,
+            'parsing': get_extraction_parse_summary()
+        },
+        'extraction_prompt': get_prompt_variant_summary(),
+        'date_normalization': get_date_normalization_summary()
     })
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark the legacy multi-pass form normalization chain vs the fused single-pass normalize_form_record
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import (
+    set_default_values,
+    normalize_vet_form_data,
+    normalize_dates_in_data,
+    convert_floats_to_decimal,
+    normalize_form_record,
+    parse_date_string,
+    normalize_date_column,
+    get_date_normalization_summary
+)
+import copy
+import time
+
+SAMPLE_RECORD = {
+    "basic_info": {"chart_number": "A-00123", "first_visit_date": "2024-3-5"},
+    "pet_info": {
+        "pet_name": "Lucky", "species": "Dog", "breed": "柴犬", "pet_gender": "Male",
+        "desexed": "", "color": "黃白", "pet_age": 3.5, "pet_birth_date": "民國110年6月1日"
+    },
+    "medical_history": {"past_medical_history": "None"},
+    "owner_info": {
+        "owner_id": "A123456789", "owner_name": "王小明", "owner_birth_date": "1985年7月20日",
+        "phone": "0912-345-678", "line_id": "wang_ming", "email": "ming@example.com",
+        "registered_address": "台北市大安區", "mailing_address": "台北市大安區"
+    },
+    "preventive_care": {
+        "monthly_preventive_treatment": "Yes", "monthly_preventive_yes": "yes", "monthly_preventive_no": "",
+        "major_illness_surgery": "no", "vaccine_types": "Vaccinated", "vaccine_rabies": "YES",
+        "vaccine_3in1": "", "vaccine_4in1": "", "vaccine_5in1": "yes", "vaccine_others": "no",
+        "vaccine_others_detail": ""
+    },
+    "visit_info": {"visit_purpose": "年度健檢", "remarks": "Neutered last year"}
+}
+
+def legacy_save_chain(record):
+    return convert_floats_to_decimal(normalize_vet_form_data(set_default_values(record)))
+
+def legacy_update_chain(record):
+    return convert_floats_to_decimal(normalize_dates_in_data(set_default_values(record)))
+
+def benchmark(name, legacy, fused, records, rounds=5):
+    print(f"\n⏱️ {name}: {len(records)} 筆紀錄")
+    print("=" * 50)
+
+    timings = {}
+    for label, runner in (('legacy', legacy), ('fused', fused)):
+        elapsed = []
+        for _ in range(rounds):
+            # 舊流程會就地修改輸入，每輪都用新的副本（複製不計入時間）
+            batch = copy.deepcopy(records)
+            started = time.perf_counter()
+            for record in batch:
+                runner(record)
+            elapsed.append(time.perf_counter() - started)
+        timings[label] = min(elapsed) / len(records) * 1e6
+        print(f"  - {label}: {timings[label]:.1f}µs / 筆")
+
+    print(f"  - 加速倍數: {timings['legacy'] / timings['fused']:.2f}x")
+    return timings
+
+def benchmark_dates(values, rounds=5):
+    print(f"\n⏱️ 日期欄位正規化: {len(values)} 個值 / {len(set(values))} 種")
+    print("=" * 50)
+
+    timings = {}
+    runners = (
+        ('uncached', lambda column: [parse_date_string(value.strip()) for value in column]),
+        ('column', normalize_date_column)
+    )
+    for label, runner in runners:
+        elapsed = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            runner(values)
+            elapsed.append(time.perf_counter() - started)
+        timings[label] = min(elapsed) / len(values) * 1e6
+        print(f"  - {label}: {timings[label]:.2f}µs / 值")
+
+    print(f"  - 加速倍數: {timings['uncached'] / timings['column']:.2f}x")
+    print(f"  - 快取: {get_date_normalization_summary()}")
+    return timings
+
+if __name__ == "__main__":
+    print("🚀 Form Normalization Benchmark")
+    print("=" * 80)
+
+    records = [copy.deepcopy(SAMPLE_RECORD) for _ in range(2000)]
+    benchmark("save_to_dynamodb 正規化", legacy_save_chain, normalize_form_record, records)
+    benchmark("api_update_ocr_result 正規化", legacy_update_chain,
+              lambda record: normalize_form_record(record, translate=False), records)
+
+    dates = [f"{year}-{month}-{day}" for year in (2022, 2023, 2024) for month in range(1, 13) for day in (1, 15)]
+    dates += [f"民國{year - 1911}年{month}月{day}日" for year in (2022, 2023) for month in range(1, 13) for day in (1, 15)]
+    benchmark_dates(dates * 50)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark the dict/Counter voting functions vs the array-indexed VoteTally, one document at a time,
+and the per-run memory of nested extracted_data dicts vs VetFormRecord
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import (
+    collect_field_votes,
+    vote_for_field,
+    set_nested_field,
+    tally_votes,
+    VetFormRecord,
+    VET_FORM_SECTIONS
+)
+from collections import defaultdict
+import copy
+import random
+import time
+import tracemalloc
+
+MODEL_RUNS = [('sonnet', 1), ('haiku', 1), ('sonnet-latest', 1)]
+
+def make_documents(count, seed=7):
+    """每份文件三個模型結果，約兩成欄位意見不一致，疫苗類型為陣列"""
+    rng = random.Random(seed)
+    documents = []
+    for document in range(count):
+        results = []
+        for model, run_number in MODEL_RUNS:
+            data = {
+                section: {
+                    field: f"{field}-{document}" if rng.random() > 0.2 else f"{field}-{model}"
+                    for field in fields
+                }
+                for section, fields in VET_FORM_SECTIONS.items()
+            }
+            data['preventive_care']['vaccine_types'] = ['狂犬', '三合一'] if rng.random() > 0.2 else ['狂犬']
+            results.append({'model': model, 'run_number': run_number, 'success': True, 'extracted_data': data})
+        documents.append(results)
+    return documents
+
+def legacy_vote(results):
+    field_votes = defaultdict(list)
+    for result in results:
+        collect_field_votes(result['extracted_data'], field_votes, result['model'], result['run_number'])
+    final_result, vote_details = {}, {}
+    for field_path, votes in field_votes.items():
+        winner, vote_detail = vote_for_field(votes)
+        set_nested_field(final_result, field_path, winner)
+        vote_details[field_path] = vote_detail
+    return final_result, vote_details
+
+def benchmark(documents, rounds=5):
+    print(f"\n⏱️ 逐份投票: {len(documents)} 份文件 x {len(MODEL_RUNS)} 個模型結果")
+    print("=" * 50)
+
+    runners = (
+        ('legacy', lambda: [legacy_vote(results) for results in documents]),
+        ('tally (final_result)', lambda: [tally_votes(results).final_result for results in documents]),
+        ('tally (final_result + vote_details)',
+         lambda: [(tally.final_result, tally.vote_details) for tally in map(tally_votes, documents)])
+    )
+    timings = {}
+    for label, runner in runners:
+        elapsed = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            runner()
+            elapsed.append(time.perf_counter() - started)
+        timings[label] = min(elapsed) / len(documents) * 1e6
+        print(f"  - {label}: {timings[label]:.1f}µs / 份")
+
+    for label in list(timings)[1:]:
+        print(f"  - 相對舊版 {label}: {timings['legacy'] / timings[label]:.2f}x")
+    return timings
+
+def traced_bytes(build):
+    tracemalloc.start()
+    try:
+        kept = build()
+        return tracemalloc.get_traced_memory()[0], kept
+    finally:
+        tracemalloc.stop()
+
+def measure_run_memory(documents):
+    """每次模型執行保存的 extracted_data：巢狀 dict vs VetFormRecord（字串值兩者共用，只比較容器）"""
+    print(f"\n💾 每次執行的結果記憶體: {len(documents)} 份文件 x {len(MODEL_RUNS)} 個模型結果")
+    print("=" * 50)
+    outputs = [result['extracted_data'] for results in documents for result in results]
+    nested_bytes, _ = traced_bytes(lambda: [copy.deepcopy(data) for data in outputs])
+    record_bytes, _ = traced_bytes(lambda: [VetFormRecord.from_nested(data) for data in outputs])
+    print(f"  - 巢狀 dict: {nested_bytes / len(outputs):.0f} bytes / 次")
+    print(f"  - VetFormRecord: {record_bytes / len(outputs):.0f} bytes / 次")
+    print(f"  - 縮減: {nested_bytes / record_bytes:.1f}x")
+    return nested_bytes, record_bytes
+
+if __name__ == "__main__":
+    print("🚀 Vote Tally Benchmark")
+    print("=" * 80)
+
+    documents = make_documents(1000)
+    for results in documents[:50]:
+        tally = tally_votes(results)
+        final_result, vote_details = legacy_vote(results)
+        assert tally.final_result == final_result, "final_result 與舊版投票不一致"
+        assert {path: detail['winner'] for path, detail in tally.vote_details.items()} == \
+            {path: detail['winner'] for path, detail in vote_details.items()}
+    benchmark(documents)
+    measure_run_memory(documents[:200])
@@ -108,7 +108,7 @@ class RpaOcrEcsStack(Stack):
                 "FLASK_ENV": "production"
             },
             health_check=ecs.HealthCheck(
-                command=["CMD-SHELL", "curl -f http://localhost:5000/health || exit 1"],
+                command=["CMD-SHELL", "curl -f http://localhost:5000/health/live || exit 1"],
                 interval=Duration.seconds(30),
                 timeout=Duration.seconds(5),
                 retries=3,
@@ -138,7 +138,7 @@ class RpaOcrEcsStack(Stack):
 
         # Configure health check for the target group
         self.fargate_service.target_group.configure_health_check(
-            path="/health",
+            path="/health/ready",
             port="5000",
             healthy_http_codes="200",
             interval=Duration.seconds(30),
@@ -5,6 +5,7 @@ Create DynamoDB table for Medical OCR results
 
 import boto3
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +14,25 @@ load_dotenv()
 AWS_REGION = os.getenv('AWS_REGION', 'us-west-2')
 AWS_PROFILE = os.getenv('AWS_PROFILE')
 TABLE_NAME = os.getenv('DYNAMODB_TABLE_NAME', 'medical-ocr-results')
+RECORD_TYPE_INDEX = os.getenv('DYNAMODB_RECORD_TYPE_INDEX', 'record-type-created-at-index')
+
+# 圖片列表查詢用的 GSI：只有帶 record_type 的圖片元數據會進入此索引
+RECORD_TYPE_INDEX_DEFINITION = {
+    'IndexName': RECORD_TYPE_INDEX,
+    'KeySchema': [
+        {
+            'AttributeName': 'record_type',
+            'KeyType': 'HASH'
+        },
+        {
+            'AttributeName': 'created_at',
+            'KeyType': 'RANGE'
+        }
+    ],
+    'Projection': {
+        'ProjectionType': 'ALL'
+    }
+}
 
 def create_aws_session():
     if AWS_PROFILE:
@@ -34,6 +54,7 @@ def create_dynamodb_table():
             table = dynamodb.Table(TABLE_NAME)
             table.load()
             print(f"✅ Table '{TABLE_NAME}' already exists")
+            ensure_record_type_index(table)
             return table
         except dynamodb.meta.client.exceptions.ResourceNotFoundException:
             pass
@@ -61,6 +82,14 @@ def create_dynamodb_table():
                 {
                     'AttributeName': 'processing_mode',
                     'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'record_type',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'created_at',
+                    'AttributeType': 'S'
                 }
             ],
             GlobalSecondaryIndexes=[
@@ -91,7 +120,8 @@ def create_dynamodb_table():
                     'Projection': {
                         'ProjectionType': 'ALL'
                     }
-                }
+                },
+                RECORD_TYPE_INDEX_DEFINITION
             ],
             BillingMode='PAY_PER_REQUEST'
         )
@@ -109,6 +139,33 @@ def create_dynamodb_table():
         print(f"❌ Error creating table: {str(e)}")
         return None
 
+def ensure_record_type_index(table):
+    """為既有表格補建 record_type + created_at GSI"""
+    existing_indexes = [gsi['IndexName'] for gsi in (table.global_secondary_indexes or [])]
+    if RECORD_TYPE_INDEX in existing_indexes:
+        print(f"✅ Index '{RECORD_TYPE_INDEX}' already exists")
+        return
+    
+    print(f"🔨 Creating index: {RECORD_TYPE_INDEX}")
+    table.meta.client.update_table(
+        TableName=TABLE_NAME,
+        AttributeDefinitions=[
+            {'AttributeName': 'record_type', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': RECORD_TYPE_INDEX_DEFINITION}]
+    )
+    
+    # 等待索引回填完成
+    print("⏳ Waiting for index backfill...")
+    while True:
+        table.reload()
+        statuses = {gsi['IndexName']: gsi['IndexStatus'] for gsi in (table.global_secondary_indexes or [])}
+        if statuses.get(RECORD_TYPE_INDEX) == 'ACTIVE':
+            break
+        time.sleep(10)
+    print(f"✅ Index '{RECORD_TYPE_INDEX}' is active")
+
 def describe_table():
     """Describe the created table"""
     try:
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Test the global Bedrock scheduler (priority ordering, AIMD concurrency), hedged requests
+and per-model circuit breakers
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import BedrockScheduler, SchedulerTimeoutError, HedgePolicy, CircuitBreaker
+from botocore.exceptions import ClientError, ReadTimeoutError
+import threading
+import time
+
+MODEL_ID = 'test-model'
+FLAKY_MODEL_ID = 'flaky-model'  # 與其他測試殘留的背景呼叫分開計數
+
+def make_scheduler(max_concurrency=1, rpm=600, tpm=1000000, max_wait_seconds=5):
+    return BedrockScheduler(
+        {},
+        {'rpm': rpm, 'tpm': tpm, 'max_concurrency': max_concurrency},
+        max_wait_seconds,
+        decrease_cooldown_seconds=0
+    )
+
+def test_interactive_calls_jump_the_queue():
+    """Waiting interactive calls should be admitted before earlier background calls"""
+    print("🧪 Testing Scheduler Priority")
+    print("=" * 50)
+
+    scheduler = make_scheduler()
+    scheduler.acquire(MODEL_ID, 2, 100)
+
+    admitted = []
+    def waiter(name, priority):
+        scheduler.acquire(MODEL_ID, priority, 100)
+        admitted.append(name)
+        scheduler.release(MODEL_ID, 'success', 100)
+
+    threads = [threading.Thread(target=waiter, args=('background', 2))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=waiter, args=('interactive', 0)))
+    threads[1].start()
+    time.sleep(0.05)
+
+    scheduler.release(MODEL_ID, 'success', 100)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert admitted == ['interactive', 'background']
+    print(f"✅ Admission order: {admitted}")
+
+def test_aimd_backs_off_on_throttling():
+    """Throttling halves the concurrency limit, successes grow it back additively"""
+    print("\n🧪 Testing AIMD Concurrency")
+    print("=" * 50)
+
+    scheduler = make_scheduler(max_concurrency=8)
+    for outcome in ('throttled', 'throttled'):
+        scheduler.acquire(MODEL_ID, 1, 100)
+        scheduler.release(MODEL_ID, outcome, 100)
+    assert scheduler.snapshot()[MODEL_ID]['concurrency_limit'] == 2
+
+    for _ in range(4):
+        scheduler.acquire(MODEL_ID, 1, 100)
+        scheduler.release(MODEL_ID, 'success', 100)
+    limit = scheduler.snapshot()[MODEL_ID]['concurrency_limit']
+    assert 3 < limit < 4
+    print(f"✅ Concurrency limit after recovery: {limit}")
+
+def test_token_bucket_limits_and_times_out():
+    """Calls beyond the TPM budget wait for refill and give up after max_wait_seconds"""
+    print("\n🧪 Testing TPM Budget")
+    print("=" * 50)
+
+    scheduler = make_scheduler(max_concurrency=4, tpm=6000, max_wait_seconds=0.2)
+    scheduler.acquire(MODEL_ID, 1, 6000)
+    scheduler.release(MODEL_ID, 'success', 6000, actual_tokens=5990)
+
+    started = time.monotonic()
+    try:
+        scheduler.acquire(MODEL_ID, 1, 3000)
+        raise AssertionError("expected SchedulerTimeoutError")
+    except SchedulerTimeoutError:
+        pass
+    assert time.monotonic() - started >= 0.2
+    assert scheduler.snapshot()[MODEL_ID]['waiting'] == 0
+    print("✅ Over-budget call timed out")
+
+class SlowPrimaryBedrockClient:
+    """Stub converse() where the primary model straggles and the alternate answers quickly"""
+
+    def __init__(self, slow_model_id, delay):
+        self.slow_model_id = slow_model_id
+        self.delay = delay
+        self.calls = []
+
+    def converse(self, modelId, messages, inferenceConfig=None, **kwargs):
+        self.calls.append(modelId)
+        time.sleep(self.delay if modelId == self.slow_model_id else 0.01)
+        return {
+            'output': {'message': {'content': [{'text': modelId}]}},
+            'usage': {'inputTokens': 10, 'outputTokens': 5}
+        }
+
+def test_hedged_request_takes_first_response():
+    """A straggling call is hedged to the alternate model and the faster answer wins"""
+    print("\n🧪 Testing Hedged Requests")
+    print("=" * 50)
+
+    originals = (app.bedrock_client, app.hedge_policy, app.HEDGING_ENABLED, app.HEDGE_ALTERNATE_MODELS)
+    original_cache = app.extraction_cache
+    app.bedrock_client = SlowPrimaryBedrockClient(MODEL_ID, delay=1.0)
+    app.hedge_policy = HedgePolicy(0.9, 50, 5, 0.05, max_per_minute=1)
+    app.HEDGING_ENABLED = True
+    app.HEDGE_ALTERNATE_MODELS = {MODEL_ID: 'alternate-model'}
+    try:
+        for _ in range(5):
+            app.hedge_policy.record_latency(MODEL_ID, 0.02)
+
+        started = time.perf_counter()
+        response = app.hedged_converse(MODEL_ID, 'prompt', b'\x89PNG', {'maxTokens': 10})
+        elapsed = time.perf_counter() - started
+        assert response['output']['message']['content'][0]['text'] == 'alternate-model'
+        assert response['answered_model'] == 'alternate-model'
+        assert elapsed < 0.5
+
+        # 已達每分鐘上限：不再對沖，等待原本的請求
+        response = app.hedged_converse(MODEL_ID, 'prompt', b'\x89PNG', {'maxTokens': 10})
+        assert response['output']['message']['content'][0]['text'] == MODEL_ID
+        assert response['answered_model'] == MODEL_ID
+
+        # 替代模型的回答不寫入主模型的快取鍵，結果記在實際回答的模型名下
+        app.hedge_policy = HedgePolicy(0.9, 50, 5, 0.05, max_per_minute=1)
+        for _ in range(5):
+            app.hedge_policy.record_latency(MODEL_ID, 0.02)
+        app.extraction_cache = app.MemoryExtractionCache(10, 60)
+        result = app.process_with_claude_model(b'\x89PNG', MODEL_ID, 1, prompt='prompt')
+        cache_size = len(app.extraction_cache.entries)
+    finally:
+        app.bedrock_client, app.hedge_policy, app.HEDGING_ENABLED, app.HEDGE_ALTERNATE_MODELS = originals
+        app.extraction_cache = original_cache
+    assert result['model'] == 'alternate-model' and result['hedged_from'] == MODEL_ID
+    assert cache_size == 0
+    print(f"✅ Hedge won in {elapsed:.2f}s")
+
+def test_circuit_breaker_opens_and_recovers():
+    """The breaker opens on errors or slow calls and closes after a successful probe"""
+    print("\n🧪 Testing Circuit Breaker")
+    print("=" * 50)
+
+    breaker = CircuitBreaker(60, 4, 0.5, 1.0, 0.5, open_seconds=0.1)
+    for success, latency in ((True, 0.1), (False, 0.1), (True, 2.0), (True, 2.0)):
+        assert breaker.allow_request()
+        breaker.record(success, latency)
+    assert breaker.snapshot()['state'] == 'open'
+    assert not breaker.allow_request()
+
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # 同時只允許一個試探呼叫
+    breaker.record(False, 0.1)
+    assert breaker.snapshot()['state'] == 'open'
+
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    breaker.record(True, 0.1)
+    assert breaker.snapshot()['state'] == 'closed'
+    assert breaker.snapshot()['times_opened'] == 2
+    print("✅ Breaker opened twice and closed after a healthy probe")
+
+def test_hedge_timer_excludes_scheduler_queue_wait():
+    """Time spent waiting for scheduler admission does not count towards the hedge delay"""
+    print("\n🧪 Testing Hedge Timer Starts at Admission")
+    print("=" * 50)
+
+    originals = (app.bedrock_client, app.hedge_policy, app.HEDGING_ENABLED, app.bedrock_scheduler)
+    stub = SlowPrimaryBedrockClient('other-model', delay=1.0)
+    app.bedrock_client = stub
+    app.hedge_policy = HedgePolicy(0.9, 50, 5, 0.05, max_per_minute=10)
+    app.HEDGING_ENABLED = True
+    app.bedrock_scheduler = make_scheduler(max_concurrency=1)
+    try:
+        for _ in range(5):
+            app.hedge_policy.record_latency(MODEL_ID, 0.02)
+        app.bedrock_scheduler.acquire(MODEL_ID, 1, 100)  # 佔住唯一的並行名額
+        threading.Timer(0.3, app.bedrock_scheduler.release, args=(MODEL_ID, 'success', 100)).start()
+
+        started = time.perf_counter()
+        app.hedged_converse(MODEL_ID, 'prompt', b'\x89PNG', {'maxTokens': 10})
+        elapsed = time.perf_counter() - started
+        hedges_issued = len(app.hedge_policy.recent_hedges)
+    finally:
+        app.bedrock_client, app.hedge_policy, app.HEDGING_ENABLED, app.bedrock_scheduler = originals
+
+    assert elapsed >= 0.3
+    assert hedges_issued == 0 and stub.calls == [MODEL_ID]  # 取得許可後 0.01s 就回應，不應送出對沖
+    print(f"✅ Queued {elapsed:.2f}s without hedging")
+
+class FlakyBedrockClient:
+    """Stub converse() that raises the queued errors in order, then answers"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def converse(self, modelId, messages, inferenceConfig=None, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {
+            'output': {'message': {'content': [{'text': 'ok'}]}},
+            'usage': {'inputTokens': 10, 'outputTokens': 5}
+        }
+
+def client_error(code, status):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'Converse')
+
+def test_transient_errors_are_retried_without_backoff():
+    """5xx and connection errors are re-queued without halving concurrency; client errors are not retried"""
+    print("\n🧪 Testing Transient Error Retries")
+    print("=" * 50)
+
+    originals = (app.bedrock_client, app.bedrock_scheduler, app.BEDROCK_SCHEDULER_ENABLED)
+    app.bedrock_scheduler = make_scheduler(max_concurrency=4)
+    app.BEDROCK_SCHEDULER_ENABLED = True
+    try:
+        stub = FlakyBedrockClient([
+            client_error('ServiceUnavailableException', 503),
+            ReadTimeoutError(endpoint_url='https://bedrock-runtime')
+        ])
+        app.bedrock_client = stub
+        response = app.scheduled_converse(FLAKY_MODEL_ID, 'prompt', b'\x89PNG', {'maxTokens': 10})
+        assert response['output']['message']['content'][0]['text'] == 'ok' and stub.calls == 3
+        snapshot = app.bedrock_scheduler.snapshot()[FLAKY_MODEL_ID]
+        assert snapshot['concurrency_limit'] > 1 and snapshot['in_flight'] == 0
+
+        stub = FlakyBedrockClient([client_error('ValidationException', 400)])
+        app.bedrock_client = stub
+        try:
+            app.scheduled_converse(FLAKY_MODEL_ID, 'prompt', b'\x89PNG', {'maxTokens': 10})
+            assert False, "ValidationException should not be retried"
+        except ClientError:
+            pass
+        assert stub.calls == 1
+    finally:
+        app.bedrock_client, app.bedrock_scheduler, app.BEDROCK_SCHEDULER_ENABLED = originals
+        app.circuit_breakers.pop(FLAKY_MODEL_ID, None)
+    print(f"✅ Transient retries: {snapshot}")
+
+if __name__ == "__main__":
+    print("🚀 Bedrock Scheduler Test")
+    print("=" * 80)
+
+    test_interactive_calls_jump_the_queue()
+    test_aimd_backs_off_on_throttling()
+    test_token_bucket_limits_and_times_out()
+    test_hedged_request_takes_first_response()
+    test_hedge_timer_excludes_scheduler_queue_wait()
+    test_circuit_breaker_opens_and_recovers()
+    test_transient_errors_are_retried_without_backoff()
+
+    print("\n✅ All tests passed!")
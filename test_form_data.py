@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Test form record normalization, date parsing, the slotted VetFormRecord and vote tallying
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import normalize_form_record, normalize_date_format, normalize_date_column, VetFormRecord, vote_documents
+from decimal import Decimal
+from collections import defaultdict
+import copy
+import json
+
+def test_single_pass_normalization():
+    """Defaults, dates, English values and floats are normalized in one pass without mutating the input"""
+    print("🧪 Testing Single-pass Normalization")
+    print("=" * 50)
+
+    record = {
+        "basic_info": {"chart_number": "A-001", "first_visit_date": "2024-3-5"},
+        "pet_info": {"species": "Dog", "pet_gender": "FEMALE", "desexed": " ", "pet_age": 3.5},
+        "preventive_care": {"vaccine_types": "Not Vaccinated", "vaccine_others": "nothing"},
+        "visit_info": {"remarks": ["Yes", 0.25]}
+    }
+    original = copy.deepcopy(record)
+
+    normalized = normalize_form_record(record)
+    assert record == original
+    assert normalized['basic_info']['first_visit_date'] == '2024/03/05'
+    assert normalized['pet_info'] == {'species': '狗', 'pet_gender': '母', 'desexed': '否', 'pet_age': Decimal('3.5')}
+    assert normalized['preventive_care'] == {'vaccine_types': '未施打', 'vaccine_others': 'nothing'}
+    assert normalized['visit_info']['remarks'] == ['是', Decimal('0.25')]
+    assert 'desexed' not in normalized['basic_info']
+
+    edited = normalize_form_record({"pet_info": {"species": "Dog"}}, translate=False)
+    assert edited == {"pet_info": {"species": "Dog", "desexed": "否"}}
+    print("✅ Record normalized in one pass")
+
+def test_date_formats_and_cache():
+    """ROC, Chinese and numeric dates are parsed, cached, and normalized as a column"""
+    print("\n🧪 Testing Date Normalization")
+    print("=" * 50)
+
+    cases = {
+        '民國110年6月1日': '2021/06/01',
+        '民國 99 年 12 月 1 號': '2010/12/01',
+        '民國110/6/1': '2021/06/01',
+        '110年6月1日': '2021/06/01',
+        '２０２４年３月５日': '2024/03/05',
+        '2024年13月40日': '2024年13月40日',
+        ' 2024.1.2 ': '2024/01/02',
+        '05/03/2024': '2024/03/05',
+        '03/25/2024': '2024/03/25',
+        '20240305': '2024/03/05',
+        '未知': '未知'
+    }
+    for raw, expected in cases.items():
+        assert normalize_date_format(raw) == expected, (raw, normalize_date_format(raw))
+
+    before = app.get_date_normalization_summary()
+    column = normalize_date_column(['民國110年6月1日', '民國110年6月1日', None, '2024-3-5'])
+    after = app.get_date_normalization_summary()
+    assert column == ['2021/06/01', '2021/06/01', None, '2024/03/05']
+    assert (after['hits'] + after['misses']) - (before['hits'] + before['misses']) == 2  # 同一欄內重複的值只查一次
+    normalize_date_format('民國110年6月1日')
+    assert app.get_date_normalization_summary()['hits'] == after['hits'] + 1
+    assert 0 < after['hit_ratio'] <= 1
+    print(f"✅ Date cache: {after}")
+
+def test_vet_form_record_round_trip():
+    """VetFormRecord converts to and from nested JSON, including when a model result is serialized"""
+    print("\n🧪 Testing VetFormRecord")
+    print("=" * 50)
+
+    data = {
+        "basic_info": {"chart_number": "A-001", "first_visit_date": ""},
+        "pet_info": {"pet_name": "小白", "pet_age": Decimal('3.5'), "nickname": "白白"},
+        "preventive_care": {"vaccine_types": ["狂犬", "三合一"]},
+        "raw_text": "extra"
+    }
+    record = VetFormRecord.from_nested(data)
+    assert not hasattr(record, '__dict__')
+    assert record.pet_name == '小白' and record.get('owner_name') is None
+    assert record.extras == {'pet_info.nickname': '白白', 'raw_text': 'extra'}
+    assert record.to_nested() == data
+
+    paths = [path for path, _ in record.items()]
+    assert paths[:4] == ['basic_info.chart_number', 'basic_info.first_visit_date', 'pet_info.pet_name', 'pet_info.pet_age']
+    assert paths[-2:] == ['pet_info.nickname', 'raw_text']
+
+    assert len(record) == 7 and not VetFormRecord()
+    model_result = {'model': 'a', 'extracted_data': record}
+    stored = json.dumps({'extracted_data': VetFormRecord(pet_name='小黑')}, ensure_ascii=False, default=app.form_json_default)
+    assert json.loads(stored) == {'extracted_data': {'pet_info': {'pet_name': '小黑'}}}
+    with app.app.app_context():
+        response = app.jsonify({'individual_results': [model_result]}).get_json()
+    assert response['individual_results'][0]['extracted_data']['preventive_care'] == {"vaccine_types": ["狂犬", "三合一"]}
+
+    skeleton = VetFormRecord(pet_name='小黑').to_nested(include_empty=True)
+    assert skeleton['pet_info']['pet_name'] == '小黑' and skeleton['owner_info']['owner_name'] == ''
+    print(f"✅ Round trip kept {len(paths)} fields")
+
+def test_vote_tally_matches_legacy_voting():
+    """VoteTally gives the same winners, confidences and vote details as the dict/Counter voting functions"""
+    print("\n🧪 Testing Vote Tally")
+    print("=" * 50)
+
+    results = [
+        {'model': 'a', 'run_number': 1, 'success': True, 'extracted_data': {
+            "pet_info": {"pet_name": "小白", "species": "狗"},
+            "preventive_care": {"vaccine_types": ["狂犬"]},
+            "notes": {"ink": "blue"}
+        }},
+        {'model': 'b', 'run_number': 1, 'success': True, 'extracted_data': {
+            "pet_info": {"pet_name": "小百", "species": "狗", "breed": "柴犬"},
+            "preventive_care": {"vaccine_types": ["狂犬"]}
+        }},
+        {'model': 'c', 'run_number': 1, 'success': False, 'extracted_data': {}}
+    ]
+
+    field_votes = defaultdict(list)
+    for result in results[:2]:
+        app.collect_field_votes(result['extracted_data'], field_votes, result['model'], result['run_number'])
+    legacy_final, legacy_details = {}, {}
+    for field_path, votes in field_votes.items():
+        winner, legacy_details[field_path] = app.vote_for_field(votes)
+        app.set_nested_field(legacy_final, field_path, winner)
+
+    tally, = vote_documents([results])
+    assert tally._vote_details is None  # 讀取前不建立
+    assert tally.final_result == legacy_final
+    assert tally.vote_details == legacy_details
+    assert app.analyze_and_vote(results)['vote_details'] == legacy_details
+    assert tally.final_result['pet_info']['pet_name'] == '小白'  # 平手時取先出現的值
+    assert tally.final_result['preventive_care']['vaccine_types'] == ['狂犬']
+    assert tally.vote_details['notes.ink']['details'] == [{'value': 'blue', 'model': 'a', 'run': 1}]
+    assert app.find_disputed_fields(results[:2]) == ['pet_info.pet_name', 'pet_info.breed', 'notes.ink']
+    print(f"✅ Tallied {len(tally)} fields")
+
+if __name__ == "__main__":
+    print("🚀 Form Data Test")
+    print("=" * 80)
+
+    test_single_pass_normalization()
+    test_date_formats_and_cache()
+    test_vet_form_record_round_trip()
+    test_vote_tally_matches_legacy_voting()
+
+    print("\n✅ All tests passed!")
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Test the durable SQLite job queue, the worker retry / dead-letter handling and batch uploads
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import SQLiteJobQueue, handle_queue_message
+import tempfile
+import io
+import time
+import zipfile
+
+def make_queue(visibility_timeout=60, max_receives=3):
+    directory = tempfile.mkdtemp()
+    return SQLiteJobQueue(os.path.join(directory, 'jobs.sqlite3'), visibility_timeout, max_receives)
+
+def test_visibility_timeout_and_delete():
+    """Received messages stay hidden until released or deleted"""
+    print("🧪 Testing SQLite Queue Visibility")
+    print("=" * 50)
+
+    job_queue = make_queue()
+    job_queue.send({'image_id': 'img-1'})
+
+    first = job_queue.receive()
+    assert len(first) == 1 and first[0]['job'] == {'image_id': 'img-1'}
+    assert first[0]['receive_count'] == 1
+    assert job_queue.receive() == []
+    assert job_queue.depth()['in_flight'] == 1
+
+    job_queue.release(first[0])
+    second = job_queue.receive()
+    assert second[0]['receive_count'] == 2
+
+    job_queue.delete(first[0])  # 舊的 receipt 不應刪除訊息
+    assert job_queue.depth()['in_flight'] == 1
+    job_queue.delete(second[0])
+    assert job_queue.depth() == {'queue_depth': 0, 'in_flight': 0, 'dead_letter_depth': 0}
+    print("✅ Visibility timeout and delete work")
+
+def test_retry_then_dead_letter():
+    """Failing jobs are retried and then moved to the dead-letter table"""
+    print("\n🧪 Testing Retry and Dead-letter")
+    print("=" * 50)
+
+    job_queue = make_queue(max_receives=2)
+    job_queue.send({'image_id': 'img-2'})
+
+    statuses = []
+    original_execute = app.execute_processing_job
+    original_update = app.update_image_processing_status
+    original_delay = app.JOB_RETRY_BASE_DELAY_SECONDS
+
+    def failing_job(job):
+        raise RuntimeError('ThrottlingException')
+
+    app.execute_processing_job = failing_job
+    app.update_image_processing_status = lambda image_id, status, ocr_result_id=None: statuses.append(status)
+    app.JOB_RETRY_BASE_DELAY_SECONDS = 0
+    try:
+        outcomes = [handle_queue_message(job_queue, message)
+                    for _ in range(2) for message in job_queue.receive()]
+    finally:
+        app.execute_processing_job = original_execute
+        app.update_image_processing_status = original_update
+        app.JOB_RETRY_BASE_DELAY_SECONDS = original_delay
+
+    assert outcomes == ['retried', 'dead_lettered']
+    assert statuses == ['queued', 'failed']
+    assert job_queue.depth() == {'queue_depth': 0, 'in_flight': 0, 'dead_letter_depth': 1}
+    print(f"✅ Outcomes: {outcomes}")
+
+def test_heartbeat_keeps_long_job_invisible():
+    """A job running longer than the visibility timeout is not redelivered while it runs"""
+    print("\n🧪 Testing Visibility Heartbeat")
+    print("=" * 50)
+
+    job_queue = make_queue(visibility_timeout=1)
+    job_queue.send({'image_id': 'img-long'})
+    redelivered = []
+
+    def long_job(job):
+        time.sleep(1.5)
+        redelivered.extend(job_queue.receive())
+        return True
+
+    original_execute = app.execute_processing_job
+    original_interval = app.JOB_HEARTBEAT_INTERVAL_SECONDS
+    app.execute_processing_job = long_job
+    app.JOB_HEARTBEAT_INTERVAL_SECONDS = 0.2
+    try:
+        outcome = handle_queue_message(job_queue, job_queue.receive()[0])
+    finally:
+        app.execute_processing_job = original_execute
+        app.JOB_HEARTBEAT_INTERVAL_SECONDS = original_interval
+
+    assert outcome == 'succeeded' and redelivered == []
+    assert job_queue.depth() == {'queue_depth': 0, 'in_flight': 0, 'dead_letter_depth': 0}
+    print("✅ Long job kept its message hidden until it finished")
+
+def test_abandoned_job_is_marked_failed_on_dead_letter():
+    """A message whose workers never reported back is dead-lettered on receive with the same failure bookkeeping"""
+    print("\n🧪 Testing Abandoned Job Dead-letter")
+    print("=" * 50)
+
+    job_queue = make_queue(max_receives=1)
+    job_queue.send({'image_id': 'img-3', 'batch_id': 'batch-3'})
+    abandoned = job_queue.receive()[0]
+    job_queue.release(abandoned)  # 模擬 visibility timeout 到期
+
+    statuses = []
+    outcomes = []
+    original_update = app.update_image_processing_status
+    original_record = app.record_batch_job_outcome
+    app.update_image_processing_status = lambda image_id, status, ocr_result_id=None: statuses.append((image_id, status))
+    app.record_batch_job_outcome = lambda batch_id, image_id, succeeded: outcomes.append((batch_id, image_id, succeeded))
+    try:
+        assert job_queue.receive() == []
+    finally:
+        app.update_image_processing_status = original_update
+        app.record_batch_job_outcome = original_record
+
+    assert statuses == [('img-3', 'failed')]
+    assert outcomes == [('batch-3', 'img-3', False)]
+    assert job_queue.depth() == {'queue_depth': 0, 'in_flight': 0, 'dead_letter_depth': 1}
+    print("✅ Abandoned job marked failed and counted in its batch")
+
+def test_progressive_request_uses_durable_queue():
+    """With a durable queue configured, progressive=true is queued for the worker as a plain async job"""
+    print("\n🧪 Testing Progressive Fallback to Durable Queue")
+    print("=" * 50)
+
+    job_queue = make_queue()
+    upload = {'image_id': 'img-4', 'session_id': 'session-4', 's3_key': 'uploads/img-4.png'}
+    original_queue = app.durable_job_queue
+    original_update = app.update_image_processing_status
+    app.durable_job_queue = job_queue
+    app.update_image_processing_status = lambda image_id, status, ocr_result_id=None: None
+    try:
+        with app.app.test_request_context('/process_human_review', method='POST', data={'progressive': 'true'}):
+            assert app.is_async_request() and not app.is_progressive_request()
+            response, status = app.enqueue_upload_response(upload, 'form.png', 'human_review',
+                                                           progressive=app.is_progressive_request())
+    finally:
+        app.durable_job_queue = original_queue
+        app.update_image_processing_status = original_update
+
+    assert status == 202 and response.get_json()['progressive'] is False
+    queued = job_queue.receive()
+    assert len(queued) == 1 and queued[0]['job']['image_id'] == 'img-4' and not queued[0]['job']['progressive']
+    print("✅ Progressive request queued for the worker")
+
+class FailingJobQueue:
+    """Durable queue stub whose send() always fails"""
+
+    name = 'sqs'
+
+    def send(self, job):
+        raise ConnectionError('queue unavailable')
+
+def test_durable_send_failure_reports_backend():
+    """A failed durable-queue send returns 503 naming the backend, not in-process queue stats"""
+    print("\n🧪 Testing Durable Queue Send Failure")
+    print("=" * 50)
+
+    upload = {'image_id': 'img-5', 'session_id': 'session-5', 's3_key': 'uploads/img-5.png'}
+    statuses = []
+    original_queue = app.durable_job_queue
+    original_update = app.update_image_processing_status
+    app.durable_job_queue = FailingJobQueue()
+    app.update_image_processing_status = lambda image_id, status, ocr_result_id=None: statuses.append(status)
+    try:
+        with app.app.test_request_context('/process_automatic', method='POST', data={'async': 'true'}):
+            response, status, headers = app.enqueue_upload_response(upload, 'form.png', 'automatic')
+    finally:
+        app.durable_job_queue = original_queue
+        app.update_image_processing_status = original_update
+
+    body = response.get_json()
+    assert status == 503 and headers['Retry-After'] == '30'
+    assert body['queue_backend'] == 'sqs' and 'queue_depth' not in body
+    assert statuses == ['queued', 'failed']
+    print(f"✅ Send failure response: {body}")
+
+class StubSQSClient:
+    """Stub of SQS get_queue_attributes() that counts calls"""
+
+    def __init__(self):
+        self.attribute_calls = 0
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self.attribute_calls += 1
+        return {'Attributes': {'ApproximateNumberOfMessages': '7', 'ApproximateNumberOfMessagesNotVisible': '2'}}
+
+def test_sqs_depth_is_cached_between_scrapes():
+    """Repeated /metrics scrapes within the TTL reuse one pair of get_queue_attributes calls"""
+    print("\n🧪 Testing SQS Depth Cache")
+    print("=" * 50)
+
+    sqs_queue = app.SQSJobQueue('https://sqs.example/jobs', 'https://sqs.example/dlq', 60, 3, depth_cache_seconds=0.2)
+    stub = StubSQSClient()
+    sqs_queue.client = stub
+    original_queue = app.durable_job_queue
+    app.durable_job_queue = sqs_queue
+    try:
+        for _ in range(3):
+            body = app.app.test_client().get('/metrics').get_data(as_text=True)
+        assert stub.attribute_calls == 2
+        assert 'job_queue_depth{backend="sqs"} 7' in body
+        time.sleep(0.25)
+        assert sqs_queue.depth() == {'queue_depth': 7, 'in_flight': 2, 'dead_letter_depth': 7}
+        assert stub.attribute_calls == 4
+    finally:
+        app.durable_job_queue = original_queue
+    print(f"✅ {stub.attribute_calls} get_queue_attributes calls for 3 scrapes and one refresh")
+
+class StubS3Client:
+    """Stub of S3 upload_fileobj() that records streamed keys and sizes"""
+
+    def __init__(self):
+        self.uploads = {}
+
+    def upload_fileobj(self, stream, bucket, key, ExtraArgs=None):
+        self.uploads[key] = len(stream.read())
+
+class StubTable:
+    """Stub of the DynamoDB Table calls used by batch uploads"""
+
+    def __init__(self):
+        self.items = {}
+
+    def batch_writer(self):
+        table = self
+
+        class Writer:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def put_item(self, Item):
+                table.items[Item['id']] = dict(Item)
+
+        return Writer()
+
+    def put_item(self, Item):
+        self.items[Item['id']] = dict(Item)
+
+    def get_item(self, Key):
+        return {'Item': self.items[Key['id']]} if Key['id'] in self.items else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues=None):
+        item = self.items.setdefault(Key['id'], {})
+        for counter in ('succeeded_count', 'failed_count'):
+            if f"ADD {counter}" in UpdateExpression:
+                item[counter] = item.get(counter, 0) + 1
+        if ':image_ids' in ExpressionAttributeValues:
+            item['failed_image_ids'] = item.get('failed_image_ids', []) + ExpressionAttributeValues[':image_ids']
+        if ':status' in ExpressionAttributeValues:
+            item['processing_status'] = ExpressionAttributeValues[':status']
+        if ':updated_epoch' in ExpressionAttributeValues:
+            item['updated_epoch'] = ExpressionAttributeValues[':updated_epoch']
+        item['updated_at'] = ExpressionAttributeValues[':updated_at']
+        return {'Attributes': dict(item)}
+
+class Upload:
+    """Minimal stand-in for werkzeug's FileStorage"""
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.stream = io.BytesIO(data)
+
+def test_batch_upload_from_zip():
+    """A ZIP batch is streamed entry by entry, queued, and reports aggregate progress"""
+    print("\n🧪 Testing Batch Upload")
+    print("=" * 50)
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        zip_file.writestr('forms/a.jpg', b'\xff\xd8\xff' + b'a' * 100)
+        zip_file.writestr('forms/b.png', b'\x89PNG' + b'b' * 50)
+        zip_file.writestr('forms/notes.txt', b'not a form')
+        zip_file.writestr('__MACOSX/forms/._a.jpg', b'resource fork')
+
+    originals = (app.s3_client, app.dynamodb_table, app.execute_processing_job)
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    app.execute_processing_job = lambda job: job['filename'] == 'a.jpg'
+    try:
+        batch = app.create_batch([Upload('clinic.zip', archive.getvalue())], 'automatic')
+        assert batch['uploaded'] == 2 and batch['total_files'] == 3
+        assert [entry['filename'] for entry in batch['skipped']] == ['notes.txt']
+        assert sorted(app.s3_client.uploads.values()) == [54, 103]
+
+        deadline = time.time() + 5
+        while app.get_batch_progress(batch['batch_id'])['status'] != 'completed' and time.time() < deadline:
+            time.sleep(0.01)
+        progress = app.get_batch_progress(batch['batch_id'])
+    finally:
+        app.s3_client, app.dynamodb_table, app.execute_processing_job = originals
+
+    assert progress['succeeded'] == 1 and progress['failed'] == 1 and progress['progress'] == 1.0
+    assert len(progress['failed_image_ids']) == 1
+    print(f"✅ Batch progress: {progress['succeeded']} succeeded, {progress['failed']} failed")
+
+def test_zip_entries_are_bounded():
+    """ZIP members above the single-upload limit, past the uncompressed total or past the entry cap are skipped"""
+    print("\n🧪 Testing ZIP Limits")
+    print("=" * 50)
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('small.jpg', b'\xff\xd8\xff' + b'a' * 100)
+        zip_file.writestr('bomb.jpg', b'\x00' * (3 * 1024 * 1024))
+        zip_file.writestr('half-1.jpg', b'\x00' * (600 * 1024))
+        zip_file.writestr('half-2.jpg', b'\x00' * (600 * 1024))
+        zip_file.writestr('late.jpg', b'late')
+
+    originals = (app.app.config['MAX_CONTENT_LENGTH'], app.BATCH_MAX_UNCOMPRESSED_MB, app.BATCH_MAX_ZIP_ENTRIES)
+    app.app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+    app.BATCH_MAX_UNCOMPRESSED_MB = 1
+    try:
+        with zipfile.ZipFile(io.BytesIO(archive.getvalue())) as zip_file:
+            entries = [(name, size, reason) for name, _, size, reason in app.iter_zip_entries(zip_file)]
+        app.BATCH_MAX_ZIP_ENTRIES = 1
+        with zipfile.ZipFile(io.BytesIO(archive.getvalue())) as zip_file:
+            capped = [(name, reason) for name, _, _, reason in app.iter_zip_entries(zip_file)]
+    finally:
+        app.app.config['MAX_CONTENT_LENGTH'], app.BATCH_MAX_UNCOMPRESSED_MB, app.BATCH_MAX_ZIP_ENTRIES = originals
+
+    assert entries[0] == ('small.jpg', 103, None)
+    assert entries[1][0] == 'bomb.jpg' and '單檔上限' in entries[1][2]
+    assert entries[2] == ('half-1.jpg', 600 * 1024, None)
+    assert entries[3][0] == 'half-2.jpg' and '總量' in entries[3][2]
+    assert len(entries) == 4  # late.jpg 未被讀取
+    assert capped[0] == ('small.jpg', None) and '項目超過上限' in capped[1][1] and len(capped) == 2
+    print(f"✅ {len(entries)} entries inspected, {sum(1 for entry in entries if entry[2])} skipped")
+
+if __name__ == "__main__":
+    print("🚀 Job Queue Test")
+    print("=" * 80)
+
+    test_visibility_timeout_and_delete()
+    test_retry_then_dead_letter()
+    test_heartbeat_keeps_long_job_invisible()
+    test_abandoned_job_is_marked_failed_on_dead_letter()
+    test_progressive_request_uses_durable_queue()
+    test_durable_send_failure_reports_backend()
+    test_sqs_depth_is_cached_between_scrapes()
+    test_batch_upload_from_zip()
+    test_zip_entries_are_bounded()
+
+    print("\n✅ All tests passed!")
@@ -0,0 +1,790 @@
+#!/usr/bin/env python3
+"""
+Test the multi-model voting pipeline against a stubbed Bedrock client
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import (
+    run_enhanced_voting_system,
+    run_multi_model_voting,
+    CLAUDE_SONNET_MODEL_ID,
+    CLAUDE_HAIKU_MODEL_ID,
+    CLAUDE_SONNET_LATEST_MODEL_ID
+)
+import concurrent.futures
+import copy
+import json
+import pathlib
+import tempfile
+import time
+
+SAMPLE_DATA = {
+    "basic_info": {"chart_number": "A-001", "first_visit_date": "2024/01/01"},
+    "pet_info": {"pet_name": "小白", "species": "狗"},
+    "owner_info": {"owner_name": "王小明", "phone": "0912345678"}
+}
+
+class StubBedrockClient:
+    """Stub of bedrock-runtime converse() returning a fixed payload per model"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def converse(self, modelId, messages, inferenceConfig=None, **kwargs):
+        prompt = messages[0]['content'][0]['text']
+        self.calls.append((modelId, prompt))
+        return {
+            'output': {'message': {'content': [{'text': json.dumps(self.responses[modelId], ensure_ascii=False)}]}},
+            'usage': {'inputTokens': 1500, 'outputTokens': 400}
+        }
+
+def test_quorum_skips_tie_breaker_on_agreement():
+    """Quorum mode should not call the third model when the first two agree"""
+    print("🧪 Testing Quorum Voting (agreement)")
+    print("=" * 50)
+
+    stub = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    result = run_enhanced_voting_system(b'image', voting_mode='quorum')
+    quorum = result['summary']['quorum']
+
+    assert quorum['quorum_reached']
+    assert quorum['calls_saved'] == 1
+    assert len(stub.calls) == 2
+    assert result['voting_result']['final_result']['pet_info']['pet_name'] == "小白"
+    print(f"✅ Calls made: {quorum['calls_made']}, saved: {quorum['calls_saved']}")
+
+def test_quorum_reasks_only_disputed_sections():
+    """Quorum mode should re-ask the tie-breaker only for disputed sections"""
+    print("\n🧪 Testing Quorum Voting (disagreement)")
+    print("=" * 50)
+
+    haiku_data = copy.deepcopy(SAMPLE_DATA)
+    haiku_data['pet_info']['pet_name'] = "小百"
+    stub = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: haiku_data,
+        CLAUDE_SONNET_LATEST_MODEL_ID: {"pet_info": SAMPLE_DATA['pet_info']}
+    })
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    result = run_enhanced_voting_system(b'image', voting_mode='quorum')
+    quorum = result['summary']['quorum']
+
+    assert quorum['tie_breaker_invoked']
+    assert quorum['partial_tie_breaker']
+    assert quorum['disputed_sections'] == ['pet_info']
+    assert '"owner_info"' not in stub.calls[-1][1]
+    assert result['voting_result']['final_result']['pet_info']['pet_name'] == "小白"
+    assert result['voting_result']['vote_details']['owner_info.owner_name']['confidence'] == 1.0
+    print(f"✅ Disputed fields: {quorum['disputed_fields']}")
+
+def test_extraction_cache_skips_bedrock_on_identical_upload():
+    """A second run on identical bytes should be served entirely from the cache"""
+    print("\n🧪 Testing Extraction Cache")
+    print("=" * 50)
+
+    stub = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.bedrock_client = stub
+    app.extraction_cache = app.MemoryExtractionCache(max_entries=16, ttl_seconds=60)
+    hits_before = app.extraction_cache_stats['hits']
+
+    first = run_enhanced_voting_system(b'same image')
+    calls_after_first = len(stub.calls)
+    second = run_enhanced_voting_system(b'same image')
+
+    assert calls_after_first == 3
+    assert len(stub.calls) == calls_after_first
+    assert app.extraction_cache_stats['hits'] - hits_before == 3
+    assert second['voting_result']['final_result'] == first['voting_result']['final_result']
+
+    run_enhanced_voting_system(b'other image')
+    assert len(stub.calls) == calls_after_first + 3
+    print(f"✅ Cache stats: {app.extraction_cache_stats}")
+
+def test_disk_extraction_cache_eviction(tmp_path):
+    """The disk backend should expire and size-bound its entries"""
+    print("\n🧪 Testing Disk Extraction Cache")
+    print("=" * 50)
+
+    cache = app.DiskExtractionCache(str(tmp_path), max_entries=2, ttl_seconds=60)
+    for index in range(3):
+        cache.set(f"{index:064x}", {'index': index})
+        os.utime(cache._path(f"{index:064x}"), (index, time.time() - 10 + index))
+
+    assert cache.get(f"{1:064x}") == {'index': 1}
+    assert cache.prune() == 1
+    assert cache.get(f"{0:064x}") is None
+    assert cache.get(f"{2:064x}") == {'index': 2}
+    print("✅ Disk cache eviction works")
+
+def test_preprocess_image_downscales_and_reports():
+    """Large JPEG uploads should be rotated, downscaled and re-encoded as JPEG"""
+    print("\n🧪 Testing Image Preprocessing")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    image = Image.new('RGB', (4000, 3000), (245, 245, 245))
+    exif = image.getexif()
+    exif[0x0112] = 6  # 旋轉 90 度
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=95, exif=exif)
+
+    result = app.preprocess_image(buffer.getvalue())
+    report = result['report']
+
+    assert app.detect_image_format(result['image_data']) == 'jpeg'
+    assert report['rotated'] and report['resized'] and report['grayscale']
+    assert max(report['processed_dimensions']) == app.IMAGE_MAX_LONG_EDGE
+    assert report['processed_dimensions'][1] > report['processed_dimensions'][0]
+    assert report['processed_bytes'] < report['original_bytes']
+    print(f"✅ {report['original_bytes']} → {report['processed_bytes']} bytes")
+
+def test_metrics_record_model_latency_and_tokens():
+    """Every converse call should land in the per-model latency histogram and token counters"""
+    print("\n🧪 Testing Metrics Endpoint")
+    print("=" * 50)
+
+    stub = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    app.run_with_metrics_route('metrics_test', run_enhanced_voting_system, b'metrics image')
+    body = app.app.test_client().get('/metrics').get_data(as_text=True)
+
+    labels = f'model="{CLAUDE_HAIKU_MODEL_ID}",route="metrics_test"'
+    assert f'bedrock_model_call_duration_seconds_count{{{labels}}} 1' in body
+    assert f'bedrock_input_tokens_total{{{labels}}} 1500' in body
+    assert 'ocr_stage_duration_seconds_count{route="metrics_test",stage="analyze_and_vote"} 1' in body
+    print("✅ Metrics exported")
+
+def test_open_circuit_substitutes_or_skips_member():
+    """An ensemble member with an open breaker is replaced by its fallback or skipped"""
+    print("\n🧪 Testing Circuit Breaker Routing")
+    print("=" * 50)
+
+    stub = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.bedrock_client = stub
+    app.extraction_cache = None
+    breaker = app.get_circuit_breaker(CLAUDE_HAIKU_MODEL_ID)
+    for _ in range(app.CIRCUIT_MIN_CALLS):
+        breaker.record(False, 1.0)
+    original_fallbacks = app.CIRCUIT_FALLBACK_MODELS
+    try:
+        app.CIRCUIT_FALLBACK_MODELS = {CLAUDE_HAIKU_MODEL_ID: CLAUDE_SONNET_MODEL_ID}
+        result = run_enhanced_voting_system(b'circuit image')
+        substituted = result['individual_results'][1]
+        assert substituted['model'] == CLAUDE_SONNET_MODEL_ID and substituted['run_number'] == 2
+        assert result['summary']['circuit_breaker']['substituted_models'] == {CLAUDE_HAIKU_MODEL_ID: CLAUDE_SONNET_MODEL_ID}
+        assert CLAUDE_HAIKU_MODEL_ID not in [model_id for model_id, _ in stub.calls]
+
+        app.CIRCUIT_FALLBACK_MODELS = {}
+        result = run_enhanced_voting_system(b'circuit image')
+        assert result['individual_results'][1]['skipped']
+        assert result['summary']['circuit_breaker']['skipped_models'] == [CLAUDE_HAIKU_MODEL_ID]
+        assert result['voting_result']['successful_models'] == 2
+    finally:
+        app.CIRCUIT_FALLBACK_MODELS = original_fallbacks
+        app.circuit_breakers.pop(CLAUDE_HAIKU_MODEL_ID, None)
+    print(f"✅ Circuit routing: {result['summary']['circuit_breaker']}")
+
+class RefiningBedrockClient(StubBedrockClient):
+    """Stub that answers targeted refinement prompts with a fixed flat JSON"""
+
+    def __init__(self, responses, refinement):
+        super().__init__(responses)
+        self.refinement = refinement
+
+    def converse(self, modelId, messages, inferenceConfig=None, **kwargs):
+        prompt = messages[0]['content'][0]['text']
+        if '候選值' not in prompt:
+            return super().converse(modelId, messages, inferenceConfig, **kwargs)
+        self.calls.append((modelId, prompt))
+        return {
+            'output': {'message': {'content': [{'text': json.dumps(self.refinement, ensure_ascii=False)}]}},
+            'usage': {'inputTokens': 1700, 'outputTokens': 20}
+        }
+
+def test_refinement_reextracts_only_low_confidence_fields():
+    """Fields on which all three models disagree are re-asked in one small call and merged back"""
+    print("\n🧪 Testing Low-confidence Refinement")
+    print("=" * 50)
+
+    responses = {}
+    for model_id, name in ((CLAUDE_SONNET_MODEL_ID, "小白"), (CLAUDE_HAIKU_MODEL_ID, "小百"),
+                           (CLAUDE_SONNET_LATEST_MODEL_ID, "小目")):
+        data = copy.deepcopy(SAMPLE_DATA)
+        data['pet_info']['pet_name'] = name
+        responses[model_id] = data
+    stub = RefiningBedrockClient(responses, {"pet_info.pet_name": "小白", "owner_info.phone": "000"})
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    result = run_enhanced_voting_system(b'refine image')
+    refinement = result['summary']['refinement']
+    detail = result['voting_result']['vote_details']['pet_info.pet_name']
+
+    assert refinement['requested_fields'] == ['pet_info.pet_name']
+    assert refinement['refined_fields'] == ['pet_info.pet_name']
+    assert len(stub.calls) == 4 and '"owner_info"' not in stub.calls[-1][1]
+    assert result['voting_result']['final_result']['pet_info']['pet_name'] == "小白"
+    assert result['voting_result']['final_result']['owner_info']['phone'] == "0912345678"
+    assert detail['refined'] and detail['confidence'] == 0.5
+    assert 'pet_info.pet_name' not in result['summary']['low_confidence_fields']
+    print(f"✅ Refinement: {refinement}")
+
+def test_refinement_covers_single_dissent_and_multi_model_path():
+    """One dissenting vote among three is refined, and the four-run multi-model path refines too"""
+    print("\n🧪 Testing Refinement Threshold")
+    print("=" * 50)
+
+    responses = {}
+    for model_id, name in ((CLAUDE_SONNET_MODEL_ID, "小白"), (CLAUDE_HAIKU_MODEL_ID, "小百"),
+                           (CLAUDE_SONNET_LATEST_MODEL_ID, "小白")):
+        data = copy.deepcopy(SAMPLE_DATA)
+        data['pet_info']['pet_name'] = name
+        responses[model_id] = data
+    stub = RefiningBedrockClient(responses, {"pet_info.pet_name": "小白"})
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    result = run_enhanced_voting_system(b'dissent image')
+    assert result['summary']['refinement']['refined_fields'] == ['pet_info.pet_name']
+    assert result['voting_result']['vote_details']['pet_info.pet_name']['previous_confidence'] < 0.7
+
+    stub.calls.clear()
+    result = run_multi_model_voting(b'multi image')
+    refinement = result['summary']['refinement']
+    assert len(stub.calls) == 5
+    assert refinement['refined_fields'] == ['pet_info.pet_name']
+    assert result['voting_result']['final_result']['pet_info']['pet_name'] == "小白"
+    print(f"✅ Multi-model refinement: {refinement}")
+
+def test_block_extraction_stitches_sections():
+    """Fixed-layout blocks are cropped, extracted with per-section prompts and stitched back"""
+    print("\n🧪 Testing Block OCR")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 1700), (250, 250, 250)).save(buffer, format='PNG')
+    stub = StubBedrockClient({app.BLOCK_MODEL_ID: SAMPLE_DATA})
+    app.bedrock_client = stub
+    app.extraction_cache = None
+
+    blocks = [app.normalize_block(block, index) for index, block in enumerate(app.VET_FORM_BLOCK_LAYOUT)]
+    results = app.run_block_extraction(buffer.getvalue(), blocks)
+    stitched = app.stitch_block_results(results)
+
+    assert len(stub.calls) == len(app.VET_FORM_BLOCK_LAYOUT)
+    assert all(result['success'] for result in results)
+    assert list(results[0]['extracted_data']) == ['basic_info']
+    assert '"owner_info"' not in stub.calls[0][1]
+    assert stitched['basic_info']['chart_number'] == "A-001"
+    assert stitched['owner_info']['phone'] == "0912345678"
+    assert stitched['visit_info']['visit_purpose'] == ""
+    print(f"✅ {len(results)} blocks stitched")
+
+class StubS3Client:
+    """Stub of the S3 put_object() calls made by the pipelines"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        import io
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+class StubTable:
+    """Stub of the DynamoDB Table calls made by save_to_dynamodb and the status updates"""
+
+    def __init__(self):
+        self.items = []
+        self.updates = []
+
+    def put_item(self, Item):
+        self.items.append(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+        self.updates.append((Key['id'], ExpressionAttributeValues))
+        return {}
+
+    def get_item(self, Key, ProjectionExpression=None):
+        statuses = [values[':status'] for image_id, values in self.updates if image_id == Key['id'] and ':status' in values]
+        return {'Item': {'id': Key['id'], 'record_type': 'image_metadata', 'processing_status': statuses[-1]}} if statuses else {}
+
+def test_pdf_pipeline_processes_each_page():
+    """A multi-page PDF is split into pages that share one session id and metadata row"""
+    print("\n🧪 Testing PDF Pipeline")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    pages = [Image.new('RGB', (850, 1100), (255, 255, 255)) for _ in range(3)]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:])
+    pdf_data = buffer.getvalue()
+
+    originals = (app.s3_client, app.dynamodb_table)
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    app.bedrock_client = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.extraction_cache = None
+    try:
+        assert app.is_pdf_file(pdf_data) and app.allowed_file('packet.pdf', allow_pdf=True)
+        assert not app.allowed_file('packet.pdf')
+        result = app.run_pdf_pipeline('img-pdf', 'session-pdf', 'packet.pdf', pdf_data,
+                                      'automatic_uploads/2024/01/01/session-pdf/packet.pdf')
+
+        assert result['success'] and result['page_count'] == 3
+        assert [page['page_number'] for page in result['pages']] == [1, 2, 3]
+        assert all(page['source'] == 'embedded_image' for page in result['pages'])
+        assert {item['session_id'] for item in app.dynamodb_table.items} == {'session-pdf'}
+        assert [item['page_number'] for item in sorted(app.dynamodb_table.items, key=lambda i: i['page_number'])] == [1, 2, 3]
+        assert 'automatic_uploads/2024/01/01/session-pdf/pages/page-0002.jpeg' in app.s3_client.objects
+        final_update = app.dynamodb_table.updates[-1][1]
+        assert final_update[':page_count'] == 3 and final_update[':status'] == 'completed'
+        assert len(final_update[':ocr_result_ids']) == 3
+    finally:
+        app.s3_client, app.dynamodb_table = originals
+    print(f"✅ {result['page_count']} pages processed")
+
+def test_pdf_pipeline_extracts_next_page_only_when_slot_is_free():
+    """Pages are pulled from the PDF only when a worker slot is free, so held pages never exceed the concurrency"""
+    print("\n🧪 Testing PDF Page Backpressure")
+    print("=" * 50)
+
+    import io
+    import threading
+    from PIL import Image
+
+    pages = [Image.new('RGB', (200, 200), (255, 255, 255)) for _ in range(6)]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:])
+
+    lock = threading.Lock()
+    held = {'current': 0, 'peak': 0}
+    original_extract, original_process = app.extract_pdf_page, app.process_pdf_page
+    originals = (app.s3_client, app.dynamodb_table, app.PDF_PAGE_CONCURRENCY)
+
+    def counting_extract(page):
+        with lock:
+            held['current'] += 1
+            held['peak'] = max(held['peak'], held['current'])
+        return {'data': b'', 'source': 'pdf_page'}
+
+    def slow_process(image_id, session_id, s3_key, page_number, page, voting_mode=None):
+        time.sleep(0.05)
+        with lock:
+            held['current'] -= 1
+        return {'page_number': page_number, 'success': True, 'record_id': f'rec-{page_number}', 'confidence_score': 1.0}
+
+    app.extract_pdf_page, app.process_pdf_page = counting_extract, slow_process
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    app.PDF_PAGE_CONCURRENCY = 2
+    try:
+        result = app.run_pdf_pipeline('img-bp', 'session-bp', 'packet.pdf', buffer.getvalue(),
+                                      'automatic_uploads/2024/01/01/session-bp/packet.pdf')
+        assert result['success'] and result['page_count'] == 6
+        assert held['peak'] <= 2, held
+    finally:
+        app.extract_pdf_page, app.process_pdf_page = original_extract, original_process
+        app.s3_client, app.dynamodb_table, app.PDF_PAGE_CONCURRENCY = originals
+    print(f"✅ At most {held['peak']} pages held at once")
+
+def test_pdf_page_extraction_failure_marks_only_that_page():
+    """A page that cannot be extracted is recorded as failed while the other pages are still linked to the image"""
+    print("\n🧪 Testing PDF Per-Page Failure")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    pages = [Image.new('RGB', (200, 200), (255, 255, 255)) for _ in range(3)]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:])
+
+    original_extract, original_process = app.extract_pdf_page, app.process_pdf_page
+    originals = (app.s3_client, app.dynamodb_table)
+    extracted = []
+
+    def flaky_extract(page):
+        extracted.append(page)
+        if len(extracted) == 2:
+            raise ValueError('broken page stream')
+        return {'data': b'', 'source': 'pdf_page'}
+
+    def fake_process(image_id, session_id, s3_key, page_number, page, voting_mode=None):
+        return {'page_number': page_number, 'success': True, 'record_id': f'rec-{page_number}', 'confidence_score': 1.0}
+
+    app.extract_pdf_page, app.process_pdf_page = flaky_extract, fake_process
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    try:
+        result = app.run_pdf_pipeline('img-flaky', 'session-flaky', 'packet.pdf', buffer.getvalue(),
+                                      'automatic_uploads/2024/01/01/session-flaky/packet.pdf')
+        assert result['success'] and result['failed_pages'] == [2]
+        assert 'broken page stream' in result['pages'][1]['error']
+        page_info = app.dynamodb_table.updates[-1][1]
+        assert page_info[':ocr_result_ids'] == ['rec-1', 'rec-3'] and page_info[':page_count'] == 3
+        assert app.dynamodb_table.get_item({'id': 'img-flaky'})['Item']['processing_status'] == 'completed'
+
+        result = app.run_pdf_pipeline('img-bad', 'session-bad', 'bad.pdf', b'%PDF-1.4 not really',
+                                      'automatic_uploads/2024/01/01/session-bad/bad.pdf')
+        assert not result['success']
+        assert app.dynamodb_table.get_item({'id': 'img-bad'})['Item']['processing_status'] == 'failed'
+    finally:
+        app.extract_pdf_page, app.process_pdf_page = original_extract, original_process
+        app.s3_client, app.dynamodb_table = originals
+    print("✅ Page 2 failed alone; unreadable PDF failed the document")
+
+def test_reprocess_routes_stored_pdf_to_page_pipeline():
+    """Reprocessing a stored PDF runs the page pipeline; human review rejects PDFs explicitly"""
+    print("\n🧪 Testing PDF Reprocess")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    pages = [Image.new('RGB', (200, 200), (255, 255, 255)) for _ in range(2)]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:])
+    s3_key = 'automatic_uploads/2024/01/01/session-re/packet.pdf'
+
+    class MetadataTable(StubTable):
+        def get_item(self, Key, ProjectionExpression=None):
+            return {'Item': {'id': Key['id'], 'record_type': 'image_metadata', 's3_key': s3_key,
+                             'session_id': 'session-re', 'filename': 'packet.pdf'}}
+
+    original_process = app.process_pdf_page
+    originals = (app.s3_client, app.dynamodb_table)
+    app.s3_client = StubS3Client()
+    app.s3_client.objects[s3_key] = buffer.getvalue()
+    app.dynamodb_table = MetadataTable()
+    app.process_pdf_page = lambda image_id, session_id, key, page_number, page, voting_mode=None: {
+        'page_number': page_number, 'success': True, 'record_id': f'rec-{page_number}', 'confidence_score': 1.0}
+    try:
+        client = app.app.test_client()
+        response = client.post('/api/images/img-re/reprocess', json={'processing_mode': 'automatic'})
+        review = client.post('/api/images/img-re/reprocess', json={'processing_mode': 'human_review'})
+        upload = client.post('/process_human_review', data={'file': (io.BytesIO(buffer.getvalue()), 'packet.pdf')})
+    finally:
+        app.process_pdf_page = original_process
+        app.s3_client, app.dynamodb_table = originals
+
+    assert response.status_code == 200 and response.get_json()['ocr_result_ids'] == ['rec-1', 'rec-2']
+    assert review.status_code == 400 and upload.status_code == 400
+    assert upload.get_json()['error'] == app.PDF_HUMAN_REVIEW_ERROR
+    print("✅ Stored PDF reprocessed page by page")
+
+def test_process_blocks_saves_result_and_completes_upload():
+    """Block OCR saves the stitched record, completes the upload row and refuses a session that does not own the key"""
+    print("\n🧪 Testing Block OCR Route")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 1700), (250, 250, 250)).save(buffer, format='PNG')
+    s3_key = 'block_uploads/2024/01/01/session-block/form.png'
+
+    class MetadataTable(StubTable):
+        def get_item(self, Key, ProjectionExpression=None):
+            if Key['id'] != 'img-block':
+                return {}
+            return {'Item': {'id': 'img-block', 'record_type': 'image_metadata', 's3_key': s3_key,
+                             'session_id': 'session-block'}}
+
+    originals = (app.s3_client, app.dynamodb_table)
+    app.s3_client = StubS3Client()
+    app.s3_client.objects[s3_key] = buffer.getvalue()
+    app.dynamodb_table = MetadataTable()
+    app.bedrock_client = StubBedrockClient({app.BLOCK_MODEL_ID: SAMPLE_DATA})
+    app.extraction_cache = None
+    try:
+        client = app.app.test_client()
+        foreign = client.post('/process_blocks', json={'s3_key': s3_key, 'image_id': 'img-block', 'session_id': 'other'})
+        response = client.post('/process_blocks', json={'s3_key': s3_key, 'image_id': 'img-block', 'session_id': 'session-block'})
+        statuses = [values[':status'] for image_id, values in app.dynamodb_table.updates if ':status' in values]
+        saved = list(app.dynamodb_table.items)
+    finally:
+        app.s3_client, app.dynamodb_table = originals
+
+    assert foreign.status_code == 404
+    body = response.get_json()
+    assert body['success'] and body['session_id'] == 'session-block' and body['ocr_result_id']
+    assert statuses == ['processing', 'completed']
+    assert saved[0]['processing_mode'] == 'block' and saved[0]['image_id'] == 'img-block'
+    print(f"✅ Block result saved as {body['ocr_result_id']}")
+
+def test_progress_events_follow_pipeline_stages():
+    """An SSE watcher that joins late receives every stage event in order and the stream ends on completion"""
+    print("\n🧪 Testing Progress Events")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (400, 300), (255, 255, 255)).save(buffer, format='PNG')
+
+    originals = (app.s3_client, app.dynamodb_table)
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    app.bedrock_client = StubBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    })
+    app.extraction_cache = None
+    try:
+        result = app.run_automatic_pipeline('img-sse', 'session-sse', 'form.png', buffer.getvalue(), voting_mode='full')
+        assert result['success']
+
+        topic = app.image_topic('img-sse')
+        chunks = list(app.stream_progress_events({topic: lambda: app.image_progress_snapshot('img-sse')}))
+    finally:
+        app.s3_client, app.dynamodb_table = originals
+
+    events = [line.split(': ', 1)[1] for chunk in chunks for line in chunk.splitlines() if line.startswith('event: ')]
+    assert chunks[0].startswith('retry: ')
+    assert events == ['status', 'model_result', 'model_result', 'model_result', 'vote_complete', 'dynamodb_saved', 'status']
+    assert '"status": "completed"' in chunks[-1]
+    assert app.progress_events.snapshot()['subscribers'] == 0
+    print(f"✅ Events: {events}")
+
+class DelayedBedrockClient(StubBedrockClient):
+    """StubBedrockClient with per-model injected latency"""
+
+    def __init__(self, responses, delays):
+        super().__init__(responses)
+        self.delays = delays
+
+    def converse(self, modelId, messages, inferenceConfig=None, **kwargs):
+        time.sleep(self.delays.get(modelId, 0))
+        return super().converse(modelId, messages, inferenceConfig, **kwargs)
+
+def test_progressive_results_deliver_fastest_model_first():
+    """Progressive mode publishes the fastest model's data first, then field-level updates as votes land"""
+    print("\n🧪 Testing Progressive Results")
+    print("=" * 50)
+
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (400, 300), (255, 255, 255)).save(buffer, format='PNG')
+    fast_answer = copy.deepcopy(SAMPLE_DATA)
+    fast_answer['pet_info']['pet_name'] = '小黑'
+
+    originals = (app.s3_client, app.dynamodb_table)
+    app.s3_client = StubS3Client()
+    app.dynamodb_table = StubTable()
+    app.bedrock_client = DelayedBedrockClient({
+        CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA,
+        CLAUDE_HAIKU_MODEL_ID: fast_answer,
+        CLAUDE_SONNET_LATEST_MODEL_ID: SAMPLE_DATA
+    }, {CLAUDE_SONNET_MODEL_ID: 0.2, CLAUDE_SONNET_LATEST_MODEL_ID: 0.4})
+    app.extraction_cache = None
+    try:
+        with app.progress_scope('img-progressive', progressive=True):
+            result = app.run_automatic_pipeline('img-progressive', 'session-progressive', 'form.png',
+                                                buffer.getvalue(), voting_mode='full')
+        assert result['success']
+    finally:
+        app.s3_client, app.dynamodb_table = originals
+
+    events = app.progress_events.events_since(app.image_topic('img-progressive'))
+    names = [record['event'] for record in events]
+    provisional = events[names.index('provisional_result')]['data']
+    assert provisional['model'] == CLAUDE_HAIKU_MODEL_ID
+    assert provisional['extracted_data']['pet_info']['pet_name'] == '小黑'
+    assert provisional['field_confidence']['pet_info.pet_name'] == round(1 / 3, 4)
+
+    updates = [record['data'] for record in events if record['event'] == 'field_updates']
+    pet_name_updates = [update for data in updates for update in data['updates'] if update['field'] == 'pet_info.pet_name']
+    assert [update['value'] for update in pet_name_updates][-1] == '小白'
+    assert pet_name_updates[-1]['confidence'] == round(2 / 3, 4)
+    assert updates[-1]['final'] and names.index('provisional_result') < names.index('vote_complete')
+    print(f"✅ Events: {names}")
+
+class ToolUseBedrockClient(StubBedrockClient):
+    """Stub that answers with a toolUse block when a toolConfig is sent, like Bedrock's converse"""
+
+    def __init__(self, responses):
+        super().__init__(responses)
+        self.tool_configs = []
+
+    def converse(self, modelId, messages, inferenceConfig=None, toolConfig=None, **kwargs):
+        self.tool_configs.append(toolConfig)
+        if toolConfig is None:
+            return {
+                'output': {'message': {'content': [{'text': '以下是提取結果：' + json.dumps(self.responses[modelId], ensure_ascii=False)[:-1]}]}},
+                'usage': {'inputTokens': 1500, 'outputTokens': 400}
+            }
+        name = toolConfig['tools'][0]['toolSpec']['name']
+        return {
+            'output': {'message': {'content': [{'toolUse': {'toolUseId': 't-1', 'name': name, 'input': self.responses[modelId]}}]}},
+            'stopReason': 'tool_use',
+            'usage': {'inputTokens': 1800, 'outputTokens': 300}
+        }
+
+def test_model_timeout_excludes_executor_queue_wait():
+    """Time spent queued behind other calls in model_executor does not count against the per-call timeout"""
+    print("\n🧪 Testing Model Timeout Starts at Execution")
+    print("=" * 50)
+
+    responses = {model_id: SAMPLE_DATA for model_id in (CLAUDE_SONNET_MODEL_ID, CLAUDE_HAIKU_MODEL_ID)}
+    original_executor = app.model_executor
+    app.bedrock_client = DelayedBedrockClient(responses, {CLAUDE_SONNET_MODEL_ID: 0.3, CLAUDE_HAIKU_MODEL_ID: 0.3})
+    app.extraction_cache = None
+    app.model_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        started = time.monotonic()
+        results = app.run_model_tasks(b'queued image', [(CLAUDE_SONNET_MODEL_ID, 1), (CLAUDE_HAIKU_MODEL_ID, 1)], timeout=0.5)
+        elapsed = time.monotonic() - started
+    finally:
+        app.model_executor.shutdown(wait=True)
+        app.model_executor = original_executor
+
+    # 第二個呼叫從提交起算約 0.6 秒才完成，但實際執行只有 0.3 秒，不應逾時
+    assert elapsed > 0.5
+    assert [result['success'] for result in results] == [True, True]
+    print(f"✅ Both calls succeeded after {elapsed:.2f}s with a 0.5s per-call timeout")
+
+def test_structured_tool_output_replaces_text_parsing():
+    """Tool mode sends the VET_FORM_FIELDS schema and reads toolUse input; text mode counts unusable output"""
+    print("\n🧪 Testing Structured Tool Output")
+    print("=" * 50)
+
+    stub = ToolUseBedrockClient({CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA})
+    app.bedrock_client = stub
+    app.extraction_cache = None
+    app.extraction_parse_stats.clear()
+    original_mode = app.EXTRACTION_OUTPUT_MODE
+    try:
+        app.EXTRACTION_OUTPUT_MODE = 'tool'
+        tool_result = app.process_with_claude_model(b'image', CLAUDE_SONNET_MODEL_ID, 1)
+        section_result = app.process_with_claude_model(b'image', CLAUDE_SONNET_MODEL_ID, 2,
+                                                       prompt=app.get_section_extraction_prompt(['pet_info']),
+                                                       sections=['pet_info'])
+        app.EXTRACTION_OUTPUT_MODE = 'text'
+        text_result = app.process_with_claude_model(b'image', CLAUDE_SONNET_MODEL_ID, 3)
+    finally:
+        app.EXTRACTION_OUTPUT_MODE = original_mode
+
+    schema = stub.tool_configs[0]['tools'][0]['toolSpec']['inputSchema']['json']
+    assert set(schema['properties']) == set(app.VET_FORM_SECTIONS)
+    assert schema['properties']['pet_info']['properties']['pet_name']['description'] == app.VET_FORM_FIELDS['pet_name']
+    assert set(stub.tool_configs[1]['tools'][0]['toolSpec']['inputSchema']['json']['properties']) == {'pet_info'}
+    assert stub.tool_configs[2] is None
+
+    tool_prompt = app.build_extraction_prompt('full', None, 'tool')['text']
+    text_prompt = app.build_extraction_prompt('full', None, 'text')['text']
+    assert '只返回 JSON' not in tool_prompt and '"pet_name": ""' not in tool_prompt
+    assert '特別注意' in tool_prompt and '"pet_name": ""' in text_prompt
+    assert schema['properties']['pet_info']['properties']['species']['description'] == app.describe_form_field('species')
+
+    assert tool_result['extracted_data'].to_nested() == SAMPLE_DATA and section_result['success']
+    assert 'parsing_error' in text_result['extracted_data'].extras
+    parsing = app.get_extraction_parse_summary()
+    assert parsing['tool'] == {'outcomes': {'tool_use': 2}, 'total': 2, 'failure_rate': 0.0}
+    assert parsing['text']['outcomes'] == {'failed': 1}
+    print(f"✅ Parsing: {parsing}")
+
+def test_compact_prompt_variant_per_model():
+    """A model configured for the compact prompt gets short keys, and its output is expanded back"""
+    print("\n🧪 Testing Compact Prompt Variant")
+    print("=" * 50)
+
+    compact_keys = app.FIELD_COMPACT_KEYS
+    compact_data = {compact_keys['pet_name']: "小白", compact_keys['owner_name']: "王小明"}
+    stub = ToolUseBedrockClient({CLAUDE_HAIKU_MODEL_ID: compact_data, CLAUDE_SONNET_MODEL_ID: SAMPLE_DATA})
+    app.bedrock_client = stub
+    app.extraction_cache = None
+    app.prompt_usage_stats.clear()
+    original = (app.EXTRACTION_OUTPUT_MODE, app.EXTRACTION_PROMPT_VARIANTS)
+    app.EXTRACTION_OUTPUT_MODE = 'tool'
+    app.EXTRACTION_PROMPT_VARIANTS = {CLAUDE_HAIKU_MODEL_ID: 'compact'}
+    try:
+        results = app.run_model_tasks(b'image', [(CLAUDE_HAIKU_MODEL_ID, 1), (CLAUDE_SONNET_MODEL_ID, 1)])
+        summary = app.get_prompt_variant_summary()
+    finally:
+        app.EXTRACTION_OUTPUT_MODE, app.EXTRACTION_PROMPT_VARIANTS = original
+
+    compact_result, full_result = results
+    assert compact_result['extracted_data'].to_nested() == {"pet_info": {"pet_name": "小白"}, "owner_info": {"owner_name": "王小明"}}
+    assert compact_result['prompt_version'].startswith('compact-') and full_result['prompt_version'].startswith('full-')
+    schemas = {frozenset(config['tools'][0]['toolSpec']['inputSchema']['json']['properties']) for config in stub.tool_configs}
+    assert schemas == {frozenset(compact_keys.values()), frozenset(app.VET_FORM_SECTIONS)}
+    variants = summary['variants']
+    assert variants['compact']['estimated_prompt_tokens'] < variants['full']['estimated_prompt_tokens']
+    assert variants['compact']['measured'][CLAUDE_HAIKU_MODEL_ID] == {'calls': 1, 'avg_input_tokens': 1800.0}
+    print(f"✅ Prompt tokens (estimated): full={variants['full']['estimated_prompt_tokens']}, "
+          f"compact={variants['compact']['estimated_prompt_tokens']}")
+
+if __name__ == "__main__":
+    print("🚀 Voting Pipeline Test")
+    print("=" * 80)
+
+    test_quorum_skips_tie_breaker_on_agreement()
+    test_quorum_reasks_only_disputed_sections()
+    test_extraction_cache_skips_bedrock_on_identical_upload()
+    test_disk_extraction_cache_eviction(pathlib.Path(tempfile.mkdtemp()))
+    test_preprocess_image_downscales_and_reports()
+    test_metrics_record_model_latency_and_tokens()
+    test_open_circuit_substitutes_or_skips_member()
+    test_refinement_reextracts_only_low_confidence_fields()
+    test_refinement_covers_single_dissent_and_multi_model_path()
+    test_block_extraction_stitches_sections()
+    test_pdf_pipeline_processes_each_page()
+    test_pdf_pipeline_extracts_next_page_only_when_slot_is_free()
+    test_pdf_page_extraction_failure_marks_only_that_page()
+    test_reprocess_routes_stored_pdf_to_page_pipeline()
+    test_process_blocks_saves_result_and_completes_upload()
+    test_progress_events_follow_pipeline_stages()
+    test_progressive_results_deliver_fastest_model_first()
+    test_model_timeout_excludes_executor_queue_wait()
+    test_structured_tool_output_replaces_text_parsing()
+    test_compact_prompt_variant_per_model()
+
+    print("\n✅ All tests passed!")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Standalone OCR worker - consumes the durable job queue (JOB_QUEUE_BACKEND=sqlite / sqs)
+and runs the same processing pipeline as the web routes.
+
+Usage:
+    JOB_QUEUE_BACKEND=sqlite python worker.py
+    JOB_QUEUE_BACKEND=sqs JOB_QUEUE_SQS_URL=https://sqs... python worker.py
+"""
+
+import os
+import signal
+import threading
+import time
+
+from app import durable_job_queue, handle_queue_message, JOB_QUEUE_BACKEND
+
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '4'))
+WORKER_IDLE_SLEEP_SECONDS = float(os.getenv('WORKER_IDLE_SLEEP_SECONDS', '1'))
+
+stop_event = threading.Event()
+
+def consume_loop(index):
+    """單一消費執行緒：取一則訊息、處理、重複"""
+    while not stop_event.is_set():
+        try:
+            messages = durable_job_queue.receive(max_messages=1)
+        except Exception as e:
+            print(f"❌ [worker-{index}] 讀取佇列失敗: {str(e)}")
+            stop_event.wait(WORKER_IDLE_SLEEP_SECONDS * 5)
+            continue
+
+        if not messages:
+            # SQS 使用 long polling，SQLite 則需要短暫休息
+            if durable_job_queue.name == 'sqlite':
+                stop_event.wait(WORKER_IDLE_SLEEP_SECONDS)
+            continue
+
+        for message in messages:
+            started = time.perf_counter()
+            outcome = handle_queue_message(durable_job_queue, message)
+            print(f"🧵 [worker-{index}] {message['job']['image_id']}: {outcome} ({time.perf_counter() - started:.1f}s)")
+
+def main():
+    if durable_job_queue is None:
+        print(f"❌ JOB_QUEUE_BACKEND={JOB_QUEUE_BACKEND} 不是持久化佇列，請設定為 sqlite 或 sqs")
+        return 1
+
+    def request_stop(signum, frame):
+        print("⏹️ 收到停止訊號，處理完目前的工作後結束...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"🚀 啟動 OCR worker: backend={durable_job_queue.name}, concurrency={WORKER_CONCURRENCY}")
+    threads = [
+        threading.Thread(target=consume_loop, args=(index,), name=f'worker-{index}')
+        for index in range(WORKER_CONCURRENCY)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("✅ Worker 已停止")
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())